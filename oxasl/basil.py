@@ -33,13 +33,19 @@ Copyright (c) 2008-2018 University of Oxford
 
 import sys
 import math
+import copy
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
+import six
 import numpy as np
 
 from fsl.wrappers import LOAD
 from fsl.data.image import Image
 
 from oxasl import __version__, __timestamp__, AslImage, Workspace, image
+from oxasl.mvn import MVN
 from oxasl.options import AslOptionParser, OptionCategory, IgnorableOptionGroup, GenericOptions
 
 def basil(wsp, output_wsp=None, prefit=True):
@@ -77,13 +83,104 @@ def basil(wsp, output_wsp=None, prefit=True):
      - ``spatial`` : If True, include final spatial VB step (default: False)
      - ``onestep`` : If True, do all inference in a single step (default: False)
      - ``basil_options`` : Optional dictionary of additional options for underlying model
+     - ``adaptive_convergence`` : If True, run the spatial step in blocks of iterations until
+                                  the free energy converges, which may be up to twice the
+                                  usual number of iterations (default: False)
+     - ``convergence_tol`` : Relative free energy change for adaptive convergence (default: 1e-3)
+     - ``mvn_cache`` : Directory for cache of final MVN outputs. If a previous run on the same
+                       data is found, it is used to initialize this run and the pre-fit is skipped
     """
-    wsp.log.write("\nRunning BASIL Bayesian modelling on ASL data\n")
     if output_wsp is None:
         output_wsp = wsp.sub("modelling")
 
+    basil_prefit(wsp, output_wsp, prefit=prefit)
+    basil_main(wsp, output_wsp)
+
+def basil_prefit(wsp, output_wsp, prefit=True):
+    """
+    First stage of ``basil``: set up defaults and find an initial MVN for the main fit
+
+    The initial MVN is taken from the MVN cache if enabled, otherwise it is obtained
+    by fitting to the mean over repeats of the ASL data
+
+    :param wsp: Workspace object
+    :param output_wsp: Workspace object for storing output
+    :param prefit: If True, run a pre-fitting step using the mean over repeats of the ASL data
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``output_wsp.initmvn`` : Initial MVN from the cache, if found
+     - ``output_wsp.init`` : Output of pre-fitting step, if run
+     - ``output_wsp.main.initmvn`` : Initial MVN from the pre-fitting step, if run
+    """
+    wsp.log.write("\nRunning BASIL Bayesian modelling on ASL data\n")
+    _basil_defaults(wsp, wsp.asldata)
+
+    # Pick up extra BASIL options
+    extra_options = dict(wsp.ifnone("basil_options", {}))
+
+    # Look for a compatible MVN from a previous run to initialize from
+    if wsp.mvn_cache:
+        from oxasl.mvn import MvnCache
+        from .wrappers import model_params
+        mvn_cache = MvnCache(wsp.mvn_cache, log=wsp.log)
+        cache_key = mvn_cache.key(wsp.asldata, wsp.rois.mask, extra_options)
+        options = _final_model_options(wsp, **extra_options)
+        initmvn = mvn_cache.initmvn(cache_key, model_params(options), priors=_model_priors(options))
+        if initmvn is not None:
+            output_wsp.initmvn = initmvn
+            return
+
+    if wsp.initmvn is not None:
+        # The initial MVN overrides any initialisation from the pre-fit
+        return
+
+    if prefit and max(wsp.asldata.rpts) > 1:
+        # Initial BASIL run on mean data
+        wsp.log.write(" - Doing initial fit on mean at each TI\n\n")
+        init_wsp = output_wsp.sub("init")
+        main_wsp = output_wsp.sub("main")
+        basil_fit(wsp, wsp.asldata.mean_across_repeats(), mask=wsp.rois.mask, output_wsp=init_wsp, **extra_options)
+        main_wsp.initmvn = init_wsp.finalstep.finalMVN
+
+def basil_main(wsp, output_wsp):
+    """
+    Second stage of ``basil``: fit the model to the full ASL data
+
+    :param wsp: Workspace object
+    :param output_wsp: Workspace object for storing output, as passed to ``basil_prefit``
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``output_wsp.finalstep`` : Workspace containing output of the final modelling step
+    """
+    extra_options = dict(wsp.ifnone("basil_options", {}))
+    main_wsp = output_wsp.main
+    if main_wsp is None:
+        main_wsp = output_wsp
+    if main_wsp.initmvn is not None:
+        extra_options["continue-from-mvn"] = main_wsp.initmvn
+
+    # Main run on full ASL data
+    wsp.log.write("\n - Doing fit on full ASL data\n\n")
+    basil_fit(wsp, wsp.asldata, mask=wsp.rois.mask, output_wsp=main_wsp, **extra_options)
+    output_wsp.finalstep = main_wsp.finalstep
+
+    if wsp.mvn_cache and output_wsp.finalstep.paramnames is not None:
+        from oxasl.mvn import MvnCache
+        mvn_cache = MvnCache(wsp.mvn_cache, log=wsp.log)
+        cache_key = mvn_cache.key(wsp.asldata, wsp.rois.mask, extra_options)
+        mvn_cache.store(cache_key, output_wsp.finalstep.finalMVN, output_wsp.finalstep.paramnames)
+
+def _basil_defaults(wsp, asldata):
+    """
+    Set up default values of workspace attributes for BASIL modelling which depend
+    on the ASL data
+    """
     # Single or Multi TI setup
-    if wsp.asldata.ntis == 1:
+    if asldata.ntis == 1:
         # Single TI data - don't try to infer arterial component of bolus duration, we don't have enough info
         wsp.log.write(" - Operating in Single TI mode - no arterial component, fixed bolus duration\n")
         wsp.inferart = False
@@ -102,7 +199,7 @@ def basil(wsp, output_wsp=None, prefit=True):
         bat_default = 0.0
     else:
         t1_default = 1.3
-        if wsp.asldata.casl:
+        if asldata.casl:
             bat_default = 1.3
         else:
             bat_default = 0.7
@@ -115,28 +212,9 @@ def basil(wsp, output_wsp=None, prefit=True):
     
     # if we are doing CASL then fix the bolus duration, unless explicitly told us otherwise
     if wsp.infertau is None: 
-        wsp.infertau = not wsp.asldata.casl
-
-    # Pick up extra BASIL options
-    extra_options = dict(wsp.ifnone("basil_options", {}))
-
-    if prefit and max(wsp.asldata.rpts) > 1:
-        # Initial BASIL run on mean data
-        wsp.log.write(" - Doing initial fit on mean at each TI\n\n")
-        init_wsp = output_wsp.sub("init")
-        main_wsp = output_wsp.sub("main")
-        basil_fit(wsp, wsp.asldata.mean_across_repeats(), mask=wsp.rois.mask, output_wsp=init_wsp, **extra_options)
-        extra_options["continue-from-mvn"] = output_wsp.init.finalstep.finalMVN
-        main_wsp.initmvn = extra_options["continue-from-mvn"]
-    else:
-        main_wsp = output_wsp
-
-    # Main run on full ASL data
-    wsp.log.write("\n - Doing fit on full ASL data\n\n")
-    basil_fit(wsp, wsp.asldata, mask=wsp.rois.mask, output_wsp=main_wsp, **extra_options)
-    output_wsp.finalstep = main_wsp.finalstep
+        wsp.infertau = not asldata.casl
 
-def basil_fit(wsp, asldata, mask=None, output_wsp=None, **kwargs):
+def basil_fit(wsp, asldata, mask=None, output_wsp=None, steps=None, **kwargs):
     """
     Run Bayesian model fitting on ASL data
 
@@ -146,8 +224,11 @@ def basil_fit(wsp, asldata, mask=None, output_wsp=None, **kwargs):
     :param asldata: AslImage object to use as input data
     :param output_wsp: Optional Workspace object for storing output files. If not specified
                        ``wsp`` is used instead
+    :param steps: Optional pre-generated steps from ``basil_steps``. If not specified
+                  the steps are generated from ``asldata`` and the keyword arguments
     """
-    steps = basil_steps(wsp, asldata, mask, **kwargs)
+    if steps is None:
+        steps = basil_steps(wsp, asldata, mask, **kwargs)
     if output_wsp is None:
         output_wsp = wsp
 
@@ -173,6 +254,97 @@ def basil_fit(wsp, asldata, mask=None, output_wsp=None, **kwargs):
     output_wsp.finalstep = step_wsp
     wsp.log.write("\nEnd\n")
 
+def basil_epochs(wsp, epochs, output_wsp=None, nthreads=None, warm_start=True):
+    """
+    Run BASIL modelling on a sequence of ASL epochs, e.g. from ``AslImage.split_epochs``
+
+    Modelling steps are only generated once for each distinct TI/PLD structure in
+    the epochs and the Fabber runs for different epochs share the same options
+    other than the input data. Epochs are divided into contiguous chunks which are
+    processed concurrently. Within a chunk, each epoch is initialized from the final
+    MVN of the previous epoch.
+
+    See ``basil`` for details of workspace attributes used
+
+    :param wsp: Workspace object
+    :param epochs: Sequence of AslImage objects, one for each epoch
+    :param output_wsp: Optional Workspace object for storing output. If not specified
+                       ``wsp.sub("epochs")`` is used
+    :param nthreads: Number of epochs to process concurrently. If not specified,
+                     ``wsp.epoch_threads`` is used, or the number of CPUs
+    :param warm_start: If True, initialize each epoch from the previous epoch in
+                       the same chunk
+
+    Output workspace attributes
+    ---------------------------
+
+     - ``mean_<param>``, ``std_<param>`` : 4D Images containing the parameter timeseries,
+                                           one volume per epoch
+     - ``epoch_finalmvn`` : List of final MVN images, one per epoch (not saved)
+    """
+    if not epochs:
+        raise ValueError("No epochs to model")
+
+    wsp.log.write("\nRunning BASIL Bayesian modelling on %i ASL epochs\n" % len(epochs))
+    if output_wsp is None:
+        output_wsp = wsp.sub("epochs")
+    if nthreads is None:
+        nthreads = wsp.ifnone("epoch_threads", multiprocessing.cpu_count())
+
+    # Defaults are chosen for the epoch with the fewest TIs so every epoch can
+    # support the parameters being inferred
+    _basil_defaults(wsp, min(epochs, key=lambda epoch: epoch.ntis))
+    extra_options = dict(wsp.ifnone("basil_options", {}))
+
+    # Generate steps once for each TI/PLD structure, and derive the steps for
+    # other epochs with the same structure by replacing the data
+    template_steps = {}
+    epoch_steps = []
+    for epoch in epochs:
+        key = (tuple(epoch.tis), tuple(epoch.rpts), tuple(epoch.taus), epoch.casl)
+        if key not in template_steps:
+            template_steps[key] = basil_steps(wsp, epoch, wsp.rois.mask, **extra_options)
+        epoch_data = epoch.diff().reorder("rt")
+        epoch_steps.append([step.derived({"data" : epoch_data}) for step in template_steps[key]])
+
+    nchunks = max(1, min(nthreads, len(epochs)))
+    chunks = [list(chunk) for chunk in np.array_split(np.arange(len(epochs)), nchunks)]
+    results = [None] * len(epochs)
+    log_lock = threading.Lock()
+
+    def _run_chunk(chunk):
+        prev_result = None
+        for epoch_idx in chunk:
+            if not warm_start:
+                prev_result = None
+            epoch_log = six.StringIO()
+            for step in epoch_steps[epoch_idx]:
+                prev_result = step.run(prev_result, log=epoch_log, fsllog=wsp.fsllog,
+                                       fabber_corelib=wsp.fabber_corelib, fabber_libs=wsp.fabber_libs,
+                                       fabber_coreexe=wsp.fabber_coreexe, fabber_exes=wsp.fabber_exes)
+            results[epoch_idx] = prev_result
+            with log_lock:
+                wsp.log.write(" - Epoch %i of %i: DONE\n" % (epoch_idx+1, len(epochs)))
+
+    if nchunks == 1:
+        _run_chunk(chunks[0])
+    else:
+        pool = ThreadPool(nchunks)
+        try:
+            pool.map(_run_chunk, chunks)
+        finally:
+            pool.close()
+
+    # Collect 3D parameter outputs into timeseries
+    header = epochs[0].header
+    for key, value in results[0].items():
+        if not key.startswith(("mean_", "std_")) or not isinstance(value, Image) or value.ndim != 3:
+            continue
+        timeseries = np.stack([result[key].data for result in results], axis=-1)
+        setattr(output_wsp, key, Image(timeseries, name=key, header=header))
+    output_wsp.epoch_finalmvn = [result["finalMVN"] for result in results]
+    wsp.log.write("\nEnd\n")
+
 def basil_steps(wsp, asldata, mask=None, **kwargs):
     """
     Get the steps required for a BASIL run
@@ -300,21 +472,7 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         raise ValueError("ERROR: PV correction is not compatible with --artonly option (there is no tissue component)")
 
     # Set general parameter inference and inclusion
-    if wsp.infertiss:
-        options["inctiss"] = True
-    if wsp.inferbat:
-        options["incbat"] = True
-        options["inferbat"] = True # Infer in first step
-    if wsp.inferart:
-        options["incart"] = True
-    if wsp.inferpc:
-        options["incpc"] = True
-    if wsp.infertau:
-        options["inctau"] = True
-    if wsp.infert1:
-        options["inct1"] = True
-    if pvcorr:
-        options["incpve"] = True
+    options.update(_inclusion_options(wsp, pvcorr))
 
     # Keep track of the number of spatial priors specified by name
     spriors = 1 
@@ -408,7 +566,10 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         del options["max-trials"]
 
         if not wsp.onestep:
-            steps.append(FabberStep(options, step_desc))
+            policy = None
+            if wsp.adaptive_convergence:
+                policy = ConvergencePolicy(options["max-iterations"], tolerance=wsp.ifnone("convergence_tol", 1e-3))
+            steps.append(FabberStep(options, step_desc, policy=policy))
 
     ### --- SINGLE-STEP OPTION ---
     if wsp.onestep:
@@ -419,33 +580,203 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         
     return steps
 
+def _inclusion_options(wsp, pvcorr):
+    """
+    :return: Fabber options for the model components which are included in all steps
+    """
+    options = {}
+    if wsp.infertiss:
+        options["inctiss"] = True
+    if wsp.inferbat:
+        options["incbat"] = True
+        options["inferbat"] = True # Infer in first step
+    if wsp.inferart:
+        options["incart"] = True
+    if wsp.inferpc:
+        options["incpc"] = True
+    if wsp.infertau:
+        options["inctau"] = True
+    if wsp.infert1:
+        options["inct1"] = True
+    if pvcorr:
+        options["incpve"] = True
+    return options
+
+def _final_model_options(wsp, **kwargs):
+    """
+    Get the model options of the final step of a BASIL run, without generating the steps
+
+    These determine the parameters inferred by the run, e.g. to look up an initial MVN
+    from the cache. Keyword arguments are the same as for ``basil_steps``
+    """
+    options = {"model" : "aslrest", "disp" : "none", "exch" : "mix"}
+    options.update(kwargs)
+    for attr in ("t1", "t1b", "bat", "batsd", "pwm", "pgm"):
+        value = getattr(wsp, attr)
+        if value is not None:
+            options[attr] = value
+
+    pvcorr = "pgm" in options or "pwm" in options
+    options.update(_inclusion_options(wsp, pvcorr))
+    for attr in ("infertiss", "inferart", "infertau", "inferpc", "infert1"):
+        if getattr(wsp, attr):
+            options[attr] = True
+    if options["disp"] != "none":
+        options["inferdisp"] = True
+    if options["exch"] != "mix":
+        options["inferexch"] = True
+    if pvcorr:
+        options["pvcorr"] = True
+    return options
+
+def _model_priors(options):
+    """
+    :return: Mapping from model parameter name to tuple of (mean, variance) for parameters
+             whose prior is set by the model options
+    """
+    priors = {}
+    for param, mean_opt, sd_opt in (("delttiss", "bat", "batsd"),
+                                    ("deltblood", "batart", "batartsd"),
+                                    ("deltwm", "batwm", "batwmsd"),
+                                    ("tautiss", "tau", None),
+                                    ("T_1", "t1", None),
+                                    ("T_1b", "t1b", None)):
+        if mean_opt in options:
+            var = float(options[sd_opt])**2 if sd_opt in options else 1.0
+            priors[param] = (float(options[mean_opt]), var)
+    return priors
+
 def _add_prior(options, prior_idx, param, **kwargs):
     options["PSP_byname%i" % prior_idx] = param
     for key, value in kwargs.items():
         options["PSP_byname%i_%s" % (prior_idx, key)] = value
     return prior_idx + 1
 
+class ConvergencePolicy(object):
+    """
+    Adaptive iteration budget for a Fabber step
+
+    The step is run in blocks of iterations, each initialised from the final MVN of
+    the previous block. The mean free energy within the mask is compared between
+    blocks and the step finishes when the relative change is below the tolerance.
+    The nominal maximum number of iterations may be exceeded, up to ``iteration_limit``,
+    while the free energy is still increasing.
+
+    Note that each block is a separate Fabber run, so the spatial prior is
+    re-estimated from the initial MVN at the start of each block. The result is
+    therefore not identical to an uninterrupted run of the same number of iterations.
+    """
+    def __init__(self, max_iterations, block_iterations=None, tolerance=1e-3, iteration_limit=None):
+        """
+        :param max_iterations: Nominal maximum number of iterations
+        :param block_iterations: Number of iterations in each block. Defaults to
+                                 a quarter of ``max_iterations``
+        :param tolerance: Relative change in free energy between blocks for convergence
+        :param iteration_limit: Maximum number of iterations while the free energy is
+                                still increasing. Defaults to twice ``max_iterations``
+        """
+        self.max_iterations = max_iterations
+        if block_iterations is None:
+            block_iterations = max(1, max_iterations // 4)
+        self.block_iterations = min(block_iterations, max_iterations)
+        self.tolerance = tolerance
+        self.iteration_limit = max(max_iterations, iteration_limit if iteration_limit is not None else 2 * max_iterations)
+
+    def converged(self, prev_free_energy, free_energy):
+        """
+        :return: True if the change in free energy between blocks is within the tolerance
+        """
+        if prev_free_energy is None or free_energy is None:
+            return False
+        change = abs(free_energy - prev_free_energy)
+        return change <= self.tolerance * max(abs(prev_free_energy), 1e-12)
+
+    def finished(self, iterations, prev_free_energy, free_energy):
+        """
+        :param iterations: Number of iterations run so far
+        :return: True if no further blocks of iterations should be run
+        """
+        if self.converged(prev_free_energy, free_energy):
+            return True
+        if iterations + self.block_iterations > self.iteration_limit:
+            return True
+        if iterations >= self.max_iterations:
+            # Only continue beyond the nominal limit while the free energy is increasing
+            return prev_free_energy is None or free_energy is None or free_energy <= prev_free_energy
+        return False
+
+def _mean_free_energy(result, mask=None):
+    """
+    :return: Mean free energy from the output of a Fabber run, or None if not available
+    """
+    free_energy = result.get("freeEnergy", None)
+    if free_energy is None:
+        return None
+    data = free_energy.data
+    if mask is not None:
+        data = data[mask.data != 0]
+    data = data[np.isfinite(data)]
+    if data.size == 0:
+        return None
+    return float(np.mean(data))
+
 class Step(object):
     """
     A step in the Basil modelling process
     """
-    def __init__(self, options, desc):
+    def __init__(self, options, desc, policy=None):
         self.options = dict(options)
         self.desc = desc
+        self.policy = policy
+
+    def derived(self, options):
+        """
+        :param options: Dictionary of options to override
+        :return: Copy of this step with the specified options changed
+        """
+        step = copy.copy(self)
+        step.options = dict(self.options)
+        step.options.update(options)
+        return step
 
 class FabberStep(Step):
     """
     A Basil step which involves running Fabber
+
+    If the step has a ``ConvergencePolicy``, Fabber is run repeatedly in blocks
+    of iterations until the free energy has converged. Where the number of iterations
+    run is known it is returned in the output as ``iterations``
     """
     def run(self, prev_output, log=sys.stdout, fsllog=None, **kwargs):
         """
         Run Fabber, initialising it from the output of a previous step
         """
+        options = dict(self.options)
         if prev_output is not None:
-            self.options["continue-from-mvn"] = prev_output["finalMVN"]
+            options["continue-from-mvn"] = prev_output["finalMVN"]
         from .wrappers import fabber
-        ret = fabber(self.options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
-        log.write("\n")
+
+        if self.policy is None:
+            ret = fabber(options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
+            if options.get("convergence", None) == "maxits":
+                ret["iterations"] = options["max-iterations"]
+            log.write("\n")
+            return ret
+
+        options["max-iterations"] = self.policy.block_iterations
+        options["convergence"] = "maxits"
+        options["save-free-energy"] = True
+        iterations, prev_free_energy = 0, None
+        while True:
+            ret = fabber(options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
+            iterations += self.policy.block_iterations
+            free_energy = _mean_free_energy(ret, options.get("mask", None))
+            if self.policy.finished(iterations, prev_free_energy, free_energy):
+                break
+            options["continue-from-mvn"] = ret["finalMVN"]
+            prev_free_energy = free_energy
+        log.write(" (%i iterations)\n" % iterations)
+        ret["iterations"] = iterations
         return ret
 
 class PvcInitStep(Step):
@@ -483,13 +814,13 @@ class PvcInitStep(Step):
         wmcbf_init = Image(wmcbf_init, header=mvn.header)
 
         # load these into the MVN
-        mvn = prev_output["finalMVN"]
-        from .wrappers import mvntool
-        params = prev_output["paramnames"]
-        mvn = mvntool(mvn, params.index("ftiss")+1, output=LOAD, mask=mask, write=True, valim=gmcbf_init, var=0.1, log=fsllog)["output"]
-        mvn = mvntool(mvn, params.index("fwm")+1, output=LOAD, mask=mask, write=True, valim=wmcbf_init, var=0.1, log=fsllog)["output"]
+        mvn = MVN(prev_output["finalMVN"], prev_output["paramnames"])
+        mvn.set_mean("ftiss", gmcbf_init, mask=mask)
+        mvn.set_var("ftiss", 0.1, mask=mask)
+        mvn.set_mean("fwm", wmcbf_init, mask=mask)
+        mvn.set_var("fwm", 0.1, mask=mask)
         log.write("DONE\n")
-        return {"finalMVN" : mvn, "gmcbf_init" : gmcbf_init, "wmcbf_init" : wmcbf_init}
+        return {"finalMVN" : mvn.image(), "gmcbf_init" : gmcbf_init, "wmcbf_init" : wmcbf_init}
 
 class BasilOptions(OptionCategory):
     """
@@ -513,6 +844,8 @@ class BasilOptions(OptionCategory):
         group.add_option("--fast", help="Faster analysis (1=faster, 2=single step", type=int, default=0)
         group.add_option("--noiseprior", help="Use an informative prior for the noise estimation", action="store_true", default=False)
         group.add_option("--noisesd", help="Set a custom noise std. dev. for the nosie prior", type=float)
+        group.add_option("--adaptive-convergence", help="Run spatial VB iterations until the free energy has converged, up to twice the usual limit", action="store_true", default=False)
+        group.add_option("--convergence-tol", help="Relative free energy change for --adaptive-convergence", type=float, default=1e-3)
         groups.append(group)
 
         group = IgnorableOptionGroup(parser, "Model options", ignore=self.ignore)
@@ -527,6 +860,13 @@ class BasilOptions(OptionCategory):
 
         group = IgnorableOptionGroup(parser, "Special options", ignore=self.ignore)
         group.add_option("--t1im", help="Voxelwise T1 tissue estimates", type="image")
+        group.add_option("--mvn-cache", help="Directory for cache of final MVN outputs used to initialize runs on the same data")
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Epoch analysis", ignore=self.ignore)
+        group.add_option("--epoch-size", help="Model the data in epochs of this number of (differenced) volumes", type=int)
+        group.add_option("--epoch-overlap", help="Number of volumes overlap between consecutive epochs", type=int, default=0)
+        group.add_option("--epoch-threads", help="Number of epochs to model concurrently (default: number of CPUs)", type=int)
         groups.append(group)
 
         return groups
@@ -585,7 +925,10 @@ def main():
                         wsp.basil_options[key] = keyval[1].strip()
 
         # Run BASIL processing, passing options as keyword arguments using **
-        basil(wsp)
+        if wsp.epoch_size:
+            basil_epochs(wsp, wsp.asldata.split_epochs(wsp.epoch_size, overlap=wsp.epoch_overlap))
+        else:
+            basil(wsp)
         
     except ValueError as exc:
         sys.stderr.write("\nERROR: " + str(exc) + "\n")
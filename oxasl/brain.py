@@ -2,15 +2,89 @@
 """
 Brain extraction
 
+BET is used by default. For low resolution ASL space images (e.g. the mean ASL
+or calibration image used as the registration reference) a simpler in-process
+method based on intensity thresholding and morphological operations can be
+used instead by passing ``method="numpy"``, which avoids running an external
+command and writing the image to disk.
+
 Copyright (c) 2008-2013 Univerisity of Oxford
 """
 
+import numpy as np
+
 import fsl.wrappers as fsl
+from fsl.data.image import Image
+
+# Supported brain extraction methods
+METHODS = ("bet", "numpy")
+
+def brain(wsp, img, thresh=0.5, method="bet"):
+    """
+    Get brain extracted image
 
-def brain(wsp, img, thresh=0.5):
+    :param img: 3D Image
+    :param thresh: Fractional intensity threshold - smaller values give larger brain estimates
+    :param method: ``bet`` or ``numpy``
+    :return: Brain extracted Image
+    """
+    if method == "numpy":
+        return extract_brain(img, thresh)[0]
+    elif method != "bet":
+        raise ValueError("Unknown brain extraction method: %s" % method)
     bet_result = fsl.bet(img, seg=True, mask=False, fracintensity=thresh, output=fsl.LOAD, log=wsp.fsllog)
     return bet_result["output"]
 
-def mask(wsp, img, thresh):
+def mask(wsp, img, thresh, method="bet"):
+    """
+    Get brain mask
+
+    :param img: 3D Image
+    :param thresh: Fractional intensity threshold - smaller values give larger brain estimates
+    :param method: ``bet`` or ``numpy``
+    :return: Brain mask Image
+    """
+    if method == "numpy":
+        return extract_brain(img, thresh)[1]
+    elif method != "bet":
+        raise ValueError("Unknown brain extraction method: %s" % method)
     bet_result = fsl.bet(img, seg=False, mask=True, fracintensity=thresh, output=fsl.LOAD, log=wsp.fsllog)
     return bet_result["output_mask"]
+
+def extract_brain(img, thresh=0.5):
+    """
+    Brain extraction of low resolution EPI or calibration images using NumPy/SciPy
+
+    Voxels above a threshold within the robust intensity range are selected, as for the
+    initial background threshold used by BET. The largest connected region is taken as
+    the brain, and the mask is smoothed using morphological closing and any holes filled.
+
+    This is not suitable for structural images where the brain is not well separated
+    from the rest of the head by intensity alone.
+
+    :param img: 3D Image
+    :param thresh: Fractional intensity threshold between 0 and 1. The intensity threshold
+                   varies from 5% to 15% of the robust intensity range, with the default of
+                   0.5 giving 10% as for the BET background threshold
+    :return: Tuple of brain extracted Image, brain mask Image
+    """
+    import scipy.ndimage
+    data = img.data
+    if data.ndim != 3:
+        raise ValueError("Brain extraction requires a 3D image")
+
+    lower, upper = np.percentile(data, (2, 98))
+    mask = data > lower + (0.05 + 0.1 * thresh) * (upper - lower)
+
+    labels, nregions = scipy.ndimage.label(mask)
+    if nregions > 1:
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        mask = labels == np.argmax(sizes)
+
+    # Pad before closing so regions touching the edge of the image are not eroded
+    structure = scipy.ndimage.generate_binary_structure(3, 1)
+    mask = scipy.ndimage.binary_closing(np.pad(mask, 1, mode="constant"), structure=structure)[1:-1, 1:-1, 1:-1]
+    mask = scipy.ndimage.binary_fill_holes(mask).astype(np.int32)
+
+    return Image(data * mask, header=img.header), Image(mask, header=img.header)
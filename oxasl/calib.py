@@ -13,10 +13,8 @@ import math
 import traceback
 
 import numpy as np
-import scipy.ndimage
 
 from fsl.data.image import Image
-from fsl.data.atlases import AtlasRegistry
 
 from oxasl import Workspace, struc, reg
 from oxasl.image import summary
@@ -149,7 +147,7 @@ def get_m0_voxelwise(wsp):
     wsp.log.write(" - Calibration gain: %f\n" % gain)
 
     # Calculate M0 value
-    m0 = np.copy(wsp.calib.data).astype(np.float) * gain
+    m0 = np.copy(wsp.calib.data).astype(np.float64) * gain
 
     shorttr = 1
     if wsp.tr is not None and wsp.tr < 5:
@@ -205,6 +203,7 @@ def _edge_correct(m0, brain_mask):
     """
     Correct for (partial volume) edge effects
     """
+    import scipy.ndimage
     brain_mask = brain_mask.data
 
     # Median smoothing
@@ -260,6 +259,11 @@ def get_m0_wholebrain(wsp):
       - ``calib``     - Calibration Image in ASL native space
       - ``rois.mask`` - Brain mask Image in ASL native space
       - ``struc``     - Structural image
+
+    Optional Workspace attributes
+    -----------------------------
+
+      - ``save_tissue_m0`` - If True, save the M0 map for each tissue type
     """
     struc.segment(wsp)
     wsp.log.write("\n - Doing wholebrain region calibration\n")
@@ -289,22 +293,28 @@ def get_m0_wholebrain(wsp):
         wsp.log.write(" - Using sensitivity image: %s\n" % wsp.sens.name)
         calib_data /= wsp.sens.data
     
-    m0 = np.zeros(calib_data.shape, dtype=np.float)
-    for tiss_type in ("wm", "gm", "csf"):
-        pve_struc = getattr(wsp.structural, "%s_pv" % tiss_type)
-        wsp.log.write(" - Transforming %s tissue PVE into ASL space\n" % tiss_type)
-        pve = reg.struc2asl(wsp, pve_struc)
+    # Transform all tissue PVEs into ASL space in a single resampling step
+    tissues = ("wm", "gm", "csf")
+    wsp.log.write(" - Transforming %s tissue PVEs into ASL space\n" % "/".join(tissues))
+    pve_struc = [getattr(wsp.structural, "%s_pv" % tiss_type) for tiss_type in tissues]
+    pve_struc = Image(np.stack([pve.data for pve in pve_struc], axis=-1), header=pve_struc[0].header)
+    pves = reg.struc2asl(wsp, pve_struc).data
+
+    corr = np.zeros(len(tissues), dtype=np.float32)
+    for idx, tiss_type in enumerate(tissues):
         t1r, t2r, t2rstar, pcr = tissue_defaults(tiss_type)
         if t2star:
             t2r = t2rstar
         t1_corr = 1 / (1 - math.exp(- (tr - taq) / t1r))
         t2_corr = 1 / math.exp(- te / t2r)
         wsp.log.write("Correction factors: T1: %f, T2 %f, PC: %f" % (t1_corr, t2_corr, pcr))
-        tiss_m0 = calib_data * t1_corr * t2_corr / pcr
-        wsp.log.write(" - Mean %s M0: %f (weighted by PV)\n" % (tiss_type, np.average(tiss_m0, weights=pve.data)))
-        tiss_m0 *= pve.data
-        setattr(wsp.calibration, "m0_img_%s" % tiss_type, Image(tiss_m0, header=wsp.calib.header))
-        m0 += tiss_m0
+        corr[idx] = t1_corr * t2_corr / pcr
+
+    m0, tiss_means = tissue_m0(calib_data, pves, corr)
+    for idx, tiss_type in enumerate(tissues):
+        wsp.log.write(" - Mean %s M0: %f (weighted by PV)\n" % (tiss_type, tiss_means[idx]))
+        if wsp.save_tissue_m0:
+            setattr(wsp.calibration, "m0_img_%s" % tiss_type, Image(calib_data * pves[..., idx] * corr[idx], header=wsp.calib.header))
 
     m0 = m0 * math.exp(- te / t2b)
     gain = wsp.ifnone("calib_gain", 1)
@@ -330,6 +340,26 @@ def get_m0_wholebrain(wsp):
 
     return float(m0)
 
+def tissue_m0(calib_data, pves, corr):
+    """
+    Combine tissue-specific M0 estimates weighted by partial volume
+
+    :param calib_data: 3D Numpy array of calibration data
+    :param pves: 4D Numpy array of tissue partial volumes in the same space
+                 as ``calib_data``, one volume per tissue type
+    :param corr: Sequence of correction factors for each tissue type which
+                 convert calibration signal into M0
+    :return: Tuple of (3D Numpy array of PV-weighted M0, sequence of PV-weighted
+             mean M0 for each tissue type)
+    """
+    corr = np.asarray(corr, dtype=np.float32)
+    pves = pves.reshape(-1, pves.shape[-1])
+    calib_flat = calib_data.reshape(-1)
+    m0 = (calib_flat * pves.dot(corr)).reshape(calib_data.shape)
+    pv_sums = np.sum(pves, axis=0)
+    tiss_means = calib_flat.dot(pves) * corr / np.where(pv_sums > 0, pv_sums, 1)
+    return m0, tiss_means
+
 def get_m0_refregion(wsp, mode="longtr"):
     """
     Do reference region calibration
@@ -423,11 +453,9 @@ def get_m0_refregion(wsp, mode="longtr"):
     wsp.log.write(" - T1r: %f; T2r: %f; T2b: %f; Part co-eff: %f\n" % (t1r, t2r, t2b, pcr))
 
     # Check the data and masks
-    calib_data = np.copy(wsp.calib.data).astype(np.float)
     wsp.calibration.calib_img = wsp.calib
-    if calib_data.ndim == 4:
+    if wsp.calib.ndim == 4:
         wsp.log.write(" - Taking mean across calibration images\n")
-        calib_data = np.mean(calib_data, -1)
 
     if wsp.rois is not None and wsp.rois.mask is not None:
         brain_mask = wsp.rois.mask.data
@@ -436,14 +464,17 @@ def get_m0_refregion(wsp, mode="longtr"):
 
     if wsp.refmask is not None:
         wsp.log.write(" - Using supplied reference tissue mask: %s\n" % wsp.refmask.name)
-        wsp.calibration.refmask = Image(wsp.refmask.data.astype(np.int), header=wsp.refmask.header)
+        wsp.calibration.refmask = Image(wsp.refmask.data.astype(np.int32), header=wsp.refmask.header)
         wsp.calibration.refmask_trans = reg.calib2asl(wsp, wsp.calibration.refmask, mask=True)
         refmask = wsp.calibration.refmask_trans.data
     elif wsp.tissref.lower() in ("csf", "wm", "gm"):
         get_tissrefmask(wsp)
         refmask = wsp.calibration.refmask.data
-        
-    nonzero = np.count_nonzero(refmask)
+
+    # The reference region is represented as a list of voxel indices so that only
+    # the reference voxels of the calibration, sensitivity and T1/T2 images are read
+    refvoxels = refregion_voxels(refmask)
+    nonzero = len(refvoxels[0])
     if nonzero < 1:
         raise ValueError("Reference mask does not contain any unmasked voxels")
     else:
@@ -454,31 +485,32 @@ def get_m0_refregion(wsp, mode="longtr"):
     if wsp.sens:
         wsp.log.write(" - Using sensitivity image: %s\n" % wsp.sens.name)
         sens_corr = True
-        sens_data = wsp.sens.data
     
     wsp.log.write(" - MODE: %s\n" % mode)
     wsp.log.write(" - Calibration gain: %f\n" % gain)
  
     if mode == "longtr":
+        # Calibration signal within the tissue reference mask only
+        ref_calib = wsp.calib.data[refvoxels].astype(np.float64)
+        if ref_calib.ndim == 2:
+            ref_calib = np.mean(ref_calib, -1)
+
         if sens_corr:
             wsp.log.write(" - Applying sensitivity image\n")
-            calib_data /= sens_data
-        
-        # Mask M0 map with tissue reference
-        calib_data[refmask == 0] = 0
+            ref_calib /= wsp.sens.data[refvoxels]
         
         # calcualte T1 of reference region (if a T1 image has been supplied)
         if t1r_img:
-            t1r = np.mean(t1r.data[refmask != 0])
+            t1r = np.mean(t1r.data[refvoxels])
             wsp.log.write(" - Calculated T1 of reference tissue: %f\n" % t1r)
 
         # calcualte T2 of reference region (if a T2 image has been supplied)
         if t2r_img:
-            t2r = np.mean(t2r.data[refmask != 0])
+            t2r = np.mean(t2r.data[refvoxels])
             wsp.log.write(" - Calculated T2 of reference tissue: %f\n" % t2r)
 
         # calculate M0_ref value
-        mean_sig = np.mean(calib_data[refmask != 0])
+        mean_sig = np.mean(ref_calib)
         wsp.log.write(" - mean signal in reference tissue: %f\n" % mean_sig)
         t1_corr = 1 / (1 - math.exp(- (tr - taq) / t1r))
         wsp.log.write(" - T1 correction factor: %f\n" % t1_corr)
@@ -521,7 +553,7 @@ def get_m0_refregion(wsp, mode="longtr"):
         mean_m0 = fabber_result["mean_M0t"]
         
         # Calculate M0 value - this is mean M0 of CSF at the TE of the sequence
-        m0_value = np.mean(mean_m0.data[refmask != 0])
+        m0_value = np.mean(mean_m0.data[refvoxels])
 
         wsp.log.write(" - M0 of reference tissue: %f\n" % m0_value)
 
@@ -573,7 +605,7 @@ def get_m0_refregion(wsp, mode="longtr"):
         ["T1 reference tissue (s)", t1r],
         ["T2 reference tissue (ms)", t2r],
         ["Blood T2 (ms)", t2b],
-        ["Number of voxels in reference region", np.count_nonzero(refmask)],
+        ["Number of voxels in reference region", nonzero],
         ["Mean signal in reference region", mean_sig],
         ["T1 correction factor", t1_corr],
         ["T2 correction factor", t2_corr],
@@ -586,6 +618,16 @@ def get_m0_refregion(wsp, mode="longtr"):
 
     return float(m0)
 
+def refregion_voxels(refmask):
+    """
+    Get the voxels in a reference region mask
+
+    :param refmask: 3D Numpy array containing reference region mask
+    :return: Tuple of index arrays which can be used to index the reference
+             region voxels of any image with the same 3D shape
+    """
+    return np.unravel_index(np.flatnonzero(refmask), refmask.shape)
+
 def get_tissrefmask(wsp):
     """
     Calculate a calibration reference mask for a particular known tissue type
@@ -608,11 +650,13 @@ def get_tissrefmask(wsp):
         # Select ventricles based on standard space atlas
         page.heading("Automatic ventricle selection", level=1)
         page.text("Standard space ventricles mask (from Harvard-Oxford atlas) eroded by 1 pixel")
+        import scipy.ndimage
+        from fsl.data.atlases import AtlasRegistry
         atlases = AtlasRegistry()
         atlases.rescanAtlases()
         atlas = atlases.loadAtlas("harvardoxford-subcortical", loadSummary=False, resolution=2)
-        ventricles = ((atlas.data[..., 2] + atlas.data[..., 13]) > 0.1).astype(np.int)
-        wsp.calibration.ventricles = Image(scipy.ndimage.binary_erosion(ventricles, structure=np.ones([3, 3, 3]), border_value=1).astype(np.int), header=atlas.header)
+        ventricles = ((atlas.data[..., 2] + atlas.data[..., 13]) > 0.1).astype(np.int32)
+        wsp.calibration.ventricles = Image(scipy.ndimage.binary_erosion(ventricles, structure=np.ones([3, 3, 3]), border_value=1).astype(np.int32), header=atlas.header)
         std_img = Image(os.path.join(os.environ["FSLDIR"], "data", "standard", 'MNI152_T1_2mm_brain'))
         page.image("ventricles_std", LightboxImage(wsp.calibration.ventricles, bgimage=std_img))
 
@@ -644,7 +688,7 @@ def get_tissrefmask(wsp):
 
     # Threshold reference mask conservatively to select only reference tissue
     wsp.log.write(" - Thresholding reference mask\n")
-    wsp.calibration.refmask = Image((wsp.calibration.refpve_calib.data > 0.9).astype(np.int), header=wsp.calibration.refpve_calib.header)
+    wsp.calibration.refmask = Image((wsp.calibration.refpve_calib.data > 0.9).astype(np.int32), header=wsp.calibration.refpve_calib.header)
 
     page.text("Reference Mask (thresholded at 0.9")
     page.image("refmask", LightboxImage(wsp.calibration.refmask, bgimage=wsp.calib))
@@ -693,6 +737,10 @@ class CalibOptions(OptionCategory):
         group.add_option("--tr", help="TR used in calibration sequence (s)", type=float, default=3.2)
         groups.append(group)
 
+        group = IgnorableOptionGroup(parser, "Whole-brain calibration", ignore=self.ignore)
+        group.add_option("--save-tissue-m0", help="Save M0 map for each tissue type", action="store_true", default=False)
+        groups.append(group)
+
         group = IgnorableOptionGroup(parser, "Voxelwise calibration", ignore=self.ignore)
         group.add_option("--pct", help="Tissue/arterial partition coefficiant", type=float, default=0.9)
         group.add_option("--t1t", help="T1 of tissue (s)", type=float, default=1.3)
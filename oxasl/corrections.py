@@ -20,15 +20,18 @@ Currently four sources of transformation exist:
 
  - User-supplied nonlinear warp image for gradient distortion corection
 
-Except for the TOPUP correction, all of the above can be combined in a single
-transformation to minimise interpolation of the ASL data
+All of the above can be combined in a single transformation to minimise interpolation
+of the ASL data. By default the TOPUP correction is applied separately using ``applytopup``,
+however it can be converted to a warp in ASL space and included in the combined
+transformation by setting ``topup_combined``
 
 Copyright (c) 2008-2013 Univerisity of Oxford
 """
 from __future__ import unicode_literals
 
-import tempfile
-import shutil
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -38,7 +41,13 @@ from fsl.data.image import Image
 from oxasl import reg, struc
 from oxasl.options import OptionCategory, IgnorableOptionGroup
 from oxasl.reporting import LightboxImage, LineGraph
-from oxasl.wrappers import epi_reg, fnirtfileutils
+from oxasl.epi_reg import epi_reg
+from oxasl.wrappers import fnirtfileutils
+from oxasl.workspace import matrix_to_text
+
+# If in-process motion correction is enabled, multi-volume calibration images
+# with up to this many volumes are motion corrected without using MCFLIRT
+INPROCESS_MOCO_MAX_VOLS = 8
 
 class DistcorrOptions(OptionCategory):
     """
@@ -59,6 +68,7 @@ class DistcorrOptions(OptionCategory):
 
         g = IgnorableOptionGroup(parser, "Distortion correction using phase-encode-reversed calibration image (TOPUP)")
         g.add_option("--cblip", help="phase-encode-reversed (blipped) calibration image", type="image")
+        g.add_option("--topup-combined", help="Combine TOPUP distortion correction with motion correction and other warps so the ASL data is only resampled once", action="store_true", default=False)
         ret.append(g)
 
         g = IgnorableOptionGroup(parser, "General distortion correction options")
@@ -67,6 +77,12 @@ class DistcorrOptions(OptionCategory):
         g.add_option("--gdcwarp", help="Additional warp image for gradient distortion correction - will be combined with fieldmap or TOPUP distortion correction", type="image")
         ret.append(g)
 
+        g = IgnorableOptionGroup(parser, "Outlier rejection")
+        g.add_option("--outlier-rejection", help="Remove outlying label/control pairs before modelling", action="store_true", default=False)
+        g.add_option("--outlier-z", help="Signal Z-score threshold for outlier rejection", type=float, default=3.0)
+        g.add_option("--outlier-fd", help="Framewise displacement threshold for outlier rejection (mm)", type=float, default=0.5)
+        ret.append(g)
+
         g = IgnorableOptionGroup(parser, "Sensitivity correction")
         g.add_option("--cref", help="Reference image for sensitivity correction", type="image")
         g.add_option("--cact", help="Image from coil used for actual ASL acquisition (default: calibration image - only in longtr mode)", type="image")
@@ -85,11 +101,24 @@ def single_volume(wsp, img, moco=True, discard_first=True):
     """
     Convert a potentially 4D image into a single 3D volume
 
+    Results are cached in the ``corrected`` workspace so each image is only
+    processed once. Motion correction uses MCFLIRT unless ``wsp.inprocess_moco`` is
+    set, in which case series with up to ``INPROCESS_MOCO_MAX_VOLS`` volumes are
+    motion corrected in-process using ``reg.motion_correct``
+
     :param moco: If True, perform basic motion correction
     :param discard_first: If True, discard first volume if nvols > 1
 
     """
     if img is not None:
+        if wsp.corrected is None:
+            wsp.sub("corrected")
+        cache = wsp.corrected.ifnone("_single_volume_cache", {})
+        key = (id(img), moco, discard_first)
+        if key in cache and cache[key][0] is img:
+            return cache[key][1]
+
+        orig_img = img
         wsp.log.write(" - Pre-processing image: %s\n" % img.name)
         if img.ndim == 4:
             if discard_first and img.shape[3] > 1:
@@ -99,11 +128,16 @@ def single_volume(wsp, img, moco=True, discard_first=True):
             if moco and img.shape[3] > 1:
                 if moco:
                     wsp.log.write("   - Motion correcting\n")
-                    img = fsl.mcflirt(img, out=fsl.LOAD, log=wsp.fsllog)["out"]
+                    if wsp.inprocess_moco and img.shape[3] <= INPROCESS_MOCO_MAX_VOLS:
+                        img = reg.motion_correct(img)[0]
+                    else:
+                        img = fsl.mcflirt(img, out=fsl.LOAD, log=wsp.fsllog)["out"]
     
             wsp.log.write("   - Taking mean across time axis\n")
             img = Image(np.mean(img.data, axis=-1), header=img.header)
 
+        cache[key] = (orig_img, img)
+        wsp.corrected.set_item("_single_volume_cache", cache, save=False)
         return img
     else:
         return None
@@ -151,7 +185,7 @@ def get_cblip_correction(wsp):
         "y"  : 1, "-y" : 1,
         "z"  : 2, "-z" : 2,
     }
-    my_topup_params = np.array(topup_params[wsp.pedir], dtype=np.float)
+    my_topup_params = np.array(topup_params[wsp.pedir], dtype=np.float64)
     dimsize = wsp.asldata.shape[dim_idx[wsp.pedir]]
     my_topup_params[:, 3] = wsp.echospacing * (dimsize - 1)
     wsp.topup.params = my_topup_params
@@ -159,7 +193,10 @@ def get_cblip_correction(wsp):
     # Run TOPUP to calculate correction
     wsp.topup.calib_blipped = Image(np.stack((wsp.calib.data, wsp.cblip.data), axis=-1), header=wsp.calib.header)
     topup_result = fsl.topup(imain=wsp.topup.calib_blipped, datain=wsp.topup.params, config="b02b0.cnf", out=fsl.LOAD, iout=fsl.LOAD, fout=fsl.LOAD, log=wsp.fsllog)
-    wsp.topup.fieldcoef, wsp.topup.movpar = topup_result["out_fieldcoef"], topup_result["out_movpar"]
+    # Field coefficients and movement parameters are saved with the names expected
+    # by applytopup so the sub-workspace can be used directly as the TOPUP output
+    wsp.topup.set_item("fieldcoef", topup_result["out_fieldcoef"], save_name="topup_fieldcoef")
+    wsp.topup.set_item("movpar", topup_result["out_movpar"], save_name="topup_movpar.txt", save_fn=matrix_to_text)
     wsp.topup.iout = topup_result["iout"]
     wsp.topup.fout = topup_result["fout"]
 
@@ -210,20 +247,7 @@ def get_fieldmap_correction(wsp):
     wsp.sub("fieldmap")
     wsp.log.write("\nCalculating distortion correction from fieldmap images using EPI_REG\n")
 
-    epi_reg_opts = {
-        "inweight" : wsp.inweight,
-        "init" : wsp.reg.asl2struc,
-        "fmap" : wsp.fmap,
-        "fmapmag" : wsp.fmapmag,
-        "fmapmagbrain" : wsp.fmapmagbrain,
-        "pedir" : wsp.pedir,
-        "echospacing" : wsp.echospacing,
-        "nofmapreg" : wsp.ifnone("nofmapreg", False),
-    }
-    
-    result = epi_reg(epi=wsp.asldata.perf_weighted(), t1=wsp.structural.struc, t1brain=wsp.structural.brain, out=fsl.LOAD, wmseg=wsp.structural.wm_seg, log=wsp.fsllog, **epi_reg_opts)
-    wsp.fieldmap.warp_struc = result["out_warp"]
-    wsp.fieldmap.asl2struc = result["out"]
+    _, wsp.fieldmap.asl2struc, wsp.fieldmap.warp_struc = epi_reg(wsp, wsp.asldata.perf_weighted(), use_fmap=True)
     wsp.fieldmap.struc2asl = np.linalg.inv(wsp.fieldmap.asl2struc)
 
     result = fsl.convertwarp(out=fsl.LOAD, ref=wsp.nativeref, warp1=wsp.fieldmap.warp_struc, postmat=wsp.fieldmap.struc2asl, rel=True, log=wsp.fsllog)
@@ -318,11 +342,13 @@ def get_motion_correction(wsp):
     page.heading("Reference volume", level=1)
     page.text(ref_source)
     page.heading("Motion parameters", level=1)
-    moco_params = [reg.get_motion_params(mat) for mat in mats]
-    trans = [p[0] for p in moco_params]
+    trans, rot, _ = reg.get_motion_params(np.array(mats))
     abstrans = np.fabs(trans)
-    rot = [p[1] for p in moco_params]
     absrot = np.fabs(rot)
+    # The centre of the field of view is unaffected by FLIRT's left-right flip
+    ref_img = wsp.input.regfrom if wsp.input.regfrom is not None else wsp.input.asldata
+    centre = (np.array(ref_img.shape[:3]) - 1) * np.array(ref_img.pixdim[:3]) / 2
+    wsp.moco.fd = reg.framewise_displacement(mats, centre=centre)
     page.table([
         ["Mean translation", "%.3g mm" % np.mean(trans)],
         ["Translation std.dev.", "%.3g mm" % np.std(trans)],
@@ -330,9 +356,183 @@ def get_motion_correction(wsp):
         ["Mean rotation", "%.3g \N{DEGREE SIGN}" % np.mean(rot)],
         ["Rotation std.dev.", "%.3g \N{DEGREE SIGN}" % np.std(rot)],
         ["Absolute maximum rotation", "%.3g \N{DEGREE SIGN} (volume %i)" % (np.max(absrot), np.argmax(absrot))],       
+        ["Mean framewise displacement", "%.3g mm" % np.mean(wsp.moco.fd)],
+        ["Maximum framewise displacement", "%.3g mm (volume %i)" % (np.max(wsp.moco.fd), np.argmax(wsp.moco.fd))],
+    ])
+    page.image("moco_trans", LineGraph(list(trans), "Volume number", "Translation (mm)"))
+    page.image("moco_rot", LineGraph(list(rot), "Volume number", "Rotation relative to reference (\N{DEGREE SIGN})"))
+    page.image("moco_fd", LineGraph(list(wsp.moco.fd), "Volume number", "Framewise displacement (mm)"))
+
+def dvars(data, mask=None):
+    """
+    Get DVARS, the RMS change in signal between consecutive volumes
+
+    :param data: 4D Image or Numpy array
+    :param mask: Optional 3D mask Image or Numpy array. If specified only voxels
+                 within the mask are included
+    :return: Array of DVARS values, one for each volume. The first entry is zero
+    """
+    if isinstance(data, Image):
+        data = data.data
+    if mask is not None:
+        if isinstance(mask, Image):
+            mask = mask.data
+        data = data[mask != 0]
+    else:
+        data = data.reshape(-1, data.shape[-1])
+
+    ret = np.zeros(data.shape[-1], dtype=np.float64)
+    if data.shape[-1] > 1 and data.shape[0] > 0:
+        ret[1:] = np.sqrt(np.mean(np.square(np.diff(data.astype(np.float64), axis=-1)), axis=0))
+    return ret
+
+def outlier_pairs(asldata, mask=None, fd=None, z_thresh=3.0, fd_thresh=0.5):
+    """
+    Identify outlying label/control pairs in ASL data
+
+    Each pair is scored by the RMS deviation of its difference image from the median
+    difference image for the same TI/PLD, converted to a robust Z-score using the median
+    absolute deviation across the pairs at that TI/PLD. If framewise displacement is given, each pair
+    is also scored by the maximum displacement of its volumes. At least one pair is
+    always retained for each TI/PLD.
+
+    For already-differenced data each volume is treated as a 'pair'.
+
+    :param asldata: AslImage in TC, CT or differenced format
+    :param mask: Optional 3D mask Image or Numpy array. If not specified all voxels are used
+    :param fd: Optional array of framewise displacement of each volume in acquisition order
+    :param z_thresh: Pairs with a signal Z-score above this value are rejected
+    :param fd_thresh: Pairs with framewise displacement above this value (mm) are rejected
+
+    :return: Tuple of (indices of volumes to keep, in TI/repeat order; list of remaining
+             repeats for each TI/PLD; 2D array with one row per pair containing TI index,
+             signal Z-score, framewise displacement and 1 if the pair was rejected or 0 otherwise)
+    """
+    if asldata.iaf not in ("tc", "ct", "diff"):
+        raise ValueError("Outlier rejection requires label/control pairs or differenced data")
+
+    # Permutation of volumes which groups pairs within each repeat and repeats within each TI
+    label_idx, ti_idx, rpt_idx = asldata.vol_indices()
+    perm = np.lexsort((label_idx, rpt_idx, ti_idx))
+    ntc = asldata.ntc
+    pair_tis = ti_idx[perm][::ntc]
+    npairs = len(pair_tis)
+
+    data = asldata.data
+    if mask is not None:
+        if isinstance(mask, Image):
+            mask = mask.data
+        data = data[mask != 0]
+    else:
+        data = data.reshape(-1, data.shape[-1])
+    pairs = data[:, perm].astype(np.float32).reshape(data.shape[0], npairs, ntc)
+    if ntc == 2:
+        pair_diff = pairs[..., 0] - pairs[..., 1]
+    else:
+        pair_diff = pairs[..., 0]
+
+    # RMS deviation of each pair from the median difference image at the same TI,
+    # converted to a robust Z-score within the TI since the noise level varies with TI
+    zscores = np.zeros(npairs, dtype=np.float64)
+    for ti in range(asldata.ntis):
+        ti_pairs = pair_tis == ti
+        if np.any(ti_pairs):
+            median_diff = np.median(pair_diff[:, ti_pairs], axis=1)
+            deviation = np.sqrt(np.mean(np.square(pair_diff[:, ti_pairs] - median_diff[:, np.newaxis]), axis=0))
+            mad = 1.4826 * np.median(np.fabs(deviation - np.median(deviation)))
+            if mad > 0:
+                zscores[ti_pairs] = (deviation - np.median(deviation)) / mad
+    reject = zscores > z_thresh
+
+    pair_fd = np.zeros(npairs, dtype=np.float64)
+    if fd is not None:
+        pair_fd = np.max(np.asarray(fd)[perm].reshape(npairs, ntc), axis=1)
+        reject |= pair_fd > fd_thresh
+
+    # Always keep the best pair at each TI
+    for ti in range(asldata.ntis):
+        ti_pairs = np.flatnonzero(pair_tis == ti)
+        if len(ti_pairs) > 0 and np.all(reject[ti_pairs]):
+            reject[ti_pairs[np.argmin(zscores[ti_pairs])]] = False
+
+    keep_vols = perm.reshape(npairs, ntc)[~reject].flatten()
+    rpts = [int(rpt) for rpt in np.bincount(pair_tis[~reject], minlength=asldata.ntis)]
+    scores = np.column_stack([pair_tis, zscores, pair_fd, reject]).astype(np.float64)
+    return keep_vols, rpts, scores
+
+def get_outlier_rejection(wsp):
+    """
+    Identify outlying label/control pairs to be removed from the ASL data
+
+    This should be run after motion correction has been applied. The outlying
+    pairs are removed by ``apply_corrections``
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``asldata`` : ASL data image
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``outlier_rejection`` : If True, do outlier rejection
+     - ``outlier_z``         : Signal Z-score threshold (default 3)
+     - ``outlier_fd``        : Framewise displacement threshold in mm (default 0.5)
+     - ``moco.fd``           : Framewise displacement from motion correction
+     - ``rois.mask``         : Brain mask. If not specified, voxels with mean signal above
+                               10% of the robust maximum are used
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``outliers.keep_vols`` : Indices of volumes to keep
+     - ``outliers.rpts``      : Number of remaining repeats at each TI/PLD
+     - ``outliers.scores``    : Outlier scores for each pair - see ``outlier_pairs``
+     - ``outliers.dvars``     : DVARS of the motion corrected data in acquisition order
+    """
+    if wsp.outliers is not None or not wsp.outlier_rejection:
+        return
+
+    wsp.log.write("\nIdentifying outlying label/control pairs\n")
+    asldata = wsp.corrected.asldata
+    if asldata.iaf not in ("tc", "ct", "diff"):
+        wsp.log.write(" - Not supported for data format: %s\n" % asldata.iaf)
+        return
+
+    if wsp.rois is not None and wsp.rois.mask is not None:
+        mask = wsp.rois.mask.data
+    else:
+        mean_data = asldata.mean().data
+        mask = mean_data > 0.1 * np.percentile(mean_data, 98)
+
+    z_thresh = wsp.ifnone("outlier_z", 3.0)
+    fd_thresh = wsp.ifnone("outlier_fd", 0.5)
+    fd = wsp.moco.fd if wsp.moco is not None else None
+    try:
+        keep_vols, rpts, scores = outlier_pairs(asldata, mask, fd, z_thresh, fd_thresh)
+    except ValueError as exc:
+        wsp.log.write(" - Not supported for this data: %s\n" % str(exc))
+        return
+
+    wsp.sub("outliers")
+    wsp.outliers.keep_vols = keep_vols
+    wsp.outliers.rpts = rpts
+    wsp.outliers.scores = scores
+    wsp.outliers.dvars = dvars(asldata, mask)
+    nrejected = int(np.sum(scores[:, 3]))
+    wsp.log.write(" - Rejected %i of %i pairs (Z > %.2f or FD > %.2f mm)\n" % (nrejected, len(scores), z_thresh, fd_thresh))
+    wsp.log.write(" - Remaining repeats: %s\n" % str(rpts))
+
+    page = wsp.report.page("outliers")
+    page.heading("Outlier rejection", level=0)
+    page.table([
+        ["Signal Z-score threshold", "%.3g" % z_thresh],
+        ["Framewise displacement threshold", "%.3g mm" % fd_thresh],
+        ["Pairs rejected", "%i / %i" % (nrejected, len(scores))],
+        ["Remaining repeats", str(rpts)],
     ])
-    page.image("moco_trans", LineGraph(trans, "Volume number", "Translation (mm)"))
-    page.image("moco_rot", LineGraph(rot, "Volume number", "Rotation relative to reference (\N{DEGREE SIGN})"))
+    page.image("outlier_z", LineGraph(list(scores[:, 1]), "Pair number (grouped by TI)", "Signal Z-score"))
+    page.image("outlier_dvars", LineGraph(list(wsp.outliers.dvars), "Volume number", "DVARS"))
 
 def get_sensitivity_correction(wsp):
     """
@@ -373,14 +573,14 @@ def get_sensitivity_correction(wsp):
         wsp.log.write(" - Sensitivity image calculated from calibration actual and reference images\n")
         cref_data = np.copy(wsp.cref.data)
         cref_data[cref_data == 0] = 1
-        sensitivity = Image(wsp.cact.data.astype(np.float) / cref_data, header=wsp.calib.header)
+        sensitivity = Image(wsp.cact.data.astype(np.float64) / cref_data, header=wsp.calib.header)
     elif wsp.calib is not None and wsp.cref is not None:
         if wsp.ifnone("mode", "longtr") != "longtr":
             raise ValueError("Calibration reference image specified but calibration image was not in longtr mode - need to provided additional calibration image using the ASL coil")
         wsp.log.write(" - Sensitivity image calculated from calibration and reference images\n")
         cref_data = np.copy(wsp.cref.data)
         cref_data[cref_data == 0] = 1
-        sensitivity = Image(wsp.calib.data.astype(np.float) / cref_data, header=wsp.calib.header)
+        sensitivity = Image(wsp.calib.data.astype(np.float64) / cref_data, header=wsp.calib.header)
     elif wsp.senscorr_auto and wsp.structural.bias is not None:
         struc.segment(wsp)
         wsp.log.write(" - Sensitivity image calculated from bias field\n")
@@ -424,6 +624,7 @@ def apply_corrections(wsp):
      - ``calib2asl``       : Calibration -> ASL transformation matrix
      - ``distcorr_warp``   : Distortion correction warp image
      - ``gdc_warp``        : Gradient distortion correction warp image
+     - ``topup_combined``  : If True, include TOPUP distortion correction in the combined transformation
 
     Updated workspace attributes
     ----------------------------
@@ -453,6 +654,13 @@ def apply_corrections(wsp):
         wsp.log.write("   - Using fieldmap distortion correction\n")
         warps.append(wsp.fieldmap.warp)
     
+    topup_combined = wsp.topup is not None and wsp.ifnone("topup_combined", False)
+    if topup_combined:
+        wsp.log.write("   - Using TOPUP distortion correction combined with other transformations\n")
+        wsp.topup.warp = topup_warp(wsp)
+        topup_idx = len(warps)
+        warps.append(wsp.topup.warp)
+
     if wsp.gdc_warp:
         wsp.log.write("   - Using user-supplied GDC warp\n")
         warps.append(wsp.gdc_warp)
@@ -461,20 +669,9 @@ def apply_corrections(wsp):
         moco_mats = wsp.moco.mc_mats
 
     if warps:
-        kwargs = {}
-        for idx, warp in enumerate(warps):
-            kwargs["warp%i" % (idx+1)] = warp
-                
         wsp.log.write("   - Converting all warps to single transform and extracting Jacobian\n")
-        result = fsl.convertwarp(ref=wsp.nativeref, out=fsl.LOAD, rel=True, jacobian=fsl.LOAD, log=wsp.fsllog, **kwargs)
-        wsp.corrected.total_warp = result["out"]
-
-        # Calculation of the jacobian for the warp - method suggested in:
-        # https://www.jiscmail.ac.uk/cgi-bin/webadmin?A2=FSL;d3fee1e5.0908
-        wsp.corrected.warp_coef = fnirtfileutils(wsp.corrected.total_warp, outformat="spline", out=fsl.LOAD, log=wsp.fsllog)["out"]
-        jacobian = fnirtfileutils(wsp.corrected.warp_coef, jac=fsl.LOAD, log=wsp.fsllog)["jac"]
-        wsp.corrected.jacobian = Image(jacobian.data, header=wsp.corrected.total_warp.header)
-        
+        wsp.corrected.total_warp, wsp.corrected.warp_coef, wsp.corrected.jacobian = combine_warps(wsp, warps)
+
     if not warps and moco_mats is None:
         wsp.log.write("   - No corrections to apply\n")
     else:
@@ -490,33 +687,25 @@ def apply_corrections(wsp):
         
             if wsp.cref is not None:
                 wsp.corrected.cref = correct_img(wsp, wsp.corrected.cref, wsp.reg.calib2asl)
-            if wsp.cblip is not None:
+            if wsp.cblip is not None and topup_combined:
+                # The phase-encode-reversed image is distorted in the opposite direction
+                # so requires its own combined warp
+                wsp.topup.warp_blip = topup_warp(wsp, index=2)
+                blip_warps = list(warps)
+                blip_warps[topup_idx] = wsp.topup.warp_blip
+                blip_warp, _, blip_jacobian = combine_warps(wsp, blip_warps)
+                wsp.corrected.cblip = correct_img(wsp, wsp.corrected.cblip, wsp.reg.calib2asl, blip_warp, blip_jacobian)
+            elif wsp.cblip is not None:
                 wsp.corrected.cblip = correct_img(wsp, wsp.corrected.cblip, wsp.reg.calib2asl)
 
-    if wsp.topup is not None:
-        wsp.log.write(" - Adding TOPUP distortion correction\n")
-        # This can't currently be done using the FSL wrappers - we need the TOPUP output as two prefixed files
-        # Only workaround currently is to create a temp directory to store appropriately named input files
-        topup_input = tempfile.mkdtemp(prefix="topup_input")
-        try:
-            wsp.topup.fieldcoef.save("%s/topup_fieldcoef" % topup_input)
-            movpar_file = open("%s/topup_movpar.txt" % topup_input, "w")
-            for row in wsp.topup.movpar:
-                movpar_file.write("\t".join([str(val) for val in row]) + "\n")
-            movpar_file.close()
-            # TOPUP does not do the jacboian magntiude correction - so only okay if using voxelwise calibration
-            wsp.corrected.calib = fsl.applytopup(wsp.corrected.calib, datain=wsp.topup.params, index=1, topup="%s/topup" % topup_input, out=fsl.LOAD, method="jac", log=wsp.fsllog)["out"]
-            wsp.corrected.cblip = fsl.applytopup(wsp.corrected.cblip, datain=wsp.topup.params, index=2, topup="%s/topup" % topup_input, out=fsl.LOAD, method="jac", log=wsp.fsllog)["out"]
-            if wsp.cref:
-                wsp.corrected.cref = fsl.applytopup(wsp.corrected.cref, datain=wsp.topup.params, index=1, topup="%s/topup" % topup_input, out=fsl.LOAD, method="jac", log=wsp.fsllog)["out"]
-            post_topup = fsl.applytopup(wsp.corrected.asldata, datain=wsp.topup.params, index=1, topup="%s/topup" % topup_input, out=fsl.LOAD, method="jac", log=wsp.fsllog)["out"]
-            wsp.corrected.asldata = wsp.corrected.asldata.derived(post_topup.data)
-            #if wsp.calib_method != "voxel":
-            #    wsp.log.write("WARNING: Using TOPUP does not correct for magntiude using the jocbian in distortion correction")
-            #    wsp.log.write("         This is not optimal when not using voxelwise calibration\n")
-            #    wsp.log.write("         To avoid this supply structural image(s)\n")
-        finally:
-            shutil.rmtree(topup_input)
+    if wsp.topup is not None and not topup_combined:
+        apply_topup(wsp)
+
+    if wsp.outliers is not None:
+        wsp.log.write(" - Removing outlying label/control pairs\n")
+        order = "lrt" if wsp.corrected.asldata.iaf != "diff" else "rt"
+        wsp.corrected.asldata = wsp.corrected.asldata.derived(wsp.corrected.asldata.data[..., wsp.outliers.keep_vols],
+                                                              order=order, rpts=wsp.outliers.rpts)
 
     if wsp.senscorr and wsp.corrected.calib:
         # Apply sensitivity correction to calibration image only. In principle we could
@@ -525,12 +714,141 @@ def apply_corrections(wsp):
         # correction cancels out of the calibrated outputs when using voxelwise calibration
         wsp.corrected.calib, = apply_sensitivity_correction(wsp, wsp.corrected.calib)
 
-def correct_img(wsp, img, linear_mat):
+def apply_topup(wsp):
+    """
+    Apply TOPUP distortion correction to the ASL and calibration data
+
+    The calibration images are corrected using a single call to applytopup for
+    each acquisition parameter index by stacking them into a 4D image. The ASL
+    data is divided into blocks of volumes which are corrected concurrently.
+    Note that TOPUP does not do the Jacobian magnitude correction so this is only
+    okay if using voxelwise calibration
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``topup`` : Sub-workspace containing TOPUP output (generated by get_cblip_correction)
+     - ``corrected`` : Sub-workspace containing ``asldata`` and calibration images to be corrected
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``topup_threads`` : Maximum number of ASL data blocks to correct concurrently. Defaults
+                           to the number of CPUs divided by the number of concurrent processing
+                           steps (``nthreads``)
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``corrected.asldata``  : Corrected ASL data
+     - ``corrected.calib``    : Corrected calibration image
+     - ``corrected.cref``     : Corrected calibration reference image
+     - ``corrected.cblip``    : Corrected phase-encode-reversed calibration image
+    """
+    wsp.log.write(" - Adding TOPUP distortion correction\n")
+    topup_prefix = os.path.join(wsp.topup.savedir, "topup")
+
+    def _applytopup(data, header, index):
+        # Trailing single volume axis may be lost when the output is loaded
+        return fsl.applytopup(Image(data, header=header), datain=wsp.topup.params, index=index, topup=topup_prefix,
+                              out=fsl.LOAD, method="jac", log=wsp.fsllog)["out"].data.reshape(data.shape)
+
+    # Calibration images acquired with the same phase encoding as the ASL data use
+    # index 1 of the TOPUP parameters, the phase-encode-reversed image uses index 2
+    for index, names in ((1, ("calib", "cref")), (2, ("cblip",))):
+        names = [name for name in names if getattr(wsp.corrected, name) is not None]
+        if names:
+            header = getattr(wsp.corrected, names[0]).header
+            stacked = np.stack([getattr(wsp.corrected, name).data for name in names], axis=-1)
+            corrected = _applytopup(stacked, header, index)
+            for idx, name in enumerate(names):
+                setattr(wsp.corrected, name, Image(corrected[..., idx], header=header))
+
+    asldata = wsp.corrected.asldata
+    # Concurrent steps may also be correcting data, so share the CPUs between them
+    nthreads = wsp.ifnone("topup_threads", max(1, multiprocessing.cpu_count() // wsp.ifnone("nthreads", 1)))
+    nblocks = max(1, min(nthreads, asldata.nvols))
+    blocks = np.array_split(asldata.data.reshape(asldata.shape[:3] + (asldata.nvols,)), nblocks, axis=-1)
+    if nblocks == 1:
+        corrected = [_applytopup(blocks[0], asldata.header, 1)]
+    else:
+        pool = ThreadPool(nblocks)
+        try:
+            corrected = pool.map(lambda block: _applytopup(block, asldata.header, 1), blocks)
+        finally:
+            pool.close()
+    wsp.corrected.asldata = asldata.derived(np.concatenate(corrected, axis=-1))
+
+def topup_warp(wsp, index=1):
+    """
+    Get the TOPUP distortion correction as a relative warp in ASL space
+
+    The TOPUP field map (in Hz) is transformed to ASL space and converted to a
+    displacement along the phase encoding direction using the total readout time
+    for the selected acquisition parameters. This enables the distortion correction
+    to be combined with motion correction and other warps so the data only needs
+    to be resampled once.
+
+    :param index: Index of the TOPUP acquisition parameters for the image to be
+                  corrected, i.e. 1 for images with the same phase encoding as the
+                  ASL data and 2 for the phase-encode-reversed image
+    :return: Relative warp Image in ASL space
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``topup`` : Sub-workspace containing TOPUP output (generated by get_cblip_correction)
+     - ``nativeref`` : ASL space reference image
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``reg.calib2asl`` : Calibration -> ASL transformation matrix. If not specified
+                           the calibration image is assumed to be aligned with the ASL data
+    """
+    calib2asl = wsp.reg.calib2asl if wsp.reg is not None else None
+    if calib2asl is None:
+        calib2asl = np.identity(4)
+    field = reg.transform(wsp, wsp.topup.fout, trans=calib2asl, ref=wsp.nativeref)
+
+    # Displacement in voxels along each axis of the image
+    params = np.array(wsp.topup.params)[index-1]
+    disp = field.data[..., np.newaxis] * params[3] * params[:3]
+
+    # Relative warps are in scaled mm coordinates in which the x axis is
+    # flipped if the image has a neurological voxel orientation
+    disp = disp * np.array(field.pixdim[:3])
+    if np.linalg.det(field.voxToWorldMat[:3, :3]) > 0:
+        disp[..., 0] = -disp[..., 0]
+    return Image(disp, header=field.header)
+
+def combine_warps(wsp, warps):
+    """
+    Combine warps into a single transformation and extract the Jacobian
+
+    :param warps: Sequence of relative warp Images in ASL space
+    :return: Tuple of combined warp Image, warp coefficient Image, Jacobian Image
+    """
+    kwargs = {}
+    for idx, warp in enumerate(warps):
+        kwargs["warp%i" % (idx+1)] = warp
+    result = fsl.convertwarp(ref=wsp.nativeref, out=fsl.LOAD, rel=True, jacobian=fsl.LOAD, log=wsp.fsllog, **kwargs)
+    total_warp = result["out"]
+
+    # Calculation of the jacobian for the warp - method suggested in:
+    # https://www.jiscmail.ac.uk/cgi-bin/webadmin?A2=FSL;d3fee1e5.0908
+    warp_coef = fnirtfileutils(total_warp, outformat="spline", out=fsl.LOAD, log=wsp.fsllog)["out"]
+    jacobian = fnirtfileutils(warp_coef, jac=fsl.LOAD, log=wsp.fsllog)["jac"]
+    return total_warp, warp_coef, Image(jacobian.data, header=total_warp.header)
+
+def correct_img(wsp, img, linear_mat, warp=None, jacobian=None):
     """
     Apply combined warp/linear transformations to an image
     
     :param img: fsl.data.image.Image to correct
     :param linear_mat: img->ASL space linear transformation matrix.
+    :param warp: Combined warp image. If not specified, ``corrected.total_warp`` is used
+    :param jacobian: Jacobian associated with ``warp``
     :return: Corrected Image
 
     If a jacobian is present, also corrects for quantitative signal magnitude as volume has been locally scaled
@@ -549,14 +867,17 @@ def correct_img(wsp, img, linear_mat):
      - ``total_warp``      : Combined warp image
      - ``jacobian``        : Jacobian associated with warp image
     """
-    if wsp.corrected.total_warp is not None:
-        img = reg.transform(wsp, img, trans=wsp.corrected.total_warp, ref=wsp.nativeref, premat=linear_mat)
+    if warp is None:
+        warp, jacobian = wsp.corrected.total_warp, wsp.corrected.jacobian
+
+    if warp is not None:
+        img = reg.transform(wsp, img, trans=warp, ref=wsp.nativeref, premat=linear_mat)
     else:
         img = reg.transform(wsp, img, trans=linear_mat, ref=wsp.nativeref)
 
-    if wsp.corrected.total_jacobian is not None:
+    if jacobian is not None:
         wsp.log.write("   - Correcting for local volume scaling using Jacobian\n")
-        jdata = wsp.corrected.total_jacobian.data
+        jdata = jacobian.data
         if img.data.ndim == 4:
             # Required to make broadcasting work
             jdata = jdata[..., np.newaxis]
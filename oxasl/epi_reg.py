@@ -1,5 +1,10 @@
 """
 Python implementation of EPI registration
+
+This follows the ``epi_reg`` script from FSL, but uses the structural segmentation
+already in the workspace and keeps intermediate images (e.g. the fieldmap in
+structural space) in the workspace so they are only calculated once when BBR
+registration is run more than once.
 """
 import os
 
@@ -9,84 +14,132 @@ import fsl.wrappers as fsl
 
 from oxasl import struc
 
-def epi_reg(wsp, epi_img, use_fmap):
-    """ 
+# Mapping from phase encode direction to FLIRT ``pedir`` and FUGUE ``unwarpdir``
+PEDIRS = {
+    "x" : (1, "x"),
+    "y" : (2, "y"),
+    "z" : (3, "z"),
+    "-x" : (-1, "x-"),
+    "-y" : (-2, "y-"),
+    "-z" : (-3, "z-"),
+    "x-" : (-1, "x-"),
+    "y-" : (-2, "y-"),
+    "z-" : (-3, "z-"),
+}
+
+def epi_reg(wsp, epi_img, use_fmap=False, init=None, output_image=False):
+    """
     Do EPI registration
+
+    BBR registration of an EPI image to the structural image, optionally including
+    fieldmap-based distortion correction
+
+    :param epi_img: 3D EPI image, e.g. perfusion weighted image
+    :param use_fmap: If True, use fieldmap images to correct for distortion
+    :param init: Initial EPI->structural transformation matrix. Defaults to ``reg.asl2struc``
+    :param output_image: If True, return the EPI image transformed to structural space
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``structural``   : Structural sub-workspace containing ``struc``, ``brain``
+     - ``fmap``         : Fieldmap image (in rad/s) - if ``use_fmap``
+     - ``fmapmag``      : Fieldmap magnitude image - if ``use_fmap``
+     - ``fmapmagbrain`` : Fieldmap magnitude brain image - if ``use_fmap``
+     - ``pedir``        : Phase encoding direction - if ``use_fmap``
+     - ``echospacing``  : Effective EPI echo spacing in seconds - if ``use_fmap``
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``nofmapreg``    : If True assume fieldmap in structural space
+     - ``inweight``     : Weighting image for the EPI image
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``reg.fmap2struc``    : Fieldmap->structural transformation matrix
+     - ``reg.fmap_unmasked`` : Fieldmap extrapolated beyond the brain mask
+     - ``reg.fmap_struc``    : Fieldmap in structural space, dilated to fill the structural FOV
+
+    :return: Tuple of EPI image in structural space (or None), EPI->structural
+             transformation matrix, EPI->structural warp (or None if not using fieldmap)
     """
     struc.segment(wsp)
-    wmseg = wsp.structural.wm_seg
-    
-    dirmap = {
-        "x" : (1, "x"),
-        "y" : (2, "y"),
-        "z" : (3, "z"),
-        "-x" : (-1, "x-"),
-        "-y" : (-2, "y-"),
-        "-z" : (-3, "z-"),
-        "x-" : (-1, "x-"),
-        "y-" : (-2, "y-"),
-        "z-" : (-3, "z-"),
+    if wsp.reg is None:
+        wsp.sub("reg")
+    if init is None:
+        init = wsp.reg.asl2struc
+
+    bbr_sch = os.path.join(os.environ["FSLDIR"], "etc", "flirtsch", "bbr.sch")
+    flirt_opts = {
+        "ref" : wsp.structural.struc,
+        "dof" : 6,
+        "cost" : "bbr",
+        "wmseg" : wsp.structural.wm_seg,
+        "init" : init,
+        "inweight" : wsp.inweight,
+        "schedule" : bbr_sch,
+        "omat" : fsl.LOAD,
+        "log" : wsp.fsllog,
     }
-    pedir, fdir = dirmap.get(wsp.pedir, (None, None))
+
+    if not use_fmap:
+        wsp.log.write("  - BBR registration using FLIRT\n")
+        if output_image:
+            flirt_opts["out"] = fsl.LOAD
+        result = fsl.flirt(epi_img, **flirt_opts)
+        return (result["out"] if output_image else None), result["omat"], None
+
+    pedir, fdir = PEDIRS.get(wsp.pedir, (None, None))
     if pedir is None:
         raise ValueError("Invalid phase encode direction specified: %s" % wsp.pedir)
 
-    bbr_sch = os.path.join(os.environ["FSLDIR"], "etc/flirtsch/bbr.sch")
+    _fmap_struc(wsp, fdir)
 
-    # Make a WM edge map for visualisation (good to overlay in FSLView)
-    # FIXME remove this?
-    wsp.wmedge = fsl.maths(wmseg).edge().bin().mask(wmseg).run(out=fsl.LOAD)
+    wsp.log.write("  - BBR registration using FLIRT with fieldmap\n")
+    epi2struc = fsl.flirt(epi_img, echospacing=wsp.echospacing, pedir=pedir, fieldmap=wsp.reg.fmap_struc, **flirt_opts)["omat"]
 
-    if not use_fmap:
-        wsp.log.write(" - Running BBR\n")
-        result = fsl.flirt(epi_img, ref=wsp.structural.struc, dof=6, cost="bbr", wmseg=wmseg, init=wsp.reg.asl2struc, omat=fsl.LOAD, out=fsl.LOAD, schedule=bbr_sch)
-        out = fsl.applywarp(epi_img, ref=wsp.structural.struc, out=fsl.LOAD, premat=result["omat"], interp="spline")["out"]
-    else:
+    # Make equivalent warp field
+    wsp.log.write("  - Making warp field\n")
+    fmap2epi = np.dot(np.linalg.inv(epi2struc), wsp.reg.fmap2struc)
+    fmap_epi = fsl.applywarp(wsp.reg.fmap_unmasked, ref=epi_img, premat=fmap2epi, out=fsl.LOAD, log=wsp.fsllog)["out"]
+    fmap_epi_mask = fsl.fslmaths(fmap_epi).abs().bin().run()
+    shift = fsl.fugue(fmap_epi, loadfmap=fmap_epi, mask=fmap_epi_mask, saveshift=fsl.LOAD, unmaskshift=True,
+                      dwell=wsp.echospacing, unwarpdir=fdir, log=wsp.fsllog)["saveshift"]
+    warp = fsl.convertwarp(ref=wsp.structural.struc, shiftmap=shift, postmat=epi2struc, out=fsl.LOAD,
+                           shiftdir=fdir, relout=True, log=wsp.fsllog)["out"]
+
+    out = None
+    if output_image:
+        out = fsl.applywarp(epi_img, ref=wsp.structural.struc, warp=warp, out=fsl.LOAD, interp="spline",
+                            rel=True, log=wsp.fsllog)["out"]
+    return out, epi2struc, warp
+
+def _fmap_struc(wsp, fdir):
+    """
+    Get the fieldmap in structural space, if not already calculated
+    """
+    if wsp.reg.fmap2struc is None:
         if wsp.nofmapreg:
-            wsp.fmap2struc = np.identity(4)
-            wsp.fmapmag_struc = wsp.fmapmag
+            wsp.reg.fmap2struc = np.identity(4)
         else:
-            # Register fmap to structural image
-            wsp.log.write(" - Registering fieldmap to structural\n")
-            wsp.fmap2struc = fsl.flirt(wsp.fmapmagbrain, ref=wsp.structural.brain, dof=6, omat=fsl.LOAD)["omat"]
-            flirt_result = fsl.flirt(wsp.fmapmag, ref=wsp.structural.struc, dof=6, init=wsp.fmap2struc, omat=fsl.LOAD, out=fsl.LOAD, nosearch=True)
-            wsp.fmap2struc = flirt_result["omat"]
-            wsp.fmapmag_struc = flirt_result["out"]
+            wsp.log.write("  - Registering fieldmap to structural\n")
+            fmap2struc_init = fsl.flirt(wsp.fmapmagbrain, ref=wsp.structural.brain, dof=6, omat=fsl.LOAD, log=wsp.fsllog)["omat"]
+            wsp.reg.fmap2struc = fsl.flirt(wsp.fmapmag, ref=wsp.structural.struc, dof=6, init=fmap2struc_init,
+                                           omat=fsl.LOAD, nosearch=True, log=wsp.fsllog)["omat"]
 
+    if wsp.reg.fmap_unmasked is None:
         # Unmask the fieldmap (necessary to avoid edge effects)
-        wsp.fmap_mask = fsl.fslmaths(wsp.fmapmagbrain).abs().bin().run()
-        wsp.fmap_mask = fsl.fslmaths(wsp.fmap).abs().bin().mul(wsp.fmap_mask).run()
-        
-        # The direction here should take into account the initial affine (it needs to be the direction in the EPI)
-        wsp.fmap_unmasked = fsl.fugue(loadfmap=wsp.fmap, mask=wsp.fmap_mask, unmaskfmap=True, savefmap=fsl.LOAD, unwarpdir=fdir)["out"]
-        
-        # The following is a NEW HACK to fix extrapolation when fieldmap is too small
-        wsp.fmap_struc_pad0 = fsl.applywarp(wsp.fmap_unmasked, ref=wsp.structural.struc, premat=wsp.fmap2struc, out=fsl.LOAD)["out"]
-        wsp.fmap_struc_innermask = fsl.fslmaths(wsp.fmap_struc_pad0).abs().bin().run()
-        wsp.fmap_struc_dilated = fsl.fugue(loadfmap=wsp.fmap_struc_pad0, mask=wsp.fmap_struc_innermask, unmaskfmap=True, unwarpdir=fdir, savefmap=fsl.LOAD)["savefmap"]
-        wsp.fmap_struc = wsp.fmap_struc_dilated
-
-        # Run bbr with fieldmap
-        wsp.log.write("Running BBR with fieldmap\n")
-        if not wsp.epi_reg_use_weighting:
-            refweight = None
-            
-        wsp.reg.epi2struc = fsl.flirt(epi_img, ref=wsp.structural.struc, dof=6, cost="bbr", wmseg=wmseg, init=wsp.reg.asl2struc, omat=fsl.LOAD, schedule=bbr_sch, echospacing=wsp.echospacing, pedir=pedir, fieldmap=wsp.fmap_struc, refweight=refweight)["omat"]
-        
-        # Make equivalent warp fields
-        wsp.log.write("Making warp fields and applying registration to EPI series\n")
-        wsp.reg.struc2epi = np.linalg.inv(wsp.reg.epi2struc)
-        fsl.concatxfm(wsp.reg.struc2epi, wsp.fmap2struc, outmat=fsl.LOAD)
-        fsl.applywarp(wsp.fmap, ref=epi_img, premat=wsp.fmap2epi, out=fsl.LOAD)
-        wsp.fmap2epi_mask = fsl.fslmaths(wsp.fmap2epi).abs().bin().run()
-        # ${vout}_fieldmaprads2epi -abs -bin ${vout}_fieldmaprads2epi_mask
-        fsl.fugue(loadfmap=wsp.fmap2epi, mask=wsp.fmap2epi_mask, saveshift=fsl.LOAD, unmaskshift=True, dwell=wsp.dwell, unwarpdir=fdir)
-        #fsl.convertwarp(wsp.structural.struc, s=wsp.fmap2epi_shift, postmat=..., out=fsl.LOAD, shiftdir=fdir, relout=True)
-        fsl.applywarp(epi_img, ref=wsp.structural.struc, out=fsl.LOAD, warp1=warp, interp="spline", rel=True)
-        
-        # if gdcwarp:
-        #     ${FSLDIR}/bin/convertwarp --ref=${vepi} --warp1=${vout}_warp --midmat=${vout}_inv.mat --warp2=${gdcwarp}  --out=${vepi}2${vepi}_undistorted_warp --relout
-        #     ${FSLDIR}/bin/applywarp -i ${vepi} -r ${vepi} -o ${vepi}_fully_undistorted -w ${vepi}2${vepi}_undistorted_warp --interp=spline --rel
-        #     ${FSLDIR}/bin/flirt -ref ${vrefhead} -in ${vepi}_fully_undistorted -dof 6 -cost bbr -wmseg ${vout}_fast_wmseg -init ${vout}.mat -omat ${vout}.mat -out ${vout} -schedule ${FSLDIR}/etc/flirtsch/bbr.sch
-        #     ${FSLDIR}/bin/convertwarp --ref=${vrefhead} --warp1=${vout}_warp --midmat=${vout}_inv.mat --warp2=${gdcwarp} --postmat=${vout}.mat --out=${vout}_warp --relout
-        #     ${FSLDIR}/bin/applywarp -i ${vepi} -r ${vrefhead} -o ${vout} -w ${vout}_warp --interp=spline --rel
+        fmap_mask = fsl.fslmaths(wsp.fmapmagbrain).abs().bin().run()
+        fmap_mask = fsl.fslmaths(wsp.fmap).abs().bin().mas(fmap_mask).run()
+        wsp.reg.fmap_unmasked = fsl.fugue(wsp.fmap, loadfmap=wsp.fmap, mask=fmap_mask, unmaskfmap=True, savefmap=fsl.LOAD,
+                                          unwarpdir=fdir, log=wsp.fsllog)["savefmap"]
+
+    if wsp.reg.fmap_struc is None:
+        # Dilate the fieldmap to fix extrapolation when it is smaller than the structural FOV
+        fmap_struc_pad0 = fsl.applywarp(wsp.reg.fmap_unmasked, ref=wsp.structural.struc, premat=wsp.reg.fmap2struc,
+                                        out=fsl.LOAD, log=wsp.fsllog)["out"]
+        fmap_struc_innermask = fsl.fslmaths(fmap_struc_pad0).abs().bin().run()
+        wsp.reg.fmap_struc = fsl.fugue(fmap_struc_pad0, loadfmap=fmap_struc_pad0, mask=fmap_struc_innermask, unmaskfmap=True,
+                                       unwarpdir=fdir, savefmap=fsl.LOAD, log=wsp.fsllog)["savefmap"]
@@ -0,0 +1,189 @@
+"""
+Dependency graphs of processing steps
+
+A ``StepGraph`` describes a processing pipeline as a set of named steps, each
+of which is a callable with explicit dependencies on other steps. Steps
+whose dependencies have completed can be run concurrently. This is useful
+because most of the expensive processing (FSL tools, Fabber) takes place in
+subprocesses or native code, so independent steps can overlap even when run
+in Python threads.
+
+The inputs and outputs of each step are recorded as the names of workspace
+attributes, so the graph can be serialized for inspection:
+
+    graph = StepGraph("modelling")
+    graph.add("prefit", basil_prefit, outputs=["basil.initmvn"])
+    graph.add("main", basil_main, deps=["prefit"], inputs=["basil.initmvn"])
+    graph.run(nthreads=2)
+    print(graph.to_yaml())
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import six
+
+class GraphStep(object):
+    """
+    A single step in a StepGraph
+
+    Attributes:
+
+      ``name`` - Unique name of the step within the graph
+      ``fn`` - Callable taking no arguments which performs the step
+      ``deps`` - Names of steps which must complete before this step
+      ``inputs`` - Names of workspace attributes used by this step
+      ``outputs`` - Names of workspace attributes set by this step
+      ``desc`` - Optional description
+    """
+    def __init__(self, name, fn, deps=(), inputs=(), outputs=(), desc=None):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.desc = desc
+
+    def to_dict(self):
+        """
+        :return: Dictionary description of step, excluding the callable
+        """
+        ret = {"name" : self.name, "deps" : self.deps, "inputs" : self.inputs, "outputs" : self.outputs}
+        if self.desc:
+            ret["desc"] = self.desc
+        return ret
+
+class StepGraph(object):
+    """
+    Directed acyclic graph of processing steps
+    """
+
+    def __init__(self, name=None, log=None):
+        """
+        :param name: Optional name of the graph
+        :param log: Optional stream to log step start/finish messages to
+        """
+        self.name = name
+        self.log = log
+        self._steps = []
+        self._log_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def names(self):
+        """
+        :return: Names of steps in the order they were added
+        """
+        return [step.name for step in self._steps]
+
+    def add(self, name, fn, deps=(), inputs=(), outputs=(), desc=None):
+        """
+        Add a step to the graph
+
+        Dependencies must already have been added, so the order in which steps
+        are added is always a valid order in which to run them.
+
+        :param name: Unique name for the step
+        :param fn: Callable taking no arguments which performs the step
+        :param deps: Names of steps which must complete before this step
+        :param inputs: Names of workspace attributes used by this step
+        :param outputs: Names of workspace attributes set by this step
+        :param desc: Optional description
+        :return: GraphStep object
+        """
+        if name in self:
+            raise ValueError("Duplicate step name: %s" % name)
+        for dep in deps:
+            if dep not in self:
+                raise ValueError("Step %s depends on unknown step: %s" % (name, dep))
+        step = GraphStep(name, fn, deps, inputs, outputs, desc)
+        self._steps.append(step)
+        return step
+
+    def step(self, name):
+        """
+        :return: GraphStep with given name
+        """
+        for step in self._steps:
+            if step.name == name:
+                return step
+        raise KeyError("No such step: %s" % name)
+
+    def run(self, nthreads=1):
+        """
+        Run all steps in the graph
+
+        Each step is started as soon as all its dependencies have completed. If a
+        step fails, no further steps are started and the exception is re-raised
+        once any steps already running have finished.
+
+        :param nthreads: Maximum number of steps to run concurrently. If 1, steps
+                         are run in the calling thread in the order they were added
+        """
+        if nthreads <= 1:
+            for step in self._steps:
+                self._run_step(step)
+            return
+
+        completed = six.moves.queue.Queue()
+        def _run(step):
+            try:
+                self._run_step(step)
+                completed.put((step.name, None))
+            except Exception:
+                completed.put((step.name, sys.exc_info()))
+
+        pool = ThreadPool(min(nthreads, len(self._steps)))
+        try:
+            pending = list(self._steps)
+            done, running, error = set(), set(), None
+            while pending or running:
+                if error is None:
+                    for step in [step for step in pending if all([dep in done for dep in step.deps])]:
+                        pending.remove(step)
+                        running.add(step.name)
+                        pool.apply_async(_run, (step,))
+                if not running:
+                    break
+                name, exc_info = completed.get()
+                running.remove(name)
+                done.add(name)
+                if exc_info is not None and error is None:
+                    error = exc_info
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            six.reraise(*error)
+
+    def _run_step(self, step):
+        self._write("Starting step: %s\n" % step.name)
+        step.fn()
+        self._write("Finished step: %s\n" % step.name)
+
+    def _write(self, text):
+        if self.log is not None:
+            with self._log_lock:
+                self.log.write(text)
+
+    def to_dict(self):
+        """
+        :return: Dictionary description of the graph suitable for serialization
+        """
+        return {"name" : self.name, "steps" : [step.to_dict() for step in self._steps]}
+
+    def to_yaml(self):
+        """
+        :return: YAML string description of the graph
+        """
+        import yaml
+        return yaml.dump(self.to_dict(), default_flow_style=False)
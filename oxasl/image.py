@@ -3,6 +3,7 @@ Subclass of fsl.data.image.Image which represents ASL data
 """
 
 import sys
+import math
 import warnings
 import collections
 
@@ -376,6 +377,37 @@ class AslImage(Image):
         else:
             raise RuntimeError("Unknown ordering character: %s" % comp_id)
 
+    def vol_indices(self, order=None):
+        """
+        Get the label, TI and repeat index of every volume in a single pass
+
+        This is equivalent to inverting ``get_vol_index`` for all volumes at once.
+        Variable repeats are supported provided the repeats are grouped within
+        each TI/PLD, i.e. ``r`` is before ``t`` in the ordering string.
+
+        :param order: If specified use custom data ordering string (does not change ordering
+                      within this AslImage - use ``reorder`` for that)
+        :return: Tuple of three integer Numpy arrays, each of length ``nvols``, containing
+                 the label index, TI index and repeat index of each volume
+        """
+        if order is None:
+            order = self.order
+        if len(order) < 3: order = "l" + order
+
+        rpts = np.array(self.rpts, dtype=np.int64)
+        if np.any(rpts != rpts[0]) and order.index("r") > order.index("t"):
+            raise ValueError("Variable repeats are only supported when repeats are grouped within each TI/PLD")
+
+        # Enumerate the full label/TI/repeat grid with the fastest varying index last
+        # and discard repeats which do not exist for a given TI
+        sizes = {"l" : self.ntc, "t" : self.ntis, "r" : int(np.max(rpts))}
+        grid = np.indices([sizes[char] for char in order[::-1]]).reshape(3, -1)
+        label_idx, ti_idx, rpt_idx = [grid[2-order.index(char)] for char in "ltr"]
+        valid = rpt_idx < rpts[ti_idx]
+        if np.count_nonzero(valid) != self.nvols:
+            raise ValueError("Data contains %i volumes, inconsistent with ASL structure" % self.nvols)
+        return label_idx[valid], ti_idx[valid], rpt_idx[valid]
+
     def reorder(self, out_order=None, iaf=None, name=None):
         """
         Re-order ASL data 
@@ -557,49 +589,31 @@ class AslImage(Image):
             name = self.name + "_pwi"
         return Image(image=meandata, name=name, header=self.header)
             
-    def split_epochs(self, epoch_size, overlap=0, time_order=None):
+    def split_epochs(self, epoch_size, overlap=0, time_order=None, lazy=False):
         """
         Split ASL data into 'epochs' of a specified size, with optional overlap
+
+        Each epoch is returned as differenced data with the mean taken over the
+        repeats of each TI/PLD present in the epoch. See ``AslEpochs`` for details
+        of how the epochs are calculated.
+
+        :param epoch_size: Number of (differenced) volumes in each epoch
+        :param overlap: Number of volumes shared between consecutive epochs
+        :param time_order: If specified, reorder the differenced data to this ordering
+                           before splitting it into epochs
+        :param lazy: If True, return a list of ``EpochView`` objects whose data is only
+                     calculated when requested using ``EpochView.img()``
+        :return: List of AslImage objects, or ``EpochView`` objects if ``lazy`` is True
         """
         asldata = self.diff()
         if time_order is not None:
             asldata = asldata.reorder(time_order)
-        
-        epoch = 0
-        epoch_start = 0
-        input_data = asldata.data
-        ret = []
-        while 1:
-            epoch_end = min(epoch_start + epoch_size, asldata.nvols)
-            tis = []
-            rpts = []
-            for ti in range(asldata.ntis):
-                for rpt in range(asldata.rpts[ti]):
-                    vol_idx = asldata.get_vol_index(0, ti, rpt)
-                    if vol_idx >= epoch_start and vol_idx < epoch_end:
-                        ti_val = self.tis[ti]
-                        if ti_val not in tis:
-                            tis.append(ti_val)
-                            rpts.append(1)
-                        else:
-                            idx = tis.index(ti_val)
-                            rpts[idx] += 1
-            epoch_data = input_data[..., epoch_start:epoch_end]
-            epoch_img = AslImage(image=epoch_data,
-                                 name=self.name + "_epoch%i" % epoch, 
-                                 iaf=asldata.iaf, order=asldata.order,
-                                 tis=tis, rpts=rpts,
-                                 header=self.header).mean_across_repeats()
-
-            ret.append(epoch_img)
-            epoch += 1
-            epoch_start += epoch_size - overlap
-            # Finish if start of next epoch is out of range or if current epoch 
-            # ended at the last volume
-            if epoch_start >= asldata.nvols or epoch_end == asldata.nvols:
-                break
 
-        return ret
+        epochs = AslEpochs(asldata, epoch_size, overlap, name=self.name)
+        if lazy:
+            return [epochs[idx] for idx in range(len(epochs))]
+        else:
+            return epochs.images()
 
     def summary(self, log=sys.stdout):
         """
@@ -692,3 +706,164 @@ class AslImage(Image):
             warnings.warn("AslImage.derived failed (%s) - returning fsl.data.image.Image" % str(exc))
             return Image(image=image, name=name, header=self.header, **kwargs)
             
+
+class AslEpochs(object):
+    """
+    Division of differenced ASL data into 'epochs' of a fixed number of volumes
+
+    The epoch boundaries and the number of repeats of each TI/PLD within each
+    epoch are determined in a single pass over the volume indices. The mean
+    of each TI/PLD within an epoch is obtained from a cumulative sum over
+    volumes grouped by TI/PLD, so the cost of each epoch is independent of the
+    epoch size and overlap. The cumulative sum is only calculated when epoch
+    data is first requested.
+
+    Attributes:
+
+      ``starts`` - Index of the first volume in each epoch
+      ``ends`` - Index one beyond the last volume in each epoch
+      ``rpts`` - Integer array of shape [number of epochs, ntis] giving the number of
+                 repeats of each TI/PLD in each epoch
+    """
+
+    def __init__(self, asldata, epoch_size, overlap=0, name=None):
+        """
+        :param asldata: Differenced AslImage
+        :param epoch_size: Number of volumes in each epoch
+        :param overlap: Number of volumes shared between consecutive epochs
+        :param name: Base name for epoch images. Defaults to the name of ``asldata``
+        """
+        if asldata.iaf != "diff":
+            raise ValueError("Epochs can only be defined on differenced data")
+        if epoch_size < 1:
+            raise ValueError("Epoch size must be at least 1 volume")
+        if overlap < 0 or overlap >= epoch_size:
+            raise ValueError("Epoch overlap must be non-negative and less than the epoch size")
+
+        self.asldata = asldata
+        self.name = name if name is not None else asldata.name
+
+        # An epoch is the last one if it reaches the end of the data
+        nvols, step = asldata.nvols, epoch_size - overlap
+        nepochs = 1 + max(0, int(math.ceil(float(nvols - epoch_size) / step)))
+        self.starts = np.arange(nepochs) * step
+        self.ends = np.minimum(self.starts + epoch_size, nvols)
+
+        # Running count of volumes seen for each TI, with a leading row of zeros
+        # so that the count within volumes [start, end) is cumcount[end] - cumcount[start]
+        _, self._ti_idx, _ = asldata.vol_indices()
+        self._cumcount = np.zeros((nvols + 1, asldata.ntis), dtype=np.int64)
+        self._cumcount[1:] = np.cumsum(self._ti_idx[:, np.newaxis] == np.arange(asldata.ntis), axis=0)
+        self.rpts = self._cumcount[self.ends] - self._cumcount[self.starts]
+        self._cumsum = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Epoch index out of range: %i" % idx)
+        return EpochView(self, idx)
+
+    def _get_cumsum(self):
+        """
+        Cumulative sum of the data over volumes, with volumes stably sorted by TI
+
+        Volumes from the same TI are contiguous in the sorted data and retain their
+        original relative order, so the volumes of a TI within any epoch form a
+        contiguous block and their sum is the difference of two cumulative sums.
+        """
+        if self._cumsum is None:
+            data = self.asldata.data
+            if data.ndim == 3:
+                data = data[..., np.newaxis]
+            vol_order = np.argsort(self._ti_idx, kind="mergesort")
+            self._cumsum = np.zeros(list(data.shape[:3]) + [data.shape[3] + 1], dtype=np.float64)
+            np.cumsum(data[..., vol_order], axis=-1, out=self._cumsum[..., 1:])
+            self._ti_offset = np.concatenate([[0], np.cumsum(self._cumcount[-1])[:-1]])
+        return self._cumsum
+
+    def mean_data(self, epochs=None):
+        """
+        Get the mean of each TI/PLD within epochs
+
+        :param epochs: Sequence of epoch indices. If not specified, all epochs are returned
+        :return: Numpy array of shape [nx, ny, nz, number of epochs, ntis]. TIs which
+                 are not present in an epoch have a value of zero
+        """
+        if epochs is None:
+            epochs = np.arange(len(self))
+        epochs = np.atleast_1d(epochs)
+        cumsum = self._get_cumsum()
+        lower = self._ti_offset + self._cumcount[self.starts[epochs]]
+        upper = self._ti_offset + self._cumcount[self.ends[epochs]]
+        counts = np.maximum(upper - lower, 1)
+        return (cumsum[..., upper] - cumsum[..., lower]) / counts
+
+    def img(self, idx, mean_data=None):
+        """
+        Get an epoch as an AslImage containing the mean of each TI/PLD present in the epoch
+
+        :param idx: Epoch index
+        :param mean_data: Optional precalculated output of ``mean_data`` for this epoch
+        :return: Differenced AslImage with one volume per TI/PLD present in the epoch
+        """
+        asldata = self.asldata
+        if mean_data is None:
+            mean_data = self.mean_data([idx])[..., 0, :]
+        present = np.flatnonzero(self.rpts[idx])
+        kwargs = {
+            "iaf" : "diff",
+            "order" : asldata.order,
+            "rpts" : 1,
+            "casl" : asldata.casl,
+            "slicedt" : asldata.slicedt,
+            "sliceband" : asldata.sliceband,
+        }
+        if asldata.taus is not None:
+            kwargs["taus"] = [asldata.taus[ti_idx] for ti_idx in present]
+        if asldata.have_plds and asldata.plds is not None:
+            kwargs["plds"] = [asldata.plds[ti_idx] for ti_idx in present]
+        elif asldata.have_plds:
+            kwargs["nplds"] = len(present)
+        elif asldata.tis is not None:
+            kwargs["tis"] = [asldata.tis[ti_idx] for ti_idx in present]
+        else:
+            kwargs["ntis"] = len(present)
+
+        name = self.name + "_epoch%i_mean" % idx
+        return AslImage(image=mean_data[..., present], name=name, header=asldata.header, **kwargs)
+
+    def images(self):
+        """
+        :return: List of AslImage objects, one for each epoch
+        """
+        mean_data = self.mean_data()
+        return [self.img(idx, mean_data[..., idx, :]) for idx in range(len(self))]
+
+class EpochView(object):
+    """
+    Lazy reference to a single epoch of an ``AslEpochs`` object
+
+    The epoch structure is available immediately but the data is only calculated
+    when ``img()`` is called.
+    """
+
+    def __init__(self, epochs, idx):
+        self.epochs = epochs
+        self.idx = idx
+        self.start = int(epochs.starts[idx])
+        self.end = int(epochs.ends[idx])
+        self.rpts = [int(rpt) for rpt in epochs.rpts[idx]]
+
+    @property
+    def nvols(self):
+        return self.end - self.start
+
+    def img(self):
+        """
+        :return: AslImage for this epoch
+        """
+        return self.epochs.img(self.idx)
@@ -40,6 +40,8 @@ def generate_mask(wsp):
      - ``asl2struc`` : Existring ASL->Structural space transformation matrix
      - ``calib``   : Calibration image
      - ``regfrom`` : ASL registration source image
+     - ``asl_brain_method`` : Brain extraction method used to generate the registration source
+                              image, ``bet`` (default) or ``numpy``. See ``reg.get_regfrom``
     """
     if wsp.rois is not None and wsp.rois.mask is not None:
         return
@@ -67,7 +69,7 @@ def generate_mask(wsp):
         # Alternatively, use registration image (which will be BETed calibration or mean ASL image)
         reg.get_regfrom(wsp)
         wsp.rois.mask_src = "regfrom"
-        wsp.rois.mask = Image((wsp.reg.regfrom.data != 0).astype(np.int), header=wsp.reg.regfrom.header)
+        wsp.rois.mask = Image((wsp.reg.regfrom.data != 0).astype(np.int32), header=wsp.reg.regfrom.header)
         mask_source = "generated from brain extracted registration ASL image"
     
     wsp.log.write("\nGenerated ASL data mask\n")
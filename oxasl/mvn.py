@@ -0,0 +1,307 @@
+"""
+Handling of Fabber MVN (multivariate normal) parameter distributions
+
+Fabber stores the posterior distribution of the model parameters in each voxel
+in an MVN image. A previous run's final MVN can be used to initialize a new run
+using the ``continue-from-mvn`` option, which can greatly reduce the number of
+iterations required.
+
+The ``MVN`` class allows parameter means and variances to be read and modified
+in memory, as an alternative to the ``mvntool`` command line tool.
+
+The ``MvnCache`` class provides a persistent store of final MVN outputs so that
+re-running BASIL on the same data with modified options can be initialized
+automatically from a previous run.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import math
+
+import six
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl.utils import data_hash
+
+class MVN(object):
+    """
+    Fabber MVN distribution held in memory
+
+    Fabber MVN images contain, for each voxel, the lower triangle of the parameter
+    covariance matrix stored row by row (so the covariance of parameters ``i`` and
+    ``j <= i`` is at volume ``i*(i+1)/2 + j``), followed by the parameter means
+    and finally a constant volume of 1. For N parameters there are therefore
+    ``N*(N+1)/2 + N + 1`` volumes.
+
+    Attributes:
+
+      ``data`` - 4D Numpy array of packed MVN data
+      ``nparams`` - Number of parameters
+      ``paramnames`` - List of parameter names, or None if not known
+      ``header`` - Nifti header for output images
+    """
+
+    def __init__(self, mvn, paramnames=None, header=None):
+        """
+        :param mvn: MVN Image or 4D Numpy array
+        :param paramnames: Optional sequence of parameter names, required to access
+                           parameters by name
+        :param header: Nifti header, if ``mvn`` is a Numpy array
+        """
+        if isinstance(mvn, Image):
+            header = mvn.header
+            data = mvn.data
+        else:
+            data = mvn
+        if data.ndim != 4:
+            raise ValueError("MVN data must be 4D")
+
+        nparams = int(round((math.sqrt(8*data.shape[3] + 1) - 3) / 2))
+        if nparams < 1 or self._nvols(nparams) != data.shape[3]:
+            raise ValueError("%i volumes is not a valid MVN" % data.shape[3])
+        if paramnames is not None and len(paramnames) != nparams:
+            raise ValueError("MVN contains %i parameters but %i names given" % (nparams, len(paramnames)))
+
+        self.data = np.array(data, dtype=np.float32)
+        self.nparams = nparams
+        self.paramnames = list(paramnames) if paramnames is not None else None
+        self.header = header
+
+    @classmethod
+    def new(cls, shape, paramnames, header=None, mean=0.0, var=1.0):
+        """
+        Create a new MVN with no covariance between parameters
+
+        :param shape: 3D spatial shape
+        :param paramnames: Sequence of parameter names
+        :param header: Optional Nifti header for output images
+        :param mean: Initial mean of all parameters
+        :param var: Initial variance of all parameters
+        """
+        nparams = len(paramnames)
+        mvn = cls(np.zeros(list(shape[:3]) + [cls._nvols(nparams)], dtype=np.float32), paramnames, header=header)
+        mvn.data[..., -1] = 1
+        for idx in range(nparams):
+            mvn.set_mean(idx, mean)
+            mvn.set_var(idx, var)
+        return mvn
+
+    @staticmethod
+    def _nvols(nparams):
+        return nparams * (nparams + 1) // 2 + nparams + 1
+
+    def param_index(self, param):
+        """
+        :param param: Parameter name or zero-based index
+        :return: Zero-based index of parameter
+        """
+        if isinstance(param, six.string_types):
+            if self.paramnames is None or param not in self.paramnames:
+                raise ValueError("Parameter not found in MVN: %s" % param)
+            return self.paramnames.index(param)
+        elif param < 0 or param >= self.nparams:
+            raise ValueError("Parameter index out of range: %i" % param)
+        return param
+
+    def _cov_vol(self, idx1, idx2):
+        idx1, idx2 = max(idx1, idx2), min(idx1, idx2)
+        return idx1 * (idx1 + 1) // 2 + idx2
+
+    def _mean_vol(self, idx):
+        return self.nparams * (self.nparams + 1) // 2 + idx
+
+    def mean(self, param):
+        """
+        :return: 3D Numpy array of parameter means
+        """
+        return self.data[..., self._mean_vol(self.param_index(param))]
+
+    def var(self, param):
+        """
+        :return: 3D Numpy array of parameter variances
+        """
+        idx = self.param_index(param)
+        return self.data[..., self._cov_vol(idx, idx)]
+
+    def cov(self, param1, param2):
+        """
+        :return: 3D Numpy array of covariance between two parameters
+        """
+        return self.data[..., self._cov_vol(self.param_index(param1), self.param_index(param2))]
+
+    def set_mean(self, param, value, mask=None):
+        """
+        Set the mean of a parameter
+
+        :param param: Parameter name or index
+        :param value: Single value, or 3D Image or Numpy array of voxelwise values
+        :param mask: Optional mask Image or array. If specified only voxels within the mask are set
+        """
+        self._set_vol(self._mean_vol(self.param_index(param)), value, mask)
+
+    def set_var(self, param, value, mask=None):
+        """
+        Set the variance of a parameter
+
+        :param param: Parameter name or index
+        :param value: Single value, or 3D Image or Numpy array of voxelwise values
+        :param mask: Optional mask Image or array. If specified only voxels within the mask are set
+        """
+        idx = self.param_index(param)
+        self._set_vol(self._cov_vol(idx, idx), value, mask)
+
+    def _set_vol(self, vol, value, mask):
+        if isinstance(value, Image):
+            value = value.data
+        if mask is None:
+            self.data[..., vol] = value
+        else:
+            if isinstance(mask, Image):
+                mask = mask.data
+            voxels = mask != 0
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                value = value[voxels]
+            self.data[..., vol][voxels] = value
+
+    def remap(self, paramnames, mean=0.0, var=1.0, priors=None):
+        """
+        Create an MVN for a different parameter set
+
+        Means, variances and covariances of parameters which are in both parameter
+        sets are copied. Other parameters are initialized from ``priors`` if given,
+        otherwise with the given mean and variance, and no covariance.
+
+        :param paramnames: Sequence of parameter names for the new MVN
+        :param mean: Initial mean of parameters not in this MVN
+        :param var: Initial variance of parameters not in this MVN
+        :param priors: Optional mapping from parameter name to tuple of (mean, variance)
+                       used to initialize parameters not in this MVN
+        :return: New MVN object
+        """
+        if self.paramnames is None:
+            raise ValueError("Parameter names are required to remap MVN")
+        ret = MVN.new(self.data.shape, paramnames, header=self.header, mean=mean, var=var)
+        for param, (prior_mean, prior_var) in (priors or {}).items():
+            if param in paramnames and param not in self.paramnames:
+                ret.set_mean(param, prior_mean)
+                ret.set_var(param, prior_var)
+        shared = [(new_idx, self.paramnames.index(param)) for new_idx, param in enumerate(paramnames) if param in self.paramnames]
+        for new_idx1, idx1 in shared:
+            ret.data[..., ret._mean_vol(new_idx1)] = self.data[..., self._mean_vol(idx1)]
+            for new_idx2, idx2 in shared:
+                if new_idx2 <= new_idx1:
+                    ret.data[..., ret._cov_vol(new_idx1, new_idx2)] = self.data[..., self._cov_vol(idx1, idx2)]
+        ret.data[..., -1] = self.data[..., -1]
+        return ret
+
+    def image(self, name=None):
+        """
+        :return: MVN as an fsl.data.image.Image
+        """
+        return Image(self.data, name=name, header=self.header)
+
+class MvnCache(object):
+    """
+    Directory-based cache of final MVN outputs from BASIL runs
+
+    Entries are keyed by the input data, mask and model structure (model, dispersion
+    and exchange options). Within a key, one entry is kept for each distinct set of
+    model parameters, so for example runs with and without partial volume correction
+    are stored separately.
+
+    An entry can be used to initialize a run with a different parameter set by
+    remapping the parameters by name. Parameters which are not present in the
+    cached MVN are initialized from their priors where these are given.
+    """
+
+    def __init__(self, cachedir, log=sys.stdout):
+        """
+        :param cachedir: Directory in which to store cache entries. Will be created if it does
+                         not exist
+        :param log: Stream for log messages
+        """
+        self.cachedir = os.path.abspath(cachedir)
+        self.log = log
+
+    def key(self, asldata, mask, options):
+        """
+        Get the cache key for a BASIL run
+
+        :param asldata: AslImage being modelled
+        :param mask: Mask image or None
+        :param options: Fabber options dictionary - only the model structure options are used
+        :return: Key string
+        """
+        return data_hash(asldata, mask,
+                         options.get("model", "aslrest"),
+                         options.get("disp", "none"),
+                         options.get("exch", "mix"))
+
+    def store(self, key, mvn, paramnames):
+        """
+        Store the final MVN from a run
+
+        :param key: Cache key from ``key()``
+        :param mvn: MVN Image
+        :param paramnames: Sequence of parameter names in the MVN
+        """
+        entrydir = os.path.join(self.cachedir, key, data_hash(*paramnames))
+        if not os.path.exists(entrydir):
+            os.makedirs(entrydir)
+        Image(mvn.data, header=mvn.header).save(os.path.join(entrydir, "finalMVN.nii.gz"))
+        with open(os.path.join(entrydir, "paramnames.txt"), "w") as pfile:
+            pfile.write("\n".join(paramnames) + "\n")
+
+    def entries(self, key):
+        """
+        Get all cached entries for a key
+
+        :param key: Cache key from ``key()``
+        :return: Sequence of tuples of (MVN filename, list of parameter names)
+        """
+        keydir = os.path.join(self.cachedir, key)
+        if not os.path.isdir(keydir):
+            return []
+
+        ret = []
+        for entry in sorted(os.listdir(keydir)):
+            mvn_fname = os.path.join(keydir, entry, "finalMVN.nii.gz")
+            params_fname = os.path.join(keydir, entry, "paramnames.txt")
+            if os.path.exists(mvn_fname) and os.path.exists(params_fname):
+                with open(params_fname) as pfile:
+                    ret.append((mvn_fname, [line.strip() for line in pfile if line.strip()]))
+        return ret
+
+    def initmvn(self, key, paramnames, priors=None):
+        """
+        Get an initial MVN for a run from the cache
+
+        The cached entry sharing the most parameters with the requested parameter
+        set is used. If the parameter sets differ, the cached MVN is remapped
+        by parameter name.
+
+        :param key: Cache key from ``key()``
+        :param paramnames: Sequence of parameter names for the new run
+        :param priors: Optional mapping from parameter name to tuple of (mean, variance)
+                       used to initialize parameters which are not in the cached MVN
+        :return: MVN Image, or None if there is no compatible entry
+        """
+        best, best_shared = None, []
+        for mvn_fname, cached_params in self.entries(key):
+            shared = [param for param in paramnames if param in cached_params]
+            if len(shared) > len(best_shared):
+                best, best_shared = (mvn_fname, cached_params), shared
+        if best is None:
+            return None
+
+        mvn_fname, cached_params = best
+        self.log.write(" - Initializing from cached MVN with parameters: %s\n" % ", ".join(cached_params))
+        mvn = Image(mvn_fname)
+        if list(cached_params) == list(paramnames):
+            return mvn
+        return MVN(mvn, cached_params).remap(paramnames, priors=priors).image()
@@ -161,6 +161,7 @@ class GenericOptions(OptionCategory):
         group.add_option("--log-cmds", help="Log all external commands run", action="store_true", default=False)
         group.add_option("--log-cmdout", help="Log the standard output of all external commands run", action="store_true", default=False)
         group.add_option("--debug", help="Debug mode - log all command output and keep all output files", action="store_true", default=False)
+        group.add_option("--save-npy", help="Also save large matrices in binary .npy format", action="store_true", default=False)
         return [group, ]
 
 def _check_image(option, opt, value):
@@ -170,11 +171,14 @@ def _check_image(option, opt, value):
         raise OptionValueError("option %s: invalid Image value: %r" % (opt, value))
 
 def load_matrix(fname):
-    matrix = []
+    """
+    Load a matrix from a space or comma separated text file
+
+    :return: 2D Numpy array
+    """
+    from oxasl.workspace import text_to_matrix
     with open(fname, "r") as f:
-        for line in f.readlines():
-            matrix.append([float(v) for v in line.split()])
-    return np.array(matrix, dtype=np.float)
+        return text_to_matrix(f.read()).astype(np.float64)
 
 def _check_matrix(option, opt, value):
     try:
@@ -55,29 +55,35 @@ from __future__ import print_function
 import sys
 import os
 import traceback
+import importlib
 
 import numpy as np
 
 from fsl.data.image import Image
 
-try:
-    import oxasl_ve
-except ImportError:
-    oxasl_ve = None
+from oxasl import Workspace, __version__, image, calib, struc, basil, mask, corrections, reg, region_analysis
+from oxasl.graph import StepGraph
+from oxasl.options import AslOptionParser, GenericOptions, OptionCategory, IgnorableOptionGroup
+from oxasl.reporting import LightboxImage
 
-try:
-    import oxasl_deblur
-except ImportError:
-    oxasl_deblur = None
+PLUGINS = ("oxasl_ve", "oxasl_deblur", "oxasl_enable")
+_plugins = {}
 
-try:
-    import oxasl_enable
-except ImportError:
-    oxasl_enable = None
+def plugin(name):
+    """
+    Get an optional plugin module
 
-from oxasl import Workspace, __version__, image, calib, struc, basil, mask, corrections, reg
-from oxasl.options import AslOptionParser, GenericOptions, OptionCategory, IgnorableOptionGroup
-from oxasl.reporting import LightboxImage
+    Plugins are imported on first use rather than when this module is imported
+
+    :param name: Plugin module name, e.g. ``oxasl_ve``
+    :return: Plugin module, or None if it is not installed
+    """
+    if name not in _plugins:
+        try:
+            _plugins[name] = importlib.import_module(name)
+        except ImportError:
+            _plugins[name] = None
+    return _plugins[name]
 
 class OxfordAslOptions(OptionCategory):
     """
@@ -92,11 +98,14 @@ class OxfordAslOptions(OptionCategory):
         g = IgnorableOptionGroup(parser, "Main Options")
         g.add_option("--wp", help="Analysis which conforms to the 'white papers' (Alsop et al 2014)", action="store_true", default=False)
         g.add_option("--mc", help="Motion correct data", action="store_true", default=False)
+        g.add_option("--inprocess-moco", help="Motion correct short multi-volume calibration images without using MCFLIRT", action="store_true", default=False)
         g.add_option("--fixbat", dest="inferbat", help="Fix bolus arrival time", action="store_false", default=True)
         g.add_option("--fixbolus", dest="infertau", help="Fix bolus duration", action="store_false")
         g.add_option("--artoff", dest="inferart", help="Do not infer arterial component", action="store_false", default=True)
         g.add_option("--spatial-off", dest="spatial", help="Do not include adaptive spatial smoothing on CBF", action="store_false", default=True)
-        if oxasl_enable:
+        g.add_option("--mvn-cache", help="Directory for cache of final MVN outputs used to initialize modelling of the same data")
+        g.add_option("--nthreads", help="Maximum number of independent processing steps to run concurrently", type=int, default=1)
+        if plugin("oxasl_enable"):
             g.add_option("--use-enable", help="Use ENABLE preprocessing step", action="store_true", default=False)
 
         ret.append(g)
@@ -115,6 +124,9 @@ class OxfordAslOptions(OptionCategory):
         g.add_option("--output-stddev", "--output-std", help="Output standard deviation of estimated variables", action="store_true", default=False)
         g.add_option("--output-var", "--vars", help="Output variance of estimated variables", action="store_true", default=False)
         g.add_option("--output-mni", help="Output in MNI standard space", action="store_true", default=False)
+        g.add_option("--region-analysis", help="Output statistics for each atlas region", action="store_true", default=False)
+        g.add_option("--region-analysis-atlas", help="FSL atlas to use for region analysis (default: harvardoxford-cortical)")
+        g.add_option("--region-analysis-atlas-img", help="Standard space label image to use for region analysis instead of an FSL atlas", type="image")
         g.add_option("--no-report", dest="save_report", help="Don't try to generate an HTML report", action="store_false", default=True)
         ret.append(g)
         return ret
@@ -132,10 +144,10 @@ def main():
         parser.add_category(calib.CalibOptions(ignore=["perf", "tis"]))
         parser.add_category(reg.RegOptions())
         parser.add_category(corrections.DistcorrOptions())
-        if oxasl_ve:
-            parser.add_category(oxasl_ve.VeaslOptions())
-        if oxasl_enable:
-            parser.add_category(oxasl_enable.EnableOptions(ignore=["regfrom",]))
+        if plugin("oxasl_ve"):
+            parser.add_category(plugin("oxasl_ve").VeaslOptions())
+        if plugin("oxasl_enable"):
+            parser.add_category(plugin("oxasl_enable").EnableOptions(ignore=["regfrom",]))
         parser.add_category(GenericOptions())
 
         options, _ = parser.parse_args()
@@ -171,9 +183,10 @@ def oxasl(wsp):
     Main oxasl pipeline script
     """
     wsp.log.write("OXASL version: %s\n" % __version__)
-    for plugin in (oxasl_ve, oxasl_deblur, oxasl_enable):
-        if plugin is not None:
-            wsp.log.write(" - Found plugin: %s (version %s)\n" % (plugin.__name__, getattr(plugin, "__version__", "unknown")))
+    for plugin_name in PLUGINS:
+        plugin_module = plugin(plugin_name)
+        if plugin_module is not None:
+            wsp.log.write(" - Found plugin: %s (version %s)\n" % (plugin_name, getattr(plugin_module, "__version__", "unknown")))
 
     wsp.log.write("\nInput ASL data: %s\n" % wsp.asldata.name)
     wsp.asldata.summary(wsp.log)
@@ -184,9 +197,9 @@ def oxasl(wsp):
     if wsp.asldata.iaf in ("tc", "ct", "diff"):
         model_paired(wsp)
     elif wsp.asldata.iaf == "ve":
-        if oxasl_ve is None:
+        if plugin("oxasl_ve") is None:
             raise ValueError("Vessel encoded data supplied but oxasl_ve is not installed")
-        oxasl_ve.model_ve(wsp)
+        plugin("oxasl_ve").model_ve(wsp)
     else:
         # FIXME support for multiphase data
         raise ValueError("ASL data has format '%s' - not supported by OXASL pipeline" % wsp.asldata.iaf)
@@ -202,16 +215,21 @@ def report_asl(wsp):
     """
     Generate a report page about the input ASL data
     """
+    # Use the uncorrected data, since this may be run concurrently with corrections
+    asldata = wsp.input.asldata if wsp.input is not None else None
+    if asldata is None:
+        asldata = wsp.asldata
+
     page = wsp.report.page("asl")
     page.heading("ASL input data")
-    md_table = [(key, value) for key, value in wsp.asldata.metadata_summary().items()]
+    md_table = [(key, value) for key, value in asldata.metadata_summary().items()]
     page.table(md_table)
     try:
         # Not all data can generate a PWI
-        img = wsp.asldata.perf_weighted()
+        img = asldata.perf_weighted()
         img_type = "Perfusion-weighted image"
     except ValueError:
-        img = wsp.asldata.mean()
+        img = asldata.mean()
         img_type = "Mean ASL data"
 
     page.heading(img_type, level=1)
@@ -224,28 +242,65 @@ def oxasl_preproc(wsp):
     This method requires wsp to be a Workspace containing certain standard information.
     As a minimum, the attribute ``asldata`` must contain an AslImage object.
     """
-    report_asl(wsp)
+    graph = preproc_graph(wsp)
+    wsp.set_item("preproc_graph", graph, save_name="preproc_graph.yml", save_fn=lambda graph: graph.to_yaml())
+    graph.run(nthreads=wsp.ifnone("nthreads", 1))
 
-    struc.init(wsp)
-    corrections.apply_corrections(wsp)
+    if plugin("oxasl_enable") and wsp.use_enable:
+        wsp.sub("enable")
+        plugin("oxasl_enable").enable(wsp.enable)
+        wsp.corrected.asldata = wsp.enable.asldata_enable
 
-    corrections.get_motion_correction(wsp)
-    corrections.apply_corrections(wsp)
+def preproc_graph(wsp):
+    """
+    Get the dependency graph of preprocessing steps
 
-    reg.reg_asl2calib(wsp)
-    reg.reg_asl2struc(wsp, True, False)
+    Preprocessing of the structural image (brain extraction and segmentation) and
+    structural->standard registration, if required, are independent of the ASL data
+    until registration, so can be run concurrently with preprocessing of the calibration
+    images and motion correction of the ASL data
 
+    :return: StepGraph object
+    """
+    graph = StepGraph("preproc", log=wsp.log if wsp.debug else None)
+
+    graph.add("report_asl", lambda: report_asl(wsp), inputs=["input.asldata"])
+    graph.add("struc_init", lambda: struc.init(wsp), inputs=["struc", "fslanat"],
+              outputs=["structural.struc", "structural.brain", "structural.brain_mask",
+                       "structural.gm_pv", "structural.wm_pv", "structural.csf_pv",
+                       "structural.gm_seg", "structural.wm_seg", "structural.csf_seg"])
+
+    have_struc = wsp.struc is not None or wsp.fslanat is not None
+    if (wsp.output_mni or wsp.region_analysis) and have_struc:
+        graph.add("reg_struc2std", lambda: reg.reg_struc2std(wsp), deps=["struc_init"],
+                  inputs=["structural.brain"], outputs=["reg.struc2std", "reg.std2struc"])
+
+    graph.add("calib_preproc", lambda: corrections.apply_corrections(wsp),
+              inputs=["input.asldata", "input.calib", "input.cref", "input.cact", "input.cblip"],
+              outputs=["corrected.calib", "corrected.cref", "corrected.cact", "corrected.cblip"])
+    graph.add("moco", lambda: corrections.get_motion_correction(wsp), deps=["calib_preproc"],
+              inputs=["input.asldata", "input.calib"], outputs=["moco.mc_mats", "reg.asl2calib", "reg.calib2asl"])
+    graph.add("apply_moco", lambda: corrections.apply_corrections(wsp), deps=["moco"],
+              inputs=["input.asldata", "moco.mc_mats"], outputs=["corrected.asldata"])
+    graph.add("outliers", lambda: corrections.get_outlier_rejection(wsp), deps=["apply_moco"],
+              inputs=["corrected.asldata", "moco.fd"], outputs=["outliers.keep_vols"])
+    graph.add("reg_asl2calib", lambda: reg.reg_asl2calib(wsp), deps=["apply_moco"],
+              inputs=["asldata", "calib"], outputs=["reg.regfrom", "reg.asl2calib", "reg.calib2asl"])
+    graph.add("reg_asl2struc", lambda: reg.reg_asl2struc(wsp, True, False), deps=["struc_init", "reg_asl2calib"],
+              inputs=["reg.regfrom", "structural.brain"], outputs=["reg.asl2struc", "reg.struc2asl"])
+    graph.add("distcorr", lambda: _distcorr(wsp), deps=["reg_asl2struc", "outliers"],
+              inputs=["fmap", "cblip", "reg.asl2struc"], outputs=["fieldmap.warp", "topup.fieldcoef", "senscorr.sensitivity"])
+    graph.add("apply_corrections", lambda: corrections.apply_corrections(wsp), deps=["distcorr"],
+              inputs=["input.asldata", "moco.mc_mats", "fieldmap.warp", "topup.fieldcoef"],
+              outputs=["corrected.asldata", "corrected.calib"])
+    graph.add("mask", lambda: mask.generate_mask(wsp), deps=["apply_corrections"],
+              inputs=["corrected.asldata", "structural.brain", "reg.struc2asl"], outputs=["rois.mask"])
+    return graph
+
+def _distcorr(wsp):
     corrections.get_fieldmap_correction(wsp)
     corrections.get_cblip_correction(wsp)
     corrections.get_sensitivity_correction(wsp)
-    corrections.apply_corrections(wsp)
-
-    mask.generate_mask(wsp)
-
-    if oxasl_enable and wsp.use_enable:
-        wsp.sub("enable")
-        oxasl_enable.enable(wsp.enable)
-        wsp.corrected.asldata = wsp.enable.asldata_enable
 
 def model_paired(wsp):
     """
@@ -260,35 +315,104 @@ def model_paired(wsp):
      - ``output.native`` - Native (ASL) space output from last Basil modelling output
      - ``output.struc``  - Structural space output
     """
-    basil.basil(wsp, output_wsp=wsp.sub("basil"))
-    redo_reg(wsp, wsp.basil.finalstep.mean_ftiss)
+    graph = modelling_graph(wsp)
+    wsp.set_item("modelling_graph", graph, save_name="modelling_graph.yml", save_fn=lambda graph: graph.to_yaml())
+    graph.run(nthreads=wsp.ifnone("nthreads", 1))
+
+def modelling_graph(wsp):
+    """
+    Get the dependency graph of steps for modelling TC/CT or subtracted data
 
+    Steps which do not depend on each other, e.g. structural->standard registration
+    and the model fitting, can be run concurrently
+
+    :return: StepGraph object
+    """
+    graph = StepGraph("modelling", log=wsp.log if wsp.debug else None)
+    wsp.sub("basil")
     wsp.sub("output")
 
+    graph.add("basil_prefit", lambda: basil.basil_prefit(wsp, wsp.basil),
+              inputs=["asldata", "rois.mask"], outputs=["basil.initmvn", "basil.init"])
+    graph.add("basil", lambda: basil.basil_main(wsp, wsp.basil), deps=["basil_prefit"],
+              inputs=["asldata", "rois.mask", "basil.initmvn"], outputs=["basil.finalstep"])
+    graph.add("redo_reg", lambda: redo_reg(wsp, wsp.basil.finalstep.mean_ftiss), deps=["basil"],
+              inputs=["basil.finalstep.mean_ftiss"], outputs=["reg.asl2struc", "reg.struc2asl"])
+
+    have_struc = wsp.structural.struc is not None or wsp.fslanat is not None
+
+    final_deps = ["redo_reg"]
     if wsp.pvcorr:
-        # Do partial volume correction fitting
-        #
-        # FIXME: We could at this point re-apply all corrections derived from structural space?
-        # But would need to make sure corrections module re-transforms things like sensitivity map
-        #
         # Partial volume correction is very sensitive to the mask, so recreate it
         # if it came from the structural image as this requires accurate ASL->Struc registration
-        if wsp.rois.mask_src == "struc":
-            wsp.rois.mask_orig = wsp.rois.mask
-            wsp.rois.mask = None
-            mask.generate_mask(wsp)
+        graph.add("pvcorr_mask", lambda: _pvcorr_mask(wsp), deps=["redo_reg"],
+                  inputs=["reg.struc2asl", "rois.mask_src"], outputs=["rois.mask"])
+        final_deps.append("pvcorr_mask")
+
+    if wsp.calib is not None:
+        # Calibration M0 depends on the final registration and mask but can be calculated
+        # while PV corrected model fitting is running
+        graph.add("calib_m0", lambda: calib.calculate_m0(wsp), deps=final_deps,
+                  inputs=["calib", "reg.struc2asl", "rois.mask"], outputs=["calibration.m0"])
+        output_deps = ["calib_m0"]
+    else:
+        output_deps = list(final_deps)
 
+    if wsp.pvcorr:
         # Generate PVM and PWM maps for Basil
-        struc.segment(wsp)
-        wsp.structural.wm_pv_asl = reg.struc2asl(wsp, wsp.structural.wm_pv)
-        wsp.structural.gm_pv_asl = reg.struc2asl(wsp, wsp.structural.gm_pv)
-        wsp.basil_options = {"pwm" : wsp.structural.wm_pv_asl, "pgm" : wsp.structural.gm_pv_asl}
-        basil.basil(wsp, output_wsp=wsp.sub("basil_pvcorr"), prefit=False)
-        output_native(wsp.output, wsp.basil_pvcorr)
+        #
+        # FIXME: We could at this point re-apply all corrections derived from structural space?
+        # But would need to make sure corrections module re-transforms things like sensitivity map
+        graph.add("pve_asl", lambda: _pve_asl(wsp), deps=final_deps,
+                  inputs=["structural.gm_pv", "structural.wm_pv", "reg.struc2asl"],
+                  outputs=["structural.gm_pv_asl", "structural.wm_pv_asl"])
+        graph.add("basil_pvcorr", lambda: _basil_pvcorr(wsp), deps=["pve_asl"],
+                  inputs=["asldata", "rois.mask", "structural.gm_pv_asl", "structural.wm_pv_asl"],
+                  outputs=["basil_pvcorr.finalstep"])
+        graph.add("output_native", lambda: output_native(wsp.output, wsp.basil_pvcorr), deps=output_deps + ["basil_pvcorr"],
+                  inputs=["basil_pvcorr.finalstep", "calibration.m0"], outputs=["output.native"])
     else:
-        output_native(wsp.output, wsp.basil)
-
-    output_trans(wsp.output)
+        graph.add("output_native", lambda: output_native(wsp.output, wsp.basil), deps=output_deps,
+                  inputs=["basil.finalstep", "calibration.m0"], outputs=["output.native"])
+
+    trans_deps = ["output_native"]
+    std_deps = []
+    if (wsp.output_mni or wsp.region_analysis) and have_struc and (wsp.reg is None or wsp.reg.std2struc is None):
+        # Structural->standard registration is independent of the ASL data. It is
+        # normally done during preprocessing
+        graph.add("reg_struc2std", lambda: reg.reg_struc2std(wsp),
+                  inputs=["structural.brain"], outputs=["reg.struc2std", "reg.std2struc"])
+        std_deps.append("reg_struc2std")
+
+    if wsp.output_mni and have_struc:
+        # The composite ASL->standard transformation only needs the final registration
+        graph.add("reg_asl2std", lambda: reg.reg_asl2std(wsp), deps=["redo_reg"] + std_deps,
+                  inputs=["reg.asl2struc", "reg.struc2std"], outputs=["reg.asl2std"])
+        trans_deps.append("reg_asl2std")
+
+    if wsp.region_analysis and have_struc and wsp.output_native:
+        graph.add("region_analysis", lambda: region_analysis.region_stats(wsp.output.native, output_images(wsp.output.native)),
+                  deps=["output_native"] + std_deps, inputs=["output.native", "reg.struc2asl", "reg.std2struc"],
+                  outputs=["output.native.region_stats"])
+
+    graph.add("output_trans", lambda: output_trans(wsp.output), deps=trans_deps,
+              inputs=["output.native", "reg.asl2struc", "reg.asl2std"], outputs=["output.struct", "output.std"])
+    return graph
+
+def _pvcorr_mask(wsp):
+    if wsp.rois.mask_src == "struc":
+        wsp.rois.mask_orig = wsp.rois.mask
+        wsp.rois.mask = None
+        mask.generate_mask(wsp)
+
+def _pve_asl(wsp):
+    struc.segment(wsp)
+    wsp.structural.wm_pv_asl = reg.struc2asl(wsp, wsp.structural.wm_pv)
+    wsp.structural.gm_pv_asl = reg.struc2asl(wsp, wsp.structural.gm_pv)
+
+def _basil_pvcorr(wsp):
+    wsp.basil_options = {"pwm" : wsp.structural.wm_pv_asl, "pgm" : wsp.structural.gm_pv_asl}
+    basil.basil(wsp, output_wsp=wsp.sub("basil_pvcorr"), prefit=False)
 
 def redo_reg(wsp, pwi):
     """
@@ -301,7 +425,7 @@ def redo_reg(wsp, pwi):
     wsp.reg.regfrom = Image(new_regfrom, header=pwi.header)
     wsp.reg.asl2struc_initial = wsp.reg.asl2struc
     wsp.reg.struc2asl_initial = wsp.reg.struc2asl
-    reg.reg_asl2struc(wsp, False, True, name="final")
+    reg.reg_asl2struc(wsp, False, True, name="final", output_image=False)
 
 def do_report(wsp):
     """
@@ -386,6 +510,22 @@ def output_native(wsp, basil_wsp, report=None):
 
     output_report(wsp.native, report=report)
         
+def output_images(wsp):
+    """
+    Get 3D output images
+
+    :param wsp: Workspace object containing output
+    :return: Dictionary mapping output name to Image, including standard deviation,
+             variance and calibrated variants where present
+    """
+    outputs = {}
+    for oxasl_name in [item[0] for item in OUTPUT_ITEMS.values()]:
+        for suffix in ("", "_std", "_var", "_calib", "_std_calib", "_var_calib"):
+            img = getattr(wsp, oxasl_name + suffix)
+            if img is not None and img.ndim == 3:
+                outputs[oxasl_name + suffix] = img
+    return outputs
+
 def output_report(wsp, report=None):
     """
     Create report pages from output data
@@ -395,11 +535,11 @@ def output_report(wsp, report=None):
     if report is None:
         report = wsp.report
 
-    roi = wsp.rois.mask.data
-    if wsp.structural.struc is not None:
-        gm = reg.struc2asl(wsp, wsp.structural.gm_pv).data
-        wm = reg.struc2asl(wsp, wsp.structural.wm_pv).data
-    
+    # Statistics for all 3D outputs are calculated in one pass over precomputed tissue ROIs
+    rois = region_analysis.tissue_rois(wsp)
+    wsp.roi_stats = rois.stats_dataframe(output_images(wsp))
+    means = dict([((row["output"], row["roi"]), row["mean"]) for _, row in wsp.roi_stats.iterrows()])
+
     for oxasl_name, multiplier, calibrate, units, normal_gm, normal_wm in OUTPUT_ITEMS.values():
         name = oxasl_name + "_calib"
         img = getattr(wsp, name)
@@ -418,14 +558,13 @@ def output_report(wsp, report=None):
                 page.text("Multiplier for physical units: %f" % multiplier)
 
             page.heading("Metrics", level=1)
-            data = img.data
             table = []
-            table.append(["Mean within mask", "%.4g %s" % (np.mean(data[roi > 0.5]), units), ""])
-            if wsp.structural.struc is not None:
-                table.append(["GM mean", "%.4g %s" % (np.mean(data[gm > 0.5]), units), normal_gm])
-                table.append(["Pure GM mean", "%.4g %s" % (np.mean(data[gm > 0.8]), units), normal_gm])
-                table.append(["WM mean", "%.4g %s" % (np.mean(data[wm > 0.5]), units), normal_wm])
-                table.append(["Pure WM mean", "%.4g %s" % (np.mean(data[wm > 0.9]), units), normal_wm])
+            table.append(["Mean within mask", "%.4g %s" % (means[(name, "mask")], units), ""])
+            if "gm" in rois.rois:
+                table.append(["GM mean", "%.4g %s" % (means[(name, "gm")], units), normal_gm])
+                table.append(["Pure GM mean", "%.4g %s" % (means[(name, "pure_gm")], units), normal_gm])
+                table.append(["WM mean", "%.4g %s" % (means[(name, "wm")], units), normal_wm])
+                table.append(["Pure WM mean", "%.4g %s" % (means[(name, "pure_wm")], units), normal_wm])
             page.table(table, headers=["Metric", "Value", "Typical"])
             
             page.heading("Image", level=1)
@@ -435,19 +574,44 @@ def output_trans(wsp):
     """
     Create transformed output, i.e. in structural and/or standard space
 
-    FIXME std space not implemented yet
+    Outputs are transformed from native space in batches to minimize the number of
+    resampling steps. Standard space output uses a composite ASL->standard space
+    transformation so each output is only interpolated once.
     """
-    if not wsp.output_struc or wsp.reg.asl2struc is None:
+    if wsp.reg.asl2struc is None or not (wsp.output_struc or wsp.output_mni):
         return
 
-    wsp.sub("struct")
+    outputs, masks = {}, {}
     for suffix in ("", "_std", "_var", "_calib", "_std_calib", "_var_calib"):
         for output in ("perfusion", "aCBV", "arrival", "perfusion_wm", "arrival_wm", "modelfit", "mask"):
             native_output = getattr(wsp.native, output + suffix)
             # Don't transform 4D output (e.g. modelfit) - too large!
             if native_output is not None and native_output.ndim == 3:
-                if wsp.reg.asl2struc is not None:
-                    setattr(wsp.struct, output + suffix, reg.asl2struc(wsp, native_output, mask=(output == 'mask')))
+                if output == "mask":
+                    masks[output + suffix] = native_output
+                else:
+                    outputs[output + suffix] = native_output
+
+    spaces = []
+    if wsp.output_struc:
+        wsp.log.write("\nTransforming output into structural space\n")
+        wsp.sub("struct")
+        spaces.append((wsp.struct, wsp.reg.asl2struc, wsp.structural.struc))
+    if wsp.output_mni:
+        wsp.log.write("\nTransforming output into standard space\n")
+        reg.reg_asl2std(wsp)
+        wsp.sub("std")
+        spaces.append((wsp.std, wsp.reg.asl2std, reg.std_ref()))
+
+    for output_wsp, trans, ref in spaces:
+        # Masks are transformed as a separate batch using nearest neighbour interpolation
+        trans_outputs = {}
+        if outputs:
+            trans_outputs.update(reg.transform_batch(wsp, outputs, trans, ref))
+        if masks:
+            trans_outputs.update(reg.transform_batch(wsp, masks, trans, ref, interp="nn", mask=True))
+        for name, img in trans_outputs.items():
+            setattr(output_wsp, name, img)
 
 def do_cleanup(wsp):
     """
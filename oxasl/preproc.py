@@ -5,8 +5,6 @@ from __future__ import print_function
 
 import sys
 
-import scipy
-
 import fsl.wrappers as fsl
 
 from oxasl import Workspace, image
@@ -61,6 +59,7 @@ def preprocess(wsp):
     if wsp.smooth:
         wsp.sigma = round(wsp.fwhm / 2.355, 2)
         wsp.log.write("  - Spatial smoothing with FWHM: %f (sigma=%f)\n" % (wsp.fwhm, wsp.sigma))
+        import scipy.ndimage
         smoothed = scipy.ndimage.gaussian_filter(wsp.asldata_preproc.data, sigma=wsp.sigma)
         wsp.asldata_preproc = wsp.asldata_preproc.derived(smoothed, suffix="_smooth")
 
@@ -12,7 +12,6 @@ import os
 import sys
 import math
 import warnings
-import traceback
 
 import numpy as np
 
@@ -20,8 +19,8 @@ from fsl.data.image import Image
 import fsl.wrappers as fsl
 
 from oxasl import __version__, Workspace, struc, brain
+from oxasl.epi_reg import epi_reg
 from oxasl.options import AslOptionParser, GenericOptions, OptionCategory, IgnorableOptionGroup, load_matrix
-from oxasl.wrappers import epi_reg
 from oxasl.reporting import LightboxImage
 
 def init(wsp):
@@ -43,6 +42,8 @@ def get_regfrom(wsp):
      - ``regfrom`` : User-supplied registration reference image
      - ``asldata`` : Raw ASL data
      - ``calib``   : Calibration image
+     - ``asl_brain_method`` : Brain extraction method for the ASL space reference image,
+                              ``bet`` (default) or ``numpy``
 
     Updated workspace attributes
     ----------------------------
@@ -52,68 +53,111 @@ def get_regfrom(wsp):
     init(wsp)
     if wsp.reg.regfrom is None:
         wsp.log.write("\nGetting the ASL image to use for registration)\n")
+        method = wsp.ifnone("asl_brain_method", "bet")
         if wsp.regfrom is not None:
             wsp.log.write(" - Registration reference image supplied by user\n")
             wsp.reg.regfrom = wsp.regfrom
         elif wsp.asldata.iaf in ("tc", "ct"):
             wsp.log.write(" - Registration reference is mean ASL signal (brain extracted)\n")
-            wsp.reg.regfrom = brain.brain(wsp, wsp.asldata.mean(), thresh=0.2)
+            wsp.reg.regfrom = brain.brain(wsp, wsp.asldata.mean(), thresh=0.2, method=method)
         elif wsp.calib is not None and wsp.calib.sameSpace(wsp.asldata):
             wsp.log.write(" - Registration reference is calibration image (brain extracted)\n")
-            wsp.reg.regfrom = brain.brain(wsp, wsp.calib, thresh=0.2)
+            wsp.reg.regfrom = brain.brain(wsp, wsp.calib, thresh=0.2, method=method)
         else:
             wsp.log.write(" - Registration reference is mean ASL image (brain extracted)\n")
-            wsp.reg.regfrom = brain.brain(wsp, wsp.asldata.mean(), thresh=0.2)
+            wsp.reg.regfrom = brain.brain(wsp, wsp.asldata.mean(), thresh=0.2, method=method)
 
 def get_motion_params(mat):
     """
-    Get motion parameters from a Flirt motion correction matrix
+    Get motion parameters from Flirt motion correction matrices
     
     This is done under the assumption that the matrix may contain
     rotation, translation and possibly minor scaling but no reflection, 
     shear etc. So the output could be incorrect for some extreme
     correction matrices, but this probably indicates an error in the
-    registration process. We wrap the whole thing in a try block so
-    if anything goes horribly wrong it does not at least stop the
-    pipeline running
+    registration process. Invalid matrices generate a warning and default
+    parameters rather than an exception so they do not stop the pipeline
+    running
     
     See http://en.wikipedia.org/wiki/Rotation_matrix for details
     of the rotation calculation.
 
-    :return: magnitude of translation, angle and rotation axis
+    The input matrices are not modified.
+
+    :param mat: Single 4x4 matrix, or stack of matrices with shape (N, 4, 4)
+    :return: magnitude of translation, angle (degrees) and rotation axis. If a stack
+             of matrices is given, these are arrays of shape (N,), (N,) and (N, 3)
     """
-    if tuple(mat.shape) != (4, 4):
+    mats = np.asarray(mat, dtype=np.float64)
+    single = mats.ndim == 2
+    if single:
+        mats = mats[np.newaxis, ...]
+    if mats.ndim != 3 or tuple(mats.shape[1:]) != (4, 4):
         raise ValueError("Not a 4x4 Flirt matrix")
 
-    try:
+    with np.errstate(invalid="ignore", divide="ignore"):
         # Extract scales - last one is the magnitude of the translation
-        scales = np.linalg.norm(mat[:3, :], axis=0)
+        scales = np.linalg.norm(mats[:, :3, :], axis=1)
 
         # Normalise unit vectors by scaling before extracting rotation
-        mat[:, 0] /= scales[0]
-        mat[:, 1] /= scales[1]
-        mat[:, 2] /= scales[2]
-        
+        rot = mats[:, :3, :3] / scales[:, np.newaxis, :3]
+
         # Rotation axis
-        rot_axis = np.array([
-            mat[2, 1] - mat[1, 2],
-            mat[0, 2] - mat[2, 0],
-            mat[1, 0] - mat[0, 1],
-        ], dtype=np.float)
+        rot_axis = np.stack([
+            rot[:, 2, 1] - rot[:, 1, 2],
+            rot[:, 0, 2] - rot[:, 2, 0],
+            rot[:, 1, 0] - rot[:, 0, 1],
+        ], axis=-1)
 
         # Rotation angle - note that we need to check the sign
-        trace = np.trace(mat[:3, :3])
-        costheta = (float(trace)-1) / 2
-        sintheta = math.sqrt(1-costheta*costheta)
-        theta = math.acos(costheta)
-        test_element = rot_axis[1]*rot_axis[0]*(1-costheta) + rot_axis[2]*sintheta
-        if np.abs(test_element - mat[1, 0]) > np.abs(test_element - mat[0, 1]):
-            theta = -theta
-        return scales[-1], math.degrees(theta), rot_axis
-    except:
+        costheta = np.clip((np.trace(rot, axis1=1, axis2=2) - 1) / 2, -1, 1)
+        sintheta = np.sqrt(1 - costheta*costheta)
+        theta = np.arccos(costheta)
+        test_element = rot_axis[:, 1]*rot_axis[:, 0]*(1-costheta) + rot_axis[:, 2]*sintheta
+        flip = np.abs(test_element - rot[:, 1, 0]) > np.abs(test_element - rot[:, 0, 1])
+        theta[flip] = -theta[flip]
+
+    trans = scales[:, -1]
+    angles = np.degrees(theta)
+    bad = ~np.all(np.isfinite(np.column_stack([scales, theta, rot_axis])), axis=1)
+    if np.any(bad):
         warnings.warn("Error extracting motion parameters from transformation matrix - check registration/moco looks OK!")
-        traceback.print_exc()
-        return 1, 0, [0, 0, 1]
+        trans[bad], angles[bad], rot_axis[bad] = 1, 0, [0, 0, 1]
+
+    if single:
+        return trans[0], angles[0], rot_axis[0]
+    return trans, angles, rot_axis
+
+def framewise_displacement(mats, radius=80, centre=None):
+    """
+    Get framewise displacement from a series of motion correction matrices
+
+    This is the RMS deviation between consecutive transformations over a sphere
+    of the given radius (Jenkinson 2002, as calculated by FSL's ``rmsdiff``)
+
+    :param mats: Stack of matrices with shape (N, 4, 4), or (4*N, 4) matrix as used
+                 for motion correction
+    :param radius: Radius of sphere in mm
+    :param centre: Centre of sphere in the coordinates of the matrices, i.e. FLIRT scaled
+                   mm coordinates of the reference image. FLIRT's origin is the corner voxel
+                   so this should normally be the centre of the reference image. If not
+                   specified the origin is used
+    :return: Array of shape (N,) of displacements in mm. The first entry is zero
+    """
+    mats = np.asarray(mats, dtype=np.float64).reshape(-1, 4, 4)
+    fd = np.zeros(mats.shape[0], dtype=np.float64)
+    if mats.shape[0] < 2:
+        return fd
+
+    # Relative transformation between each volume and the previous volume
+    rel = np.matmul(mats[1:], np.linalg.inv(mats[:-1]))
+    diff = rel[:, :3, :3] - np.identity(3)
+    trans = rel[:, :3, 3]
+    if centre is not None:
+        # Translation of the sphere centre, (A-I)c + t
+        trans = trans + np.dot(diff, np.asarray(centre, dtype=np.float64))
+    fd[1:] = np.sqrt(0.2 * radius * radius * np.sum(np.square(diff), axis=(1, 2)) + np.sum(np.square(trans), axis=1))
+    return fd
 
 def reg_asl2calib(wsp):
     """
@@ -128,12 +172,14 @@ def reg_asl2calib(wsp):
         _, wsp.reg.asl2calib = reg_flirt(wsp, wsp.reg.regfrom, wsp.calib)
         wsp.reg.calib2asl = np.linalg.inv(wsp.reg.asl2calib)
 
-def reg_asl2struc(wsp, flirt=True, bbr=False, name="initial"):
+def reg_asl2struc(wsp, flirt=True, bbr=False, name="initial", output_image=True):
     """
     Registration of ASL images to structural image
     
     :param flirt: If provided, sets whether to use FLIRT registration
     :param bbr: If provided, sets whether to use BBR registration
+    :param output_image: If False, ``regto`` is not generated by BBR registration and
+                         any existing ``regto`` image is kept
     
     Required workspace attributes
     -----------------------------
@@ -156,7 +202,9 @@ def reg_asl2struc(wsp, flirt=True, bbr=False, name="initial"):
         if flirt:
             wsp.reg.regto, wsp.reg.asl2struc = reg_flirt(wsp, wsp.reg.regfrom, wsp.structural.brain, wsp.reg.asl2struc)
         if bbr:
-            wsp.reg.regto, wsp.reg.asl2struc = reg_bbr(wsp)
+            regto, wsp.reg.asl2struc = reg_bbr(wsp, output_image=output_image)
+            if regto is not None:
+                wsp.reg.regto = regto
         
         wsp.reg.struc2asl = np.linalg.inv(wsp.reg.asl2struc)
 
@@ -185,6 +233,11 @@ def reg_asl2struc(wsp, flirt=True, bbr=False, name="initial"):
             wm_asl = struc2asl(wsp, wsp.structural.wm_seg, interp="nn")
             page.heading("WM mask aligned with ASL data", level=1)
             page.image("wm_reg_%s" % name, LightboxImage(wm_asl, bgimage=wsp.reg.regfrom))
+            if bbr and wsp.save_report:
+                # Only needed for the report so skip the extra resampling if it will not be written
+                wm_edge_asl = struc2asl(wsp, struc.wm_edge(wsp), interp="nn")
+                page.heading("WM boundary aligned with ASL data", level=1)
+                page.image("wm_edge_reg_%s" % name, LightboxImage(wm_edge_asl, bgimage=wsp.reg.regfrom))
 
 def reg_struc2std(wsp, fnirt=False):
     """
@@ -235,6 +288,92 @@ def reg_struc2std(wsp, fnirt=False):
     else:
         wsp.reg.std2struc = np.linalg.inv(wsp.reg.struc2std)
 
+def reg_asl2std(wsp):
+    """
+    Determine the composite ASL -> standard space transformation
+
+    The ASL->structural and structural->standard transformations are combined
+    so that ASL space images can be transformed into standard space with a
+    single interpolation. If the structural->standard transformation is a
+    warp, the composite warp is generated once using CONVERTWARP and cached.
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``reg.asl2struc`` : ASL->structural transformation matrix
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``reg.asl2std``    : ASL->MNI transformation - either warp image or FLIRT matrix
+    """
+    init(wsp)
+
+    if wsp.reg.asl2std is not None:
+        return
+
+    if wsp.reg.asl2struc is None:
+        raise ValueError("ASL->structural registration has not been performed")
+
+    reg_struc2std(wsp)
+    wsp.log.write(" - Generating composite ASL->standard space transformation\n")
+    if isinstance(wsp.reg.struc2std, Image):
+        wsp.reg.asl2std = fsl.convertwarp(out=fsl.LOAD, ref=std_ref(), premat=wsp.reg.asl2struc, warp1=wsp.reg.struc2std,
+                                          relout=True, log=wsp.fsllog)["out"]
+    else:
+        wsp.reg.asl2std = np.dot(wsp.reg.struc2std, wsp.reg.asl2struc)
+
+def reg_std2asl(wsp):
+    """
+    Determine the composite standard space -> ASL transformation
+
+    This is the inverse of ``reg_asl2std``, used to bring standard space images
+    (e.g. atlases) into ASL space with a single interpolation.
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``reg.struc2asl`` : Structural->ASL transformation matrix
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``reg.std2asl``    : MNI->ASL transformation - either warp image or FLIRT matrix
+    """
+    init(wsp)
+
+    if wsp.reg.std2asl is not None:
+        return
+
+    if wsp.reg.struc2asl is None:
+        raise ValueError("ASL->structural registration has not been performed")
+
+    reg_struc2std(wsp)
+    wsp.log.write(" - Generating composite standard space->ASL transformation\n")
+    if isinstance(wsp.reg.std2struc, Image):
+        wsp.reg.std2asl = fsl.convertwarp(out=fsl.LOAD, ref=wsp.nativeref, warp1=wsp.reg.std2struc, postmat=wsp.reg.struc2asl,
+                                          relout=True, log=wsp.fsllog)["out"]
+    else:
+        wsp.reg.std2asl = np.dot(wsp.reg.struc2asl, wsp.reg.std2struc)
+
+def std_ref():
+    """
+    :return: Standard space reference Image
+    """
+    return Image(os.path.join(os.environ["FSLDIR"], "data/standard/MNI152_T1_2mm_brain"))
+
+def std2asl(wsp, img, **kwargs):
+    """
+    Transform an image from standard space to ASL space
+
+    Keyword arguments are passed to ``transform``
+
+    :param img: Image object in standard space
+    :return: Transformed Image object in native (ASL) space
+    """
+    reg_std2asl(wsp)
+    return transform(wsp, img, wsp.reg.std2asl, wsp.nativeref, **kwargs)
+
 def std2struc(wsp, img, **kwargs):
     """
     Transform an image from standard space to structural space
@@ -245,8 +384,19 @@ def struc2std(wsp, img, **kwargs):
     """
     Transform an image from structural space to standard space
     """
-    ref = Image(os.path.join(os.environ["FSLDIR"], "data/standard/MNI152_T1_2mm_brain"))
-    return transform(wsp, img, wsp.reg.struc2std, ref, **kwargs)
+    return transform(wsp, img, wsp.reg.struc2std, std_ref(), **kwargs)
+
+def asl2std(wsp, img, **kwargs):
+    """
+    Transform an image from ASL space to standard space
+
+    Keyword arguments are passed to ``transform``
+
+    :param img: Image object in native (ASL) space
+    :return: Transformed Image object in standard space
+    """
+    reg_asl2std(wsp)
+    return transform(wsp, img, wsp.reg.asl2std, std_ref(), **kwargs)
 
 def struc2asl(wsp, img, **kwargs):
     """
@@ -326,7 +476,45 @@ def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", padding
         ret = fsl.applywarp(img, ref, out=fsl.LOAD, interp=interp, paddingsize=paddingsize, super=True, superlevel="a", log=wsp.fsllog, **kwargs)["out"]
     if mask:
         # Binarise mask images
-        ret = Image((ret.data > mask_thresh).astype(np.int), header=ret.header)
+        ret = Image((ret.data > mask_thresh).astype(np.int32), header=ret.header)
+    return ret
+
+def transform_batch(wsp, imgs, trans, ref, max_vols=16, **kwargs):
+    """
+    Transform multiple 3D images using the same transformation
+
+    The images are stacked into 4D images of up to ``max_vols`` volumes so only
+    one resampling step is required for each stack rather than one for each image.
+    Images which require different interpolation (e.g. masks) should be
+    transformed in a separate batch.
+
+    Keyword arguments are passed to ``transform``
+
+    :param wsp: Workspace, used for logging only
+    :param imgs: Mapping from name to 3D Image object. All images must have the same shape
+    :param trans: Transformation matrix or warp image
+    :param ref: Reference image
+    :param max_vols: Maximum number of volumes to resample at once. This limits the
+                     memory required when transforming to a high resolution space
+
+    :return: Dictionary mapping name to transformed Image object
+    """
+    names = list(imgs.keys())
+    ret = {}
+    for start in range(0, len(names), max_vols):
+        chunk = names[start:start+max_vols]
+        if len(chunk) == 1:
+            ret[chunk[0]] = transform(wsp, imgs[chunk[0]], trans, ref, **kwargs)
+            continue
+
+        first = imgs[chunk[0]]
+        for name in chunk:
+            if imgs[name].shape != first.shape or imgs[name].ndim != 3:
+                raise ValueError("Batch transformation requires 3D images with the same shape: %s" % name)
+        stacked = Image(np.stack([imgs[name].data for name in chunk], axis=-1), header=first.header)
+        stacked_trans = transform(wsp, stacked, trans, ref, **kwargs)
+        for idx, name in enumerate(chunk):
+            ret[name] = Image(stacked_trans.data[..., idx], header=stacked_trans.header)
     return ret
 
 def reg_flirt(wsp, img, ref, initial_transform=None):
@@ -370,50 +558,137 @@ def reg_flirt(wsp, img, ref, initial_transform=None):
 
     return flirt_result["out"], flirt_result["omat"]
 
-def reg_bbr(wsp):
+def rigid_register(src, ref, max_iter=50, tol=1e-4, sigmas=(2.0, 0.0)):
+    """
+    Rigid body registration of two 3D images on the same voxel grid using NumPy/SciPy
+
+    This is intended for registering the volumes of short multi-volume calibration
+    series where the images have the same contrast and only small movements are
+    expected, and avoids the overhead of running an external registration tool.
+    The sum of squared differences is minimised by Gauss-Newton iteration, first on
+    smoothed images and then at full resolution.
+
+    :param src: 3D Image to register
+    :param ref: 3D reference Image. Must have the same shape and voxel sizes as ``src``
+    :param max_iter: Maximum number of iterations at each level of smoothing
+    :param tol: Convergence tolerance for the change in the transformation parameters
+                (mm or radians)
+    :param sigmas: Sequence of Gaussian smoothing widths in voxels
+    :return: src->ref transformation matrix in scaled voxel (mm) coordinates. Note that
+             unlike FLIRT the x axis is not flipped for images with a neurological
+             voxel ordering, so this is not in general a valid FLIRT matrix
+    """
+    import scipy.ndimage
+    if src.shape != ref.shape or src.ndim != 3:
+        raise ValueError("Rigid body registration requires 3D images with the same shape")
+
+    pixdims = np.array(ref.pixdim[:3], dtype=np.float64)
+    grid = np.indices(ref.shape, dtype=np.float64).reshape(3, -1) * pixdims[:, np.newaxis]
+    centre = np.mean(grid, axis=1)
+    rel_grid = (grid - centre[:, np.newaxis]).T
+
+    # Transformation is from reference coordinates to source coordinates and
+    # is updated by composition with a small rigid body transformation
+    ref2src = np.identity(4)
+    for sigma in sigmas:
+        src_data = scipy.ndimage.gaussian_filter(np.asarray(src.data, dtype=np.float64), sigma)
+        ref_data = scipy.ndimage.gaussian_filter(np.asarray(ref.data, dtype=np.float64), sigma).ravel()
+        for _ in range(max_iter):
+            warped = _resample_rigid(src_data, ref2src, pixdims)
+            resid = ref_data - warped.ravel()
+            grads = np.stack([grad.ravel() for grad in np.gradient(warped, *pixdims)], axis=-1)
+            jac = np.concatenate([grads, np.cross(rel_grid, grads)], axis=1)
+            delta = np.linalg.lstsq(jac, resid, rcond=None)[0]
+            ref2src = np.dot(ref2src, _rigid_matrix(delta, centre))
+            if np.max(np.abs(delta)) < tol:
+                break
+
+    return np.linalg.inv(ref2src)
+
+def motion_correct(img, refvol=None, **kwargs):
+    """
+    Motion correction of a 4D image using in-process rigid body registration
+
+    Each volume is registered to the reference volume using ``rigid_register``
+    and resampled using trilinear interpolation. Keyword arguments are passed
+    to ``rigid_register``.
+
+    :param img: 4D Image
+    :param refvol: Index of reference volume. Defaults to the middle volume as for MCFLIRT
+    :return: Tuple of motion corrected Image, sequence of volume->reference transformation
+             matrices in scaled voxel (mm) coordinates, as returned by ``rigid_register``
+    """
+    if img.ndim != 4:
+        raise ValueError("Motion correction requires a 4D image")
+    nvols = img.shape[3]
+    if refvol is None:
+        refvol = int(nvols / 2)
+
+    pixdims = np.array(img.pixdim[:3], dtype=np.float64)
+    ref = Image(img.data[..., refvol], header=img.header)
+    corrected, mats = np.zeros(img.shape, dtype=np.float32), []
+    for vol in range(nvols):
+        if vol == refvol:
+            mat = np.identity(4)
+            corrected[..., vol] = ref.data
+        else:
+            mat = rigid_register(Image(img.data[..., vol], header=img.header), ref, **kwargs)
+            corrected[..., vol] = _resample_rigid(img.data[..., vol], np.linalg.inv(mat), pixdims)
+        mats.append(mat)
+    return Image(corrected, header=img.header), mats
+
+def _resample_rigid(data, ref2src, pixdims):
     """
-    Perform BBR registration
+    Resample 3D data on its own voxel grid using a transformation in scaled mm coordinates
+    """
+    import scipy.ndimage
+    grid = np.indices(data.shape, dtype=np.float64).reshape(3, -1) * pixdims[:, np.newaxis]
+    coords = (np.dot(ref2src[:3, :3], grid) + ref2src[:3, 3:]) / pixdims[:, np.newaxis]
+    return scipy.ndimage.map_coordinates(data, coords, order=1, mode="nearest").reshape(data.shape)
 
-    :param reg_img: Data to register, e.g. PWI or calibration image. Normally would be brain extracted
-    :param struc_img: Structural image
-    :param struc_brain_img: Brain-extracted structural image
+def _rigid_matrix(params, centre):
+    """
+    Rigid body transformation matrix from translations and a rotation vector about a centre point
+    """
+    trans, rotvec = params[:3], params[3:]
+    theta = np.linalg.norm(rotvec)
+    rot = np.identity(3)
+    if theta > 0:
+        axis = rotvec / theta
+        skew = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+        rot += math.sin(theta) * skew + (1 - math.cos(theta)) * np.dot(skew, skew)
+    mat = np.identity(4)
+    mat[:3, :3] = rot
+    mat[:3, 3] = trans + centre - np.dot(rot, centre)
+    return mat
 
-    Optional keyword arguments:
+def reg_bbr(wsp, output_image=True):
+    """
+    Perform BBR registration of the ASL registration reference image to the structural image
 
-    :param inweight: 
-    :param init: Initial transform matrix
+    This uses ``oxasl.epi_reg`` which runs FLIRT directly using the BBR cost function
+    rather than via the ``epi_reg`` script, so the existing structural segmentation is
+    used and only the transformation matrix is generated unless the registered image
+    is requested.
 
-    Optional keyword arguments for fieldmap distortion correction:
+    :param output_image: If True, return the registration reference image transformed
+                         to structural space
 
-    :param fmap: Fieldmap image
-    :param fmapmag: Fieldmap magnitude image
-    :param fmapmagbrain: Fieldmap magnitude image - brain extracted
-    :param pedir: Phase encoding direction (x, -x, y, -y, z, -z)
-    :param echospacing: Echo spacing
+    Required workspace attributes
+    -----------------------------
 
-    :return Tuple of registered image, transform matrix
+     - ``regfrom``            : Registration reference image in ASL space
+     - ``asl2struc``          : Initial ASL->structural transformation matrix
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``inweight`` : Weighting image for the registration reference image
+
+    :return Tuple of registered image (or None), transform matrix
     """
-    struc.segment(wsp)
-
-    wsp.log.write("  - BBR registration using epi_reg\n")
-    result = epi_reg(epi=wsp.reg.regfrom, t1=wsp.structural.struc, t1brain=wsp.structural.brain, out=fsl.LOAD, wmseg=wsp.structural.wm_seg, init=wsp.reg.asl2struc, inweight=wsp.inweight, log=wsp.fsllog)
-    return result["out.nii.gz"], result["out"]
-
-    #OUTPUT
-    #echo "Saving FINAL output"
-    #if [ -z $finalonly ]; then
-	#cp $outdir/asl2struct.mat $outdir/asl2struct_init.mat # save the initial transformation matrix to allow chekcing if this part failed
-    #fi
-    #cp $tempdir/low2high_final.mat $outdir/asl2struct.mat #the transformation matrix from epi_reg - this overwrites the version from MAIN registration
-    #convert_xfm -omat $outdir/struct2asl.mat -inverse $outdir/asl2struct.mat #often useful to have the inverse transform, so calcuate it
-    #if [ ! -z $fmap ]; then
-	#imcp $tempdir/low2high_final_warp $outdir/asl2struct_warp #the warp from epi_reg
-    #fi
-    #imcp $tempdir/low2high_final $outdir/asl2struct # save the transformed image to check on the registration
-    # 
-    # # copy the edge image from epi_reg output as that is good for visualisation
-    # imcp $wm_seg $outdir/wm_seg
-    #imcp $tempdir/low2high_final_fast_wmedge $outdir/tissedge
+    out, asl2struc, _ = epi_reg(wsp, wsp.reg.regfrom, output_image=output_image)
+    return out, asl2struc
 
 class RegOptions(OptionCategory):
     """
@@ -428,6 +703,7 @@ class RegOptions(OptionCategory):
 
         group = IgnorableOptionGroup(parser, "Registration", ignore=self.ignore)
         group.add_option("--regfrom", help="Registration image (e.g. perfusion weighted image)", type="image")
+        group.add_option("--asl-brain-method", help="Brain extraction method for the ASL space registration image, which also defines the mask if no structural image is given. 'numpy' uses in-process thresholding which is faster for low resolution images", choices=brain.METHODS, default="bet")
         #group.add_option("--omat", help="Output file for transform matrix", default=None)
         #group.add_option("--bbr", dest="do_bbr", help="Include BBR registration step using EPI_REG", action="store_true", default=False)
         #group.add_option("--flirt", dest="do_flirt", help="Include rigid-body registration step using FLIRT", action="store_true", default=True)
@@ -468,7 +744,7 @@ def main():
             parser.print_help()
             sys.exit(1)
 
-        reg_asl2struc(wsp, wsp.do_flirt, wsp.do_bbr)
+        reg_asl2struc(wsp, wsp.do_flirt, wsp.do_bbr, output_image=bool(wsp.output))
         if wsp.output:
             wsp.reg.regto.save(wsp.output)
         if wsp.reg.asl2struc:
@@ -0,0 +1,302 @@
+"""
+Region of interest statistics for output images
+
+A ``RoiStats`` object holds a set of named regions of interest in a given
+image space. Each region is stored as an array of voxel indices which is
+calculated once, so statistics for any number of output images can be
+calculated without re-thresholding or re-transforming the regions:
+
+    rois = RoiStats()
+    rois.add_roi("mask", wsp.rois.mask)
+    rois.add_roi("gm", gm_pv_asl, thresh=0.5)
+    df = rois.stats_dataframe({"perfusion" : wsp.native.perfusion})
+
+Regional statistics over atlas labels are provided by ``LabelStats``. The atlas
+is transformed into native space once and statistics for every label are
+calculated together using ``np.bincount``.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+from __future__ import absolute_import
+
+import collections
+
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import reg
+
+# Percentiles calculated for each region in addition to mean, median and standard deviation
+PERCENTILES = (5, 25, 75, 95)
+
+class RoiStats(object):
+    """
+    Set of regions of interest in a common image space
+    """
+
+    def __init__(self):
+        self.shape = None
+        self.rois = collections.OrderedDict()
+
+    def add_roi(self, name, roi, thresh=0.5):
+        """
+        Add a region of interest
+
+        :param name: Name of the region
+        :param roi: 3D Image or Numpy array. Voxels with values above ``thresh`` are
+                    included in the region, e.g. a partial volume map thresholded
+                    at 0.5 or a binary mask
+        :param thresh: Threshold value
+        """
+        if isinstance(roi, Image):
+            roi = roi.data
+        if self.shape is None:
+            self.shape = roi.shape[:3]
+        elif roi.shape[:3] != self.shape:
+            raise ValueError("ROI %s has shape %s - expected %s" % (name, roi.shape, self.shape))
+        self.rois[name] = np.flatnonzero(np.reshape(roi, -1) > thresh)
+
+    def stats(self, imgs):
+        """
+        Calculate statistics of images within each region
+
+        All images are stacked so that the statistics for each region are
+        calculated for every image at once.
+
+        :param imgs: Mapping from name to 3D Image or Numpy array
+        :return: Sequence of dictionaries, one for each image and region, containing
+                 keys ``output``, ``roi``, ``nvoxels``, ``mean``, ``std``, ``median``
+                 and ``pN`` for each percentile N in ``PERCENTILES``
+        """
+        names = list(imgs.keys())
+        if not names:
+            return []
+
+        stacked = np.empty((len(names), int(np.prod(self.shape))), dtype=np.float32)
+        for idx, name in enumerate(names):
+            data = imgs[name]
+            if isinstance(data, Image):
+                data = data.data
+            if data.shape != self.shape:
+                raise ValueError("Image %s has shape %s - expected %s" % (name, data.shape, self.shape))
+            stacked[idx] = np.reshape(data, -1)
+
+        rows = []
+        for roi_name, voxels in self.rois.items():
+            values = stacked[:, voxels]
+            if values.shape[1] == 0:
+                roi_stats = np.full((len(names), 3 + len(PERCENTILES)), np.nan)
+            else:
+                roi_stats = np.column_stack([
+                    np.mean(values, axis=1),
+                    np.std(values, axis=1),
+                    np.percentile(values, (50,) + PERCENTILES, axis=1).T,
+                ])
+            for idx, name in enumerate(names):
+                row = collections.OrderedDict([
+                    ("output", name),
+                    ("roi", roi_name),
+                    ("nvoxels", values.shape[1]),
+                    ("mean", roi_stats[idx, 0]),
+                    ("std", roi_stats[idx, 1]),
+                    ("median", roi_stats[idx, 2]),
+                ])
+                for pidx, percentile in enumerate(PERCENTILES):
+                    row["p%i" % percentile] = roi_stats[idx, 3 + pidx]
+                rows.append(row)
+        return rows
+
+    def stats_dataframe(self, imgs):
+        """
+        Calculate statistics of images within each region
+
+        :param imgs: Mapping from name to 3D Image or Numpy array
+        :return: pandas DataFrame with one row for each image and region. Columns
+                 are as for the dictionary keys returned by ``stats``
+        """
+        import pandas as pd
+        columns = ["output", "roi", "nvoxels", "mean", "std", "median"] + ["p%i" % percentile for percentile in PERCENTILES]
+        return pd.DataFrame(self.stats(imgs), columns=columns)
+
+def tissue_rois(wsp):
+    """
+    Get standard tissue regions of interest in native ASL space
+
+    The regions are calculated once and cached in the workspace so they can be
+    re-used for every output image.
+
+    :param wsp: Workspace object
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``rois.mask`` : Brain mask in ASL space
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``structural.gm_pv``, ``structural.wm_pv`` : GM and WM partial volume maps in
+       structural space. If provided, GM and WM regions are included
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``structural.gm_pv_asl``, ``structural.wm_pv_asl`` : GM and WM partial volume
+       maps in ASL space, if not already present
+     - ``tissue_rois`` : RoiStats object containing the regions (not saved)
+    """
+    rois = wsp.tissue_rois
+    if rois is not None:
+        return rois
+
+    rois = RoiStats()
+    rois.add_roi("mask", wsp.rois.mask)
+    if wsp.structural.struc is not None:
+        if wsp.structural.gm_pv_asl is None or wsp.structural.wm_pv_asl is None:
+            pves = reg.transform_batch(wsp, {"gm" : wsp.structural.gm_pv, "wm" : wsp.structural.wm_pv},
+                                       wsp.reg.struc2asl, wsp.nativeref)
+            wsp.structural.gm_pv_asl = pves["gm"]
+            wsp.structural.wm_pv_asl = pves["wm"]
+        rois.add_roi("gm", wsp.structural.gm_pv_asl, thresh=0.5)
+        rois.add_roi("pure_gm", wsp.structural.gm_pv_asl, thresh=0.8)
+        rois.add_roi("wm", wsp.structural.wm_pv_asl, thresh=0.5)
+        rois.add_roi("pure_wm", wsp.structural.wm_pv_asl, thresh=0.9)
+    wsp.set_item("tissue_rois", rois, save=False)
+    return rois
+
+class LabelStats(object):
+    """
+    Set of labelled regions defined by an integer label image
+
+    Each voxel belongs to at most one region, identified by a positive label
+    value, so statistics for all regions can be calculated in a single pass
+    over each image.
+    """
+
+    def __init__(self, labels, names=None):
+        """
+        :param labels: 3D Image or Numpy array of integer labels. Voxels with label 0 are
+                       not in any region
+        :param names: Optional mapping from label value to region name. If specified, only
+                      labels in the mapping are included
+        """
+        if isinstance(labels, Image):
+            labels = labels.data
+        self.shape = labels.shape[:3]
+        flat_labels = np.rint(np.reshape(labels, -1)).astype(np.int64)
+        self.voxels = np.flatnonzero(flat_labels > 0)
+        self.labels = flat_labels[self.voxels]
+        self.nlabels = int(self.labels.max()) + 1 if len(self.labels) > 0 else 1
+        if names is None:
+            names = dict([(label, "label_%i" % label) for label in np.unique(self.labels)])
+        self.names = collections.OrderedDict(sorted(names.items()))
+        self.counts = np.bincount(self.labels, minlength=self.nlabels)
+
+    def stats(self, imgs):
+        """
+        Calculate statistics of images within each labelled region
+
+        :param imgs: Mapping from name to 3D Image or Numpy array
+        :return: Sequence of dictionaries, one for each image and region, containing
+                 keys ``output``, ``roi``, ``label``, ``nvoxels``, ``mean`` and ``std``
+        """
+        rows = []
+        for name, data in imgs.items():
+            if isinstance(data, Image):
+                data = data.data
+            if data.shape != self.shape:
+                raise ValueError("Image %s has shape %s - expected %s" % (name, data.shape, self.shape))
+            values = np.reshape(data, -1)[self.voxels].astype(np.float64)
+            sums = np.bincount(self.labels, weights=values, minlength=self.nlabels)
+            sumsq = np.bincount(self.labels, weights=np.square(values), minlength=self.nlabels)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means = sums / self.counts
+                stds = np.sqrt(np.maximum(sumsq / self.counts - np.square(means), 0))
+            for label, roi_name in self.names.items():
+                if label < self.nlabels and self.counts[label] > 0:
+                    nvoxels, mean, std = int(self.counts[label]), means[label], stds[label]
+                else:
+                    nvoxels, mean, std = 0, np.nan, np.nan
+                rows.append(collections.OrderedDict([
+                    ("output", name),
+                    ("roi", roi_name),
+                    ("label", label),
+                    ("nvoxels", nvoxels),
+                    ("mean", mean),
+                    ("std", std),
+                ]))
+        return rows
+
+    def stats_dataframe(self, imgs):
+        """
+        Calculate statistics of images within each labelled region
+
+        :param imgs: Mapping from name to 3D Image or Numpy array
+        :return: pandas DataFrame with one row for each image and region. Columns
+                 are as for the dictionary keys returned by ``stats``
+        """
+        import pandas as pd
+        return pd.DataFrame(self.stats(imgs), columns=["output", "roi", "label", "nvoxels", "mean", "std"])
+
+def atlas_labels(wsp):
+    """
+    Get atlas label image in native ASL space
+
+    The atlas is transformed from standard space using a single nearest neighbour
+    resampling step.
+
+    :param wsp: Workspace object
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``region_analysis_atlas_img`` : Label image in standard space. If not
+       specified, the summary (maximum probability) image of the FSL atlas
+       ``region_analysis_atlas`` is used
+     - ``region_analysis_atlas`` : FSL atlas ID (default: ``harvardoxford-cortical``)
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``atlas_labels`` : Atlas label image in ASL space
+     - ``atlas_names`` : Dictionary mapping label values to region names (not saved)
+    """
+    if wsp.atlas_labels is not None:
+        return wsp.atlas_labels, wsp.atlas_names
+
+    if wsp.region_analysis_atlas_img is not None:
+        wsp.log.write(" - Using user-specified atlas label image: %s\n" % wsp.region_analysis_atlas_img.name)
+        atlas, names = wsp.region_analysis_atlas_img, None
+    else:
+        atlas_id = wsp.ifnone("region_analysis_atlas", "harvardoxford-cortical")
+        wsp.log.write(" - Using FSL atlas: %s\n" % atlas_id)
+        from fsl.data.atlases import AtlasRegistry
+        atlases = AtlasRegistry()
+        atlases.rescanAtlases()
+        atlas = atlases.loadAtlas(atlas_id, loadSummary=True, resolution=2)
+        names = dict([(label.value, label.name) for label in atlas.desc.labels])
+        atlas = Image(atlas.data, header=atlas.header)
+
+    wsp.log.write(" - Transforming atlas labels into ASL space\n")
+    wsp.atlas_labels = reg.std2asl(wsp, atlas, interp="nn")
+    wsp.set_item("atlas_names", names, save=False)
+    return wsp.atlas_labels, names
+
+def region_stats(wsp, outputs):
+    """
+    Calculate statistics of output images in atlas regions
+
+    :param wsp: Workspace object containing native space output
+    :param outputs: Mapping from name to 3D native space output Image
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``region_stats`` : DataFrame containing statistics for each output and region
+    """
+    wsp.log.write("\nCalculating regional statistics\n")
+    labels, names = atlas_labels(wsp)
+    label_stats = LabelStats(labels, names)
+    wsp.log.write(" - %i regions, %i output images\n" % (len(label_stats.names), len(outputs)))
+    wsp.region_stats = label_stats.stats_dataframe(outputs)
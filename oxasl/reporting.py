@@ -36,16 +36,24 @@ import csv
 
 import six
 import numpy as np
-import scipy.ndimage
-
-try:
-    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-    from matplotlib.figure import Figure
-except:
-    Figure = None
 
 from fsl.data.image import Image
 
+def _matplotlib():
+    """
+    Import matplotlib on first use as it is slow to import and not required
+    unless images are being generated
+
+    :return: Tuple of matplotlib Figure and FigureCanvas classes, or (None, None)
+             if matplotlib is not installed
+    """
+    try:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+        from matplotlib.figure import Figure
+        return Figure, FigureCanvas
+    except ImportError:
+        return None, None
+
 class LightboxImage(object):
     """
     A .png image file showing a lightbox view of one or more Image instances
@@ -84,6 +92,7 @@ class LightboxImage(object):
         """
         Write image to a file
         """
+        Figure, FigureCanvas = _matplotlib()
         if Figure is None:
             warnings.warn("matplotlib not installed - cannot generate images")
             return
@@ -135,7 +144,8 @@ class LightboxImage(object):
                         data = np.clip(data, vmin, vmax)
 
                 if self._outline:
-                    data = (data > 0.5).astype(np.int)
+                    import scipy.ndimage
+                    data = (data > 0.5).astype(np.int32)
                     data = data - scipy.ndimage.morphology.binary_erosion(data, structure=np.ones((3, 3)))
 
                 if self._mask:
@@ -175,6 +185,7 @@ class LineGraph(object):
         """
         Write image to a file
         """
+        Figure, FigureCanvas = _matplotlib()
         if Figure is None:
             warnings.warn("matplotlib not installed - cannot generate graphs")
             return
@@ -84,7 +84,7 @@ def init(wsp):
     if wsp.structural.brain is not None and wsp.structural.brain_mask is None:
         # FIXME - for now get the mask by binarising the brain image but gives slightly
         # different results compared to using the mask returned by BET
-        wsp.structural.brain_mask = Image((wsp.structural.brain.data != 0).astype(np.int), header=wsp.structural.struc.header)
+        wsp.structural.brain_mask = Image((wsp.structural.brain.data != 0).astype(np.int32), header=wsp.structural.struc.header)
         
     if wsp.structural.struc is not None:
         segment(wsp)
@@ -129,9 +129,9 @@ def segment(wsp):
         else:
             raise ValueError("No structural data provided - cannot segment")
 
-        wsp.structural.csf_seg = Image((wsp.structural.csf_pv.data > 0.5).astype(np.int), header=wsp.structural.struc.header)
-        wsp.structural.gm_seg = Image((wsp.structural.gm_pv.data > 0.5).astype(np.int), header=wsp.structural.struc.header)
-        wsp.structural.wm_seg = Image((wsp.structural.wm_pv.data > 0.5).astype(np.int), header=wsp.structural.struc.header)
+        wsp.structural.csf_seg = Image((wsp.structural.csf_pv.data > 0.5).astype(np.int32), header=wsp.structural.struc.header)
+        wsp.structural.gm_seg = Image((wsp.structural.gm_pv.data > 0.5).astype(np.int32), header=wsp.structural.struc.header)
+        wsp.structural.wm_seg = Image((wsp.structural.wm_pv.data > 0.5).astype(np.int32), header=wsp.structural.struc.header)
         
         page.heading("Segmentation image", level=1)
         page.text("CSF partial volume")
@@ -140,3 +140,24 @@ def segment(wsp):
         page.image("gm_pv", LightboxImage(wsp.structural.gm_pv, bgimage=wsp.structural.brain))
         page.text("White matter partial volume")
         page.image("wm_pv", LightboxImage(wsp.structural.wm_pv, bgimage=wsp.structural.brain))
+
+def wm_edge(wsp):
+    """
+    Get the white matter boundary of the structural segmentation
+
+    This is the set of white matter voxels which are adjacent to non-white matter
+    voxels, as used by epi_reg to visualise BBR registration. It is calculated once
+    from the white matter segmentation
+
+    Updated workspace attributes
+    ----------------------------
+
+     - ``structural.wm_edge`` : White matter boundary image
+    """
+    import scipy.ndimage
+    segment(wsp)
+    if wsp.structural.wm_edge is None:
+        wm = wsp.structural.wm_seg.data > 0
+        eroded = scipy.ndimage.binary_erosion(wm, structure=scipy.ndimage.generate_binary_structure(3, 1), border_value=1)
+        wsp.structural.wm_edge = Image((wm & ~eroded).astype(np.int32), header=wsp.structural.wm_seg.header)
+    return wsp.structural.wm_edge
@@ -0,0 +1,146 @@
+"""
+Benchmarks for core AslImage and pipeline operations
+
+These use pytest-benchmark and are not collected as part of the normal test
+suite. To run them and store the results in ``.benchmarks/`` so that later
+runs can be compared against them:
+
+    pytest oxasl/test/bench_core.py --benchmark-autosave
+
+To compare the current code against the most recent saved run, failing if
+the mean time of any benchmark has increased by more than 10%:
+
+    pytest oxasl/test/bench_core.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+Saved runs can be listed and compared using ``pytest-benchmark list`` and
+``pytest-benchmark compare``. Each saved run records the commit it was run on.
+
+The synthetic datasets are of typical clinical size (64x64x24 voxels) and
+cover the common acquisition types.
+"""
+import os
+import shutil
+import tempfile
+from six import StringIO
+
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import Workspace, AslImage, calib
+from oxasl.reporting import LightboxImage
+from oxasl.workspace import matrix_to_text, text_to_matrix
+
+pytest.importorskip("pytest_benchmark")
+
+SHAPE = (64, 64, 24)
+
+def _pcasl_single_pld():
+    """ Single-PLD pCASL, 30 tag-control pairs """
+    return AslImage(np.random.rand(*(SHAPE + (60,))), name="pcasl", iaf="tc", order="lrt", plds=[1.8])
+
+def _multi_pld():
+    """ 6-PLD pCASL, 8 repeats of each PLD, blocked by repeats """
+    return AslImage(np.random.rand(*(SHAPE + (96,))), name="multipld", iaf="tc", order="ltr",
+                    plds=[0.25, 0.5, 0.75, 1.0, 1.25, 1.5])
+
+def _variable_rpts():
+    """ 6-PLD pCASL with more repeats at longer PLDs """
+    rpts = [2, 2, 4, 4, 8, 8]
+    return AslImage(np.random.rand(*(SHAPE + (2*sum(rpts),))), name="varrpts", iaf="tc", order="lrt",
+                    plds=[0.25, 0.5, 0.75, 1.0, 1.25, 1.5], rpts=rpts)
+
+def _multiphase():
+    """ Single-PLD multiphase with 8 phases and 6 repeats """
+    return AslImage(np.random.rand(*(SHAPE + (48,))), name="multiphase", iaf="mp", order="lrt",
+                    plds=[1.8], nphases=8)
+
+DIFF_DATASETS = {
+    "pcasl_single_pld" : _pcasl_single_pld,
+    "multi_pld" : _multi_pld,
+    "variable_rpts" : _variable_rpts,
+}
+
+ALL_DATASETS = dict(DIFF_DATASETS, multiphase=_multiphase)
+
+@pytest.fixture(params=sorted(ALL_DATASETS.keys()))
+def asldata(request):
+    return ALL_DATASETS[request.param]()
+
+@pytest.fixture(params=sorted(DIFF_DATASETS.keys()))
+def tcdata(request):
+    return DIFF_DATASETS[request.param]()
+
+@pytest.fixture
+def tempdir():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        yield tempdir
+    finally:
+        shutil.rmtree(tempdir)
+
+def _brain_mask():
+    """ Ellipsoidal brain mask filling most of the image """
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in SHAPE], indexing="ij")
+    return Image((x**2 + y**2 + z**2 < 0.8).astype(np.int32), name="mask")
+
+def test_aslimage_init(benchmark, asldata):
+    benchmark(AslImage, asldata.data, name="asldata", **dict(asldata.metaItems()))
+
+def test_reorder(benchmark, tcdata):
+    benchmark(tcdata.reorder, "rtl")
+
+def test_reorder_multiphase(benchmark):
+    benchmark(_multiphase().reorder, "rtl")
+
+def test_diff(benchmark, tcdata):
+    benchmark(tcdata.diff)
+
+def test_mean_across_repeats(benchmark, asldata):
+    benchmark(asldata.mean_across_repeats, diff=asldata.iaf != "mp")
+
+def test_perf_weighted(benchmark, tcdata):
+    benchmark(tcdata.perf_weighted)
+
+def test_split_epochs(benchmark, tcdata):
+    benchmark(tcdata.split_epochs, 6, overlap=2)
+
+def test_workspace_set_item(benchmark, tempdir):
+    wsp = Workspace(savedir=tempdir, log=StringIO())
+    asldata = _multi_pld()
+    benchmark(wsp.set_item, "asldata", asldata)
+
+def test_workspace_reload(benchmark, tempdir):
+    wsp = Workspace(savedir=tempdir, log=StringIO())
+    wsp.asldata = _multi_pld()
+    benchmark(lambda: wsp.asldata.data)
+
+def _calib_wsp(edgecorr):
+    wsp = Workspace(calib=Image(np.random.rand(*SHAPE) + 1, name="calib"), calib_method="voxelwise",
+                    calib_edgecorr=edgecorr, log=StringIO())
+    wsp.sub("rois")
+    wsp.rois.mask = _brain_mask()
+    return (wsp, Image(np.random.rand(*SHAPE), name="perfusion")), {}
+
+@pytest.mark.parametrize("edgecorr", [False, True])
+def test_calibrate(benchmark, edgecorr):
+    # M0 is cached in the workspace so a new workspace is required for each run
+    benchmark.pedantic(calib.calibrate, setup=lambda: _calib_wsp(edgecorr), rounds=3)
+
+def test_edge_correct(benchmark):
+    mask = _brain_mask()
+    m0 = np.random.rand(*SHAPE) * mask.data
+    benchmark(calib._edge_correct, m0, mask)
+
+def test_lightbox_tofile(benchmark, tempdir):
+    pytest.importorskip("matplotlib")
+    mask = _brain_mask()
+    img = Image(np.random.rand(*SHAPE) * mask.data, name="perfusion")
+    lightbox = LightboxImage(img, mask=mask)
+    benchmark(lightbox.tofile, os.path.join(tempdir, "lightbox.png"))
+
+@pytest.mark.parametrize("shape", [(4, 4), (96, 12)])
+def test_text_to_matrix(benchmark, shape):
+    text = matrix_to_text(np.random.rand(*shape))
+    benchmark(text_to_matrix, text)
@@ -0,0 +1,66 @@
+"""
+End-to-end benchmarks of the oxasl pipeline using stand-in FSL and Fabber tools
+
+The tools are replaced by the fast NumPy implementations in ``mock_fsl`` so the
+benchmarks measure the overhead of oxasl itself (workspace I/O, reordering,
+reporting, etc.) and can be run without FSL. The time spent in the stand-in tools
+and the number of calls to each tool are stored in the ``extra_info`` of each
+benchmark, so changes in the number of tool invocations can be compared
+across commits as well as the run time. See ``bench_core`` for how to store
+and compare results, e.g.:
+
+    pytest oxasl/test/bench_pipeline.py --benchmark-autosave
+"""
+import shutil
+import tempfile
+from six import StringIO
+
+import pytest
+
+from oxasl import Workspace, oxford_asl
+from oxasl.test.mock_fsl import MockBackends, synthetic_subject
+
+pytest.importorskip("pytest_benchmark")
+
+# Pipeline configurations. Options are as set by the oxasl command line tool
+CONFIGS = {
+    "native" : {"struc" : False},
+    "struc" : {"mc" : True, "output_struc" : True},
+    "pvcorr_mni" : {"mc" : True, "output_struc" : True, "output_mni" : True, "pvcorr" : True},
+}
+
+@pytest.fixture
+def tempdir():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        yield tempdir
+    finally:
+        shutil.rmtree(tempdir)
+
+def _pipeline_wsp(tempdir, struc=True, **kwargs):
+    # The input images are saved into the workspace of each round and refer to those
+    # files afterwards, so each round needs its own in-memory input data
+    inputs = synthetic_subject()
+    if not struc:
+        del inputs["struc"]
+    options = dict(calib_method="voxelwise", output_native=True, save_mask=True, save_report=True)
+    options.update(kwargs)
+    options.update(inputs)
+    wsp = Workspace(savedir=tempfile.mkdtemp(dir=tempdir), log=StringIO(), **options)
+    return (wsp,), {}
+
+def _run_pipeline(benchmark, tempdir, rounds, delay=0.0, **kwargs):
+    with MockBackends(delay=delay) as backends:
+        benchmark.pedantic(oxford_asl.oxasl, setup=lambda: _pipeline_wsp(tempdir, **kwargs), rounds=rounds)
+    benchmark.extra_info["tool_time"] = backends.tool_time / rounds
+    benchmark.extra_info["tool_calls"] = dict([(name, count // rounds) for name, count in backends.ncalls.items()])
+
+@pytest.mark.parametrize("config", sorted(CONFIGS.keys()))
+def test_pipeline(benchmark, tempdir, config):
+    _run_pipeline(benchmark, tempdir, rounds=3, **CONFIGS[config])
+
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_pipeline_tool_delay(benchmark, tempdir, nthreads):
+    # Each tool call takes at least 0.5s, so comparing the run time with the serial
+    # run shows how well independent steps are overlapped
+    _run_pipeline(benchmark, tempdir, rounds=1, delay=0.5, nthreads=nthreads, **CONFIGS["pvcorr_mni"])
@@ -0,0 +1,613 @@
+"""
+Stand-in FSL and Fabber backends for offline pipeline benchmarking
+
+``MockBackends`` replaces the FSL tool wrappers and the Fabber wrapper used by
+oxasl with fast, deterministic NumPy implementations so that the complete
+pipeline can be run and profiled without an FSL installation:
+
+    with MockBackends(delay=0.1) as backends:
+        oxford_asl.oxasl(wsp)
+    print(backends.ncalls, backends.tool_time)
+
+The stand-ins are not intended to give meaningful results. They accept the
+same arguments and return outputs of the same type and shape as the real
+tools, so the time spent in oxasl itself (workspace I/O, reordering, reporting)
+can be measured in isolation. An optional delay can be added to each tool call
+to simulate the cost of running the real tool, e.g. to check that independent
+steps run concurrently.
+
+Conventions used by the stand-ins:
+
+ - Transformation matrices map scaled voxel (mm) coordinates, ignoring the
+   left-right flip used by FLIRT for neurological images
+ - Warps are relative displacement fields in mm, defined in the space of the
+   reference image
+ - Registration estimates a translation aligning the intensity-weighted centres
+   of mass of the images
+
+If ``FSLDIR`` is not set, a temporary directory is created containing a synthetic
+MNI152 2mm brain image so that standard space registration can be run.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import importlib
+import collections
+
+import six
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import AslImage
+from oxasl.mvn import MVN
+
+# Tools replaced in fsl.wrappers
+FSL_TOOLS = ("bet", "fast", "flirt", "mcflirt", "applywarp", "applyxfm", "convertwarp",
+             "fnirt", "invwarp", "topup", "applytopup", "fslmaths", "fugue")
+
+# Tools replaced in oxasl.wrappers. Modules which import these by name are also patched
+OXASL_TOOLS = ("fabber", "model_params", "fnirtfileutils")
+
+# Modules which import tools from oxasl.wrappers by name
+OXASL_TOOL_MODULES = ("oxasl.reg", "oxasl.corrections")
+
+# Fabber aslrest model parameters which are inferred for each inclusion option
+ASLREST_PARAMS = (
+    ("inctiss", ("ftiss",)),
+    ("incbat", ("delttiss",)),
+    ("inctau", ("tautiss",)),
+    ("incart", ("fblood", "deltblood")),
+    ("incpc", ("fpc", "deltpc")),
+    ("inct1", ("T_1", "T_1b")),
+    ("incpve", ("fwm", "deltwm")),
+)
+
+class MockBackends(object):
+    """
+    Context manager which replaces FSL and Fabber tools with stand-ins
+
+    Attributes:
+
+      ``calls`` - List of tuples of (tool name, time in seconds) for each tool call made
+    """
+
+    def __init__(self, delay=0.0, delays=None):
+        """
+        :param delay: Synthetic delay in seconds added to each tool call
+        :param delays: Optional mapping from tool name to delay, overriding ``delay``
+                       for specific tools
+        """
+        self.delay = delay
+        self.delays = dict(delays or {})
+        self.calls = []
+        self._lock = threading.Lock()
+        self._saved = []
+        self._fsldir = None
+
+    @property
+    def ncalls(self):
+        """
+        :return: Mapping from tool name to number of times it was called
+        """
+        return collections.Counter([name for name, _ in self.calls])
+
+    @property
+    def tool_time(self):
+        """
+        :return: Total time in seconds spent in tool calls, including synthetic delays
+        """
+        return sum([elapsed for _, elapsed in self.calls])
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        """
+        Replace the FSL and Fabber tools with stand-ins
+        """
+        import fsl.wrappers
+        import oxasl.wrappers
+        modules = [importlib.import_module(name) for name in OXASL_TOOL_MODULES]
+
+        for name in FSL_TOOLS:
+            self._patch(fsl.wrappers, name, self._timed(name, globals()[name]))
+        for name in OXASL_TOOLS:
+            tool = self._timed(name, globals()[name])
+            self._patch(oxasl.wrappers, name, tool)
+            for module in modules:
+                if hasattr(module, name):
+                    self._patch(module, name, tool)
+
+        if "FSLDIR" not in os.environ:
+            self._fsldir = _mock_fsldir()
+            os.environ["FSLDIR"] = self._fsldir
+
+    def uninstall(self):
+        """
+        Restore the original FSL and Fabber tools
+        """
+        for module, name, orig in reversed(self._saved):
+            setattr(module, name, orig)
+        self._saved = []
+
+        if self._fsldir is not None:
+            del os.environ["FSLDIR"]
+            shutil.rmtree(self._fsldir)
+            self._fsldir = None
+
+    def _patch(self, module, name, replacement):
+        self._saved.append((module, name, getattr(module, name)))
+        setattr(module, name, replacement)
+
+    def _timed(self, name, tool):
+        delay = self.delays.get(name, self.delay)
+        def _run(*args, **kwargs):
+            start = time.time()
+            try:
+                if delay > 0:
+                    time.sleep(delay)
+                return tool(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.calls.append((name, time.time() - start))
+        return _run
+
+def _mock_fsldir():
+    """
+    Create a temporary FSLDIR containing a synthetic MNI152 2mm brain
+    """
+    fsldir = tempfile.mkdtemp(prefix="oxasl_mock_fsldir")
+    os.makedirs(os.path.join(fsldir, "data", "standard"))
+    os.makedirs(os.path.join(fsldir, "etc", "flirtsch"))
+    std = Image(synthetic_head((91, 109, 91))["brain"], xform=np.diag([2.0, 2.0, 2.0, 1.0]))
+    std.save(os.path.join(fsldir, "data", "standard", "MNI152_T1_2mm_brain"))
+    return fsldir
+
+def synthetic_head(shape):
+    """
+    Generate a synthetic head image
+
+    The head is an ellipsoid filling most of the image, containing a brain with a
+    grey matter shell, white matter core and CSF filled ventricles.
+
+    :param shape: 3D image shape
+    :return: Mapping from ``struc``, ``brain``, ``csf``, ``gm`` and ``wm`` to Numpy arrays
+             containing the T1 weighted image, brain extracted image and partial volume
+             maps
+    """
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing="ij")
+    radius = np.sqrt(x**2 + y**2 + z**2)
+    ventricles = np.sqrt((x/0.3)**2 + (y/0.5)**2 + (z/0.3)**2)
+
+    # Smooth partial volume transitions, a few voxels wide
+    edge = 4.0 / min(shape)
+    brain = np.clip((0.75 - radius) / edge + 0.5, 0, 1)
+    wm = np.clip((0.55 - radius) / edge + 0.5, 0, 1)
+    csf_vent = np.clip((1 - ventricles) / (2 * edge) + 0.5, 0, 1) * wm
+    wm = wm - csf_vent
+    gm = brain - wm - csf_vent
+    csf = csf_vent + np.clip((0.8 - radius) / edge + 0.5, 0, 1) - brain
+    scalp = np.clip((0.9 - radius) / edge + 0.5, 0, 1) - np.clip((0.8 - radius) / edge + 0.5, 0, 1)
+
+    brain_img = 300*csf + 600*gm + 800*wm
+    return {
+        "struc" : (brain_img + 500*scalp).astype(np.float32),
+        "brain" : brain_img.astype(np.float32),
+        "csf" : csf.astype(np.float32),
+        "gm" : gm.astype(np.float32),
+        "wm" : wm.astype(np.float32),
+    }
+
+def synthetic_subject(asl_shape=(64, 64, 24), struc_shape=(128, 128, 72), plds=(0.25, 0.5, 0.75, 1.0, 1.25, 1.5), rpts=8):
+    """
+    Generate synthetic input data for the oxasl pipeline
+
+    :param asl_shape: 3D shape of ASL and calibration data. Voxel sizes are chosen to
+                      give a field of view of 220x220x120mm
+    :param struc_shape: 3D shape of structural image, with the same field of view
+    :param plds: Sequence of PLDs
+    :param rpts: Number of repeats of each PLD
+    :return: Mapping from ``asldata``, ``calib`` and ``struc`` to input images
+    """
+    fov = np.array([220.0, 220.0, 120.0])
+    asl_xform = np.diag(list(fov / asl_shape) + [1.0])
+    struc_xform = np.diag(list(fov / struc_shape) + [1.0])
+
+    head = synthetic_head(asl_shape)
+    nvols = 2 * len(plds) * rpts
+    rand = np.random.RandomState(0)
+    data = head["brain"][..., np.newaxis] + rand.normal(0, 5, list(asl_shape) + [nvols])
+    # Control images have additional signal in grey matter
+    data[..., 1::2] += 10 * head["gm"][..., np.newaxis]
+    return {
+        "asldata" : AslImage(Image(data.astype(np.float32), xform=asl_xform), name="asldata",
+                             iaf="tc", order="lrt", plds=list(plds)),
+        "calib" : Image(2 * head["brain"] + 100 * (head["brain"] > 0), xform=asl_xform, name="calib"),
+        "struc" : Image(synthetic_head(struc_shape)["struc"], xform=struc_xform, name="struc"),
+    }
+
+def _image(img):
+    if img is None or isinstance(img, Image):
+        return img
+    return Image(img)
+
+def _matrix(mat):
+    if mat is None:
+        return np.identity(4)
+    elif isinstance(mat, np.ndarray):
+        return mat
+    else:
+        return np.loadtxt(mat)
+
+def _pixdims(img):
+    return np.array(img.pixdim[:3], dtype=np.float64)
+
+def _grid_mm(img):
+    """
+    :return: (3, N) array of scaled voxel coordinates of every voxel in an image
+    """
+    grid = np.indices(img.shape[:3], dtype=np.float32).reshape(3, -1)
+    return grid * _pixdims(img)[:, np.newaxis].astype(np.float32)
+
+def _affine(mat, coords):
+    return np.dot(mat[:3, :3], coords) + mat[:3, 3:4]
+
+def _sample(data, coords, order):
+    """
+    Sample 3D data at voxel coordinates
+    """
+    import scipy.ndimage
+    return scipy.ndimage.map_coordinates(data, coords, order=order, mode="constant", cval=0.0)
+
+def _src_coords(ref, premat=None, warp=None, postmat=None):
+    """
+    Get the coordinates in the input image space of each voxel in the reference image
+
+    The forward transformation is input -> premat -> warp -> postmat -> reference
+
+    :return: (3, N) array of scaled voxel coordinates
+    """
+    coords = _affine(np.linalg.inv(_matrix(postmat)), _grid_mm(ref))
+    if warp is not None:
+        warp_vox = coords / _pixdims(warp)[:, np.newaxis]
+        coords = coords + np.array([_sample(warp.data[..., dim], warp_vox, 1) for dim in range(3)])
+    return _affine(np.linalg.inv(_matrix(premat)), coords)
+
+def _resample(img, ref, interp="trilinear", premat=None, **kwargs):
+    """
+    Resample an image onto the voxel grid of a reference image
+
+    :param premat: Transformation matrix, or for 4D images a (4*nvols, 4) array of
+                   one matrix for each volume
+    :param kwargs: ``warp`` and ``postmat`` transformations as for ``_src_coords``
+    """
+    order = 0 if interp in ("nn", "nearestneighbour") else 1
+    data = img.data
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    premat = _matrix(premat)
+    if premat.shape[0] == 4:
+        mats = [premat] * data.shape[3]
+    else:
+        mats = [premat[4*vol:4*vol+4] for vol in range(data.shape[3])]
+
+    out = np.zeros(list(ref.shape[:3]) + [data.shape[3]], dtype=np.float32)
+    coords = None
+    for vol in range(data.shape[3]):
+        if coords is None or mats[vol] is not mats[vol-1]:
+            coords = _src_coords(ref, premat=mats[vol], **kwargs) / _pixdims(img)[:, np.newaxis]
+        out[..., vol] = _sample(data[..., vol], coords, order).reshape(ref.shape[:3])
+    if img.ndim == 3:
+        out = out[..., 0]
+    return Image(out, header=ref.header)
+
+def _com_mm(data):
+    """
+    :return: Intensity-weighted centre of mass in voxel coordinates
+    """
+    weights = np.abs(data)
+    total = np.sum(weights)
+    if total == 0:
+        return (np.array(data.shape[:3], dtype=np.float64) - 1) / 2
+    return np.array([np.sum(weights * idx) for idx in np.indices(data.shape[:3])]) / total
+
+def _com_translation(img_data, img_pixdims, ref_data, ref_pixdims):
+    """
+    :return: Transformation matrix aligning the centre of mass of an image to a reference
+    """
+    mat = np.identity(4)
+    mat[:3, 3] = _com_mm(ref_data) * ref_pixdims - _com_mm(img_data) * img_pixdims
+    return mat
+
+def _displacement(ref, src_coords):
+    """
+    :return: Relative warp image in the space of ``ref`` from input coordinates
+    """
+    disp = (src_coords - _grid_mm(ref)).T.reshape(list(ref.shape[:3]) + [3])
+    return Image(disp.astype(np.float32), header=ref.header)
+
+def bet(input, output=None, fracintensity=0.5, **kwargs):
+    """
+    Brain extraction by thresholding at a robust intensity range and filling holes
+    """
+    import scipy.ndimage
+    img = _image(input)
+    data = img.data
+    lower, upper = np.percentile(data, (2, 98))
+    thresh = lower + 0.2 * fracintensity * (upper - lower)
+    mask = scipy.ndimage.binary_fill_holes(data > thresh).astype(np.int32)
+    return {
+        "output" : Image(data * mask, header=img.header),
+        "output_mask" : Image(mask, header=img.header),
+    }
+
+def fast(imgs, out=None, **kwargs):
+    """
+    Tissue segmentation by linear interpolation between CSF, GM and WM intensities
+    """
+    img = _image(imgs)
+    data = img.data
+    brain = data[data > 0]
+    means = np.percentile(brain, (10, 50, 90)) if brain.size > 0 else np.array([0, 1, 2])
+    pves = np.zeros(list(data.shape[:3]) + [3], dtype=np.float32)
+    for tissue in range(3):
+        weights = 1 - np.abs(np.interp(data, means, [0, 1, 2]) - tissue)
+        pves[..., tissue] = np.clip(weights, 0, 1) * (data > 0)
+    ret = dict([("out_pve_%i" % tissue, Image(pves[..., tissue], header=img.header)) for tissue in range(3)])
+    ret["out_seg"] = Image((np.argmax(pves, axis=-1) + 1) * (data > 0), header=img.header)
+    return ret
+
+def flirt(src, ref, init=None, **kwargs):
+    """
+    Registration by aligning centres of mass, or using the initial transformation
+    if provided
+    """
+    src, ref = _image(src), _image(ref)
+    if init is not None:
+        omat = _matrix(init)
+    else:
+        omat = _com_translation(src.data, _pixdims(src), ref.data, _pixdims(ref))
+    return {"omat" : omat, "out" : _resample(src, ref, premat=omat)}
+
+def mcflirt(infile, reffile=None, **kwargs):
+    """
+    Motion correction by aligning the centre of mass of each volume to the reference
+    """
+    img = _image(infile)
+    data = img.data
+    if reffile is not None:
+        ref_data = _image(reffile).data
+    else:
+        ref_data = data[..., int(data.shape[3] / 2)]
+    pixdims = _pixdims(img)
+    ret = {}
+    out = np.zeros(data.shape, dtype=np.float32)
+    for vol in range(data.shape[3]):
+        mat = _com_translation(data[..., vol], pixdims, ref_data, pixdims)
+        ret["out.mat/MAT_%04i" % vol] = mat
+        out[..., vol] = _resample(Image(data[..., vol], header=img.header), img, premat=mat).data
+    ret["out"] = Image(out, header=img.header)
+    return ret
+
+def applywarp(src, ref, interp="trilinear", premat=None, postmat=None, warp=None, **kwargs):
+    """
+    Apply a transformation matrix and/or warp
+    """
+    return {"out" : _resample(_image(src), _image(ref), interp=interp, premat=premat, warp=_image(warp), postmat=postmat)}
+
+def applyxfm(src, ref, mat, interp="trilinear", **kwargs):
+    """
+    Apply a transformation matrix
+    """
+    return {"out" : _resample(_image(src), _image(ref), interp=interp, premat=mat)}
+
+def convertwarp(out=None, ref=None, warp1=None, premat=None, postmat=None, **kwargs):
+    """
+    Combine transformation matrices and a warp into a single warp
+    """
+    ref = _image(ref)
+    return {"out" : _displacement(ref, _src_coords(ref, premat=premat, warp=_image(warp1), postmat=postmat))}
+
+def fnirt(src, ref=None, aff=None, **kwargs):
+    """
+    Nonlinear registration, returning the affine initialization as a warp
+    """
+    if ref is None:
+        ref = os.path.join(os.environ["FSLDIR"], "data", "standard", "MNI152_T1_2mm_brain")
+    ref = _image(ref)
+    return {"cout" : _displacement(ref, _src_coords(ref, premat=aff))}
+
+def invwarp(warp, ref, **kwargs):
+    """
+    Approximate inversion of a warp by negating the displacements at the nearest voxels
+    """
+    warp, ref = _image(warp), _image(ref)
+    coords = _grid_mm(ref) / _pixdims(warp)[:, np.newaxis]
+    disp = np.array([-_sample(warp.data[..., dim], coords, 0) for dim in range(3)])
+    return {"out" : _displacement(ref, _grid_mm(ref) + disp)}
+
+def topup(imain, datain=None, **kwargs):
+    """
+    Distortion estimation, returning a zero field and no movement
+    """
+    img = _image(imain)
+    nvols = img.shape[3] if img.ndim == 4 else 1
+    zeros = np.zeros(img.shape[:3], dtype=np.float32)
+    return {
+        "out_fieldcoef" : Image(zeros, header=img.header),
+        "out_movpar" : np.zeros((nvols, 6)),
+        "iout" : Image(img.data, header=img.header),
+        "fout" : Image(zeros, header=img.header),
+    }
+
+def fugue(input=None, loadfmap=None, savefmap=None, saveshift=None, dwell=0.0, unwarpdir="y", **kwargs):
+    """
+    Fieldmap processing, returning the fieldmap unchanged and the voxel shift map
+    along the unwarp direction
+    """
+    # pylint: disable=redefined-builtin
+    fmap = _image(loadfmap)
+    ret = {}
+    if savefmap is not None:
+        ret["savefmap"] = Image(fmap.data, header=fmap.header)
+    if saveshift is not None:
+        dim = "xyz".index(unwarpdir[0])
+        sign = -1 if unwarpdir.endswith("-") else 1
+        shift = sign * fmap.data * dwell * fmap.shape[dim] / (2 * np.pi)
+        ret["saveshift"] = Image(shift, header=fmap.header)
+    return ret
+
+def applytopup(imain, **kwargs):
+    """
+    Distortion correction, returning the uncorrected data
+    """
+    img = _image(imain)
+    return {"out" : Image(img.data, header=img.header)}
+
+class fslmaths(object):
+    """
+    Chained image arithmetic, supporting the operations used by oxasl
+    """
+    # pylint: disable=invalid-name
+
+    def __init__(self, img):
+        img = _image(img)
+        self._header = img.header
+        self._data = np.array(img.data, dtype=np.float32)
+
+    def _value(self, other):
+        return _image(other).data if isinstance(other, (Image,) + six.string_types) else other
+
+    def abs(self):
+        self._data = np.abs(self._data)
+        return self
+
+    def bin(self):
+        self._data = (self._data != 0).astype(np.float32)
+        return self
+
+    def thr(self, thresh):
+        self._data[self._data < thresh] = 0
+        return self
+
+    def uthr(self, thresh):
+        self._data[self._data > thresh] = 0
+        return self
+
+    def add(self, other):
+        self._data = self._data + self._value(other)
+        return self
+
+    def sub(self, other):
+        self._data = self._data - self._value(other)
+        return self
+
+    def mul(self, other):
+        self._data = self._data * self._value(other)
+        return self
+
+    def div(self, other):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._data = np.nan_to_num(self._data / self._value(other))
+        return self
+
+    def mas(self, other):
+        self._data[self._value(other) == 0] = 0
+        return self
+
+    def fillh(self):
+        import scipy.ndimage
+        self._data = scipy.ndimage.binary_fill_holes(self._data != 0).astype(np.float32)
+        return self
+
+    def ero(self):
+        import scipy.ndimage
+        self._data[~scipy.ndimage.binary_erosion(self._data != 0, structure=np.ones([3, 3, 3]))] = 0
+        return self
+
+    def dilM(self):
+        import scipy.ndimage
+        self._data = scipy.ndimage.grey_dilation(self._data, size=(3, 3, 3))
+        return self
+
+    def edge(self):
+        gradients = np.gradient(self._data)
+        self._data = np.sqrt(sum([np.square(grad) for grad in gradients]))
+        return self
+
+    def run(self, output=None, **kwargs):
+        return Image(self._data, header=self._header)
+
+def fnirtfileutils(src, out=None, jac=None, **kwargs):
+    """
+    Warp file conversion, returning the warp unchanged and its Jacobian determinant
+    """
+    warp = _image(src)
+    gradients = [np.gradient(warp.data[..., dim], _pixdims(warp)[dim], axis=dim) for dim in range(3)]
+    jacobian = np.ones(warp.shape[:3], dtype=np.float32)
+    for dim, grad in enumerate(gradients):
+        jacobian *= 1 + grad
+    return {"out" : Image(warp.data, header=warp.header), "jac" : Image(jacobian, header=warp.header)}
+
+def model_params(options, **kwargs):
+    """
+    Names of the parameters inferred by the aslrest or satrecov model
+    """
+    if options.get("model", "aslrest") == "satrecov":
+        return ["M0t", "T1t", "A"] + (["g"] if options.get("LFA", None) else [])
+    params = []
+    for option, option_params in ASLREST_PARAMS:
+        if options.get(option, False):
+            params.extend(option_params)
+    return params if params else ["ftiss"]
+
+def fabber(options, output=None, progress_log=None, **kwargs):
+    """
+    Model fitting, estimating parameters from the mean of the data
+
+    Parameter estimates are moved half way towards the new estimates from any initial
+    MVN, so repeated runs initialized from the previous output converge.
+    """
+    data = _image(options["data"])
+    shape = data.shape[:3]
+    mean_data = np.mean(data.data, axis=-1) if data.ndim == 4 else data.data
+    mask = options.get("mask", None)
+    mask = _image(mask).data != 0 if mask is not None else np.ones(shape, dtype=bool)
+
+    paramnames = model_params(options)
+    estimates = {
+        "ftiss" : mean_data, "fwm" : mean_data * 0.4, "fblood" : mean_data * 0.1, "M0t" : mean_data,
+        "delttiss" : options.get("bat", 1.3), "deltwm" : options.get("batwm", 1.6), "deltblood" : options.get("batart", 1.0),
+        "tautiss" : options.get("tau", 1.8), "T_1" : options.get("t1", 1.3), "T_1b" : options.get("t1b", 1.65),
+        "T1t" : options.get("t1", 1.3),
+    }
+    mvn = MVN.new(shape, paramnames, header=data.header, mean=0.0, var=0.1)
+    initmvn = options.get("continue-from-mvn", None)
+    if initmvn is not None:
+        initmvn = MVN(_image(initmvn), paramnames)
+    for param in paramnames:
+        mean = np.zeros(shape, dtype=np.float32) + estimates.get(param, 1.0)
+        if initmvn is not None:
+            mean = (mean + initmvn.mean(param)) / 2
+        mvn.set_mean(param, mean * mask)
+
+    ret = {"paramnames" : paramnames, "finalMVN" : mvn.image(), "logfile" : "Mock Fabber run\n"}
+    for param in paramnames:
+        ret["mean_%s" % param] = Image(mvn.mean(param), header=data.header)
+        ret["std_%s" % param] = Image(np.sqrt(mvn.var(param)) * mask, header=data.header)
+    if data.ndim == 4:
+        ret["modelfit"] = Image(np.repeat(mvn.mean(paramnames[0])[..., np.newaxis], data.shape[3], axis=-1), header=data.header)
+    if options.get("save-free-energy", False):
+        ret["freeEnergy"] = Image(-np.abs(mvn.mean(paramnames[0])) - 1000, header=data.header)
+    if progress_log is not None:
+        progress_log.write("100%")
+    return ret
@@ -446,4 +446,3 @@ def test_pvc():
     })
     options.pop("max-trials")
     _check_step(steps[2], desc_text="spatial")
-
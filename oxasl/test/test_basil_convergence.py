@@ -0,0 +1,66 @@
+"""
+Tests for adaptive convergence of BASIL steps
+"""
+import numpy as np
+
+from oxasl import AslImage, Workspace
+import oxasl.basil as basil
+from oxasl.test.mock_fsl import MockBackends
+
+def test_convergence_policy():
+    """
+    Check adaptive convergence test on free energy change
+    """
+    policy = basil.ConvergencePolicy(200, block_iterations=10, tolerance=1e-3)
+    assert(not policy.converged(None, -1000))
+    assert(not policy.converged(-1000, -990))
+    assert(policy.converged(-1000, -999.5))
+    assert(basil.ConvergencePolicy(5, block_iterations=10).block_iterations == 5)
+
+def test_convergence_policy_defaults():
+    """
+    Check block size is relative to the iteration limit so early stopping is possible
+    """
+    policy = basil.ConvergencePolicy(20)
+    assert(policy.block_iterations == 5)
+    assert(policy.iteration_limit == 40)
+    assert(not policy.finished(5, None, -1000))
+    assert(policy.finished(10, -1000, -999.9))
+    assert(basil.ConvergencePolicy(2).block_iterations == 1)
+
+def test_convergence_policy_extend():
+    """
+    Check iterations continue beyond the nominal limit only while the free energy increases
+    """
+    policy = basil.ConvergencePolicy(20)
+    assert(not policy.finished(15, -1000, -900))
+    assert(not policy.finished(20, -1000, -900))
+    assert(policy.finished(20, -900, -1000))
+    assert(policy.finished(40, -1000, -900))
+
+def test_spatial_adaptive():
+    """
+    Check adaptive convergence is only applied to the spatial step
+    """
+    d = np.random.rand(5, 5, 5, 6)
+    img = AslImage(name="asldata", image=d, tis=[1.5], order="rt")
+    wsp = Workspace(infertiss=True, inferbat=True, spatial=True, adaptive_convergence=True)
+
+    steps = basil.basil_steps(wsp, img)
+    assert(len(steps) == 2)
+    assert(steps[0].policy is None)
+    assert(steps[1].policy.max_iterations == 20)
+
+def test_adaptive_run():
+    """
+    Check a step with a convergence policy stops once the free energy is unchanged
+    """
+    d = np.zeros((5, 5, 5, 6)) + 10
+    img = AslImage(name="asldata", image=d, tis=[1.5], iaf="diff", order="rt")
+    wsp = Workspace(infertiss=True, inferbat=True, spatial=True, adaptive_convergence=True)
+
+    steps = basil.basil_steps(wsp, img)
+    with MockBackends() as backends:
+        ret = steps[1].run(None, log=wsp.log)
+    assert(backends.ncalls["fabber"] == 2)
+    assert(ret["iterations"] == 10)
@@ -0,0 +1,123 @@
+"""
+Tests for epoch-wise BASIL modelling
+
+These use the stand-in Fabber backend so the epoch fitting can be run without
+a Fabber installation
+"""
+import sys
+import types
+import threading
+import importlib
+
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import AslImage, Workspace
+import oxasl.basil as basil
+from oxasl.test.mock_fsl import MockBackends
+
+def _epochs(nepochs, shape=(4, 4, 3)):
+    """
+    :return: List of single-TI epochs with a different signal level in each
+    """
+    epochs = []
+    for idx in range(nepochs):
+        data = np.zeros(list(shape) + [4], dtype=np.float32) + 10 * (idx + 1)
+        epochs.append(AslImage(name="epoch%i" % idx, image=data, tis=[1.5], iaf="diff", order="rt"))
+    return epochs
+
+def _wsp(shape=(4, 4, 3)):
+    wsp = Workspace(infertiss=True, inferbat=True)
+    wsp.rois = Workspace()
+    wsp.rois.mask = Image(np.ones(shape, dtype=np.int32), name="mask")
+    return wsp
+
+def test_step_derived():
+    """
+    Check that derived steps have independent options
+    """
+    d = np.random.rand(5, 5, 5, 6)
+    img = AslImage(name="asldata", image=d, tis=[1.5], order="rt")
+    wsp = Workspace(infertiss=True, inferbat=True)
+
+    steps = basil.basil_steps(wsp, img)
+    derived = steps[0].derived({"max-iterations" : 5})
+    assert(derived.desc == steps[0].desc)
+    assert(derived.options["max-iterations"] == 5)
+    assert(steps[0].options["max-iterations"] == 20)
+    assert(derived.options["ti1"] == 1.5)
+
+def test_epochs_output():
+    """
+    Check parameter timeseries are assembled with one volume per epoch
+    """
+    epochs = _epochs(3)
+    wsp = _wsp()
+    with MockBackends() as backends:
+        basil.basil_epochs(wsp, epochs, nthreads=1, warm_start=False)
+
+    assert(backends.ncalls["fabber"] == 3)
+    for param in ("ftiss", "delttiss"):
+        for prefix in ("mean_", "std_"):
+            img = getattr(wsp.epochs, prefix + param)
+            assert(img.shape == (4, 4, 3, 3))
+    # Without warm start each epoch is fitted independently
+    for idx in range(3):
+        assert(np.allclose(wsp.epochs.mean_ftiss.data[..., idx], 10 * (idx + 1)))
+    assert(len(wsp.epochs.epoch_finalmvn) == 3)
+
+def test_epochs_warm_start():
+    """
+    Check each epoch is initialized from the previous epoch in the same chunk
+    """
+    epochs = _epochs(3)
+    wsp = _wsp()
+    with MockBackends():
+        basil.basil_epochs(wsp, epochs, nthreads=1, warm_start=True)
+
+    # The stand-in Fabber moves estimates half way towards the initial MVN
+    ftiss = wsp.epochs.mean_ftiss.data
+    assert(np.allclose(ftiss[..., 0], 10))
+    assert(np.allclose(ftiss[..., 1], (20 + 10) / 2.0))
+    assert(np.allclose(ftiss[..., 2], (30 + 15) / 2.0))
+
+def test_epochs_chunks():
+    """
+    Check epochs are split into contiguous chunks and warm start does not
+    cross chunk boundaries
+    """
+    epochs = _epochs(4)
+    wsp = _wsp()
+    with MockBackends() as backends:
+        basil.basil_epochs(wsp, epochs, nthreads=2, warm_start=True)
+
+    assert(backends.ncalls["fabber"] == 4)
+    ftiss = wsp.epochs.mean_ftiss.data
+    # Chunks are epochs (1, 2) and (3, 4) so epoch 3 is fitted from scratch
+    assert(np.allclose(ftiss[..., 0], 10))
+    assert(np.allclose(ftiss[..., 1], 15))
+    assert(np.allclose(ftiss[..., 2], 30))
+    assert(np.allclose(ftiss[..., 3], 35))
+
+def test_fabber_instance_per_thread(monkeypatch):
+    """
+    Check Fabber API instances are reused within a thread but not shared between threads
+    """
+    # The package exports the fabber function under the same name as the module
+    fabber_wrapper = importlib.import_module("oxasl.wrappers.fabber")
+
+    module = types.ModuleType("fabber")
+    module.Fabber = type("Fabber", (object,), {"__init__" : lambda self, *dirs: None})
+    monkeypatch.setitem(sys.modules, "fabber", module)
+    monkeypatch.setattr(fabber_wrapper, "_FABBER_INSTANCES", threading.local())
+
+    main = fabber_wrapper._get_fabber()
+    assert fabber_wrapper._get_fabber() is main
+    assert fabber_wrapper._get_fabber("/some/dir") is not main
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(fabber_wrapper._get_fabber()))
+    thread.start()
+    thread.join()
+    assert other[0] is not main
@@ -0,0 +1,69 @@
+"""
+Tests for brain extraction module
+"""
+from six import StringIO
+
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import Workspace, AslImage, brain, reg
+
+def _head(shape=(32, 32, 16)):
+    """
+    Ellipsoidal 'brain' with noisy background
+    """
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing="ij")
+    inside = (x**2 + y**2 + z**2) < 0.6
+    rand = np.random.RandomState(0)
+    data = 100 * inside + rand.normal(0, 2, shape)
+    return data, inside
+
+def test_extract_brain():
+    """
+    Check brain is extracted from a low resolution image
+    """
+    data, inside = _head()
+    brain_img, mask = brain.extract_brain(Image(data))
+    # Closing may add a few voxels at the edge of the brain
+    assert np.all(mask.data[inside] == 1)
+    assert np.count_nonzero(mask.data[~inside]) < 0.01 * np.count_nonzero(inside)
+    assert np.allclose(brain_img.data, data * mask.data)
+
+def test_extract_brain_largest_region():
+    """
+    Check only the largest connected region is kept
+    """
+    data, inside = _head()
+    data[0:2, 0:2, 0:2] = 100
+    _, mask = brain.extract_brain(Image(data))
+    assert np.all(mask.data[0:2, 0:2, 0:2] == 0)
+    assert np.all(mask.data[inside] == 1)
+
+def test_extract_brain_fill_holes():
+    """
+    Check holes in the brain are filled
+    """
+    data, inside = _head()
+    data[14:18, 14:18, 6:10] = 0
+    _, mask = brain.extract_brain(Image(data))
+    assert np.all(mask.data[inside] == 1)
+
+def test_extract_brain_4d():
+    """
+    Check 4D images are rejected
+    """
+    with pytest.raises(ValueError):
+        brain.extract_brain(Image(np.random.rand(5, 5, 5, 2)))
+
+def test_regfrom_numpy():
+    """
+    Check registration reference image can be brain extracted without BET
+    """
+    data, inside = _head()
+    asldata = AslImage(np.repeat(data[..., np.newaxis], 4, axis=-1), tis=[1.5], iaf="tc", order="lrt")
+    wsp = Workspace(asldata=asldata, asl_brain_method="numpy", log=StringIO())
+    reg.get_regfrom(wsp)
+    assert np.all(wsp.reg.regfrom.data[inside] != 0)
+    assert np.count_nonzero(wsp.reg.regfrom.data[~inside]) < 0.05 * np.count_nonzero(inside)
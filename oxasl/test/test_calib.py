@@ -609,3 +609,33 @@ def test_refregion_alpha():
 
     m0_expected =  _expected_m0(np.mean(calib_img.data), 1.0, 50, 0.82, alpha=ALPHA)
     np.testing.assert_allclose(calibrated_d, perf_img.data / m0_expected)
+
+def test_tissue_m0():
+    """
+    Check vectorized PV-weighted M0 matches per-tissue calculation
+    """
+    calib_d = np.random.rand(5, 5, 5)
+    pves = np.random.rand(5, 5, 5, 3)
+    corr = [1.2, 1.5, 0.8]
+    m0, tiss_means = calib.tissue_m0(calib_d, pves, corr)
+    expected = np.zeros(calib_d.shape)
+    for idx, factor in enumerate(corr):
+        tiss_m0 = calib_d * factor
+        assert tiss_means[idx] == pytest.approx(np.average(tiss_m0, weights=pves[..., idx]), rel=1e-5)
+        expected += tiss_m0 * pves[..., idx]
+    assert np.allclose(m0, expected, rtol=1e-5)
+
+def test_refregion_voxels():
+    """
+    Check reference region voxel indices select the same voxels as the mask
+    """
+    refmask = np.zeros((5, 6, 7), dtype=int)
+    refmask[1:3, 2:5, 4] = 1
+    refmask[4, 0, 0] = 1
+    refvoxels = calib.refregion_voxels(refmask)
+    assert len(refvoxels[0]) == np.count_nonzero(refmask)
+
+    # Should index 3D and 4D images in any memory layout
+    data = np.asfortranarray(np.random.rand(5, 6, 7, 3))
+    assert np.allclose(data[refvoxels], data[refmask != 0])
+    assert np.allclose(data[..., 0][refvoxels], data[..., 0][refmask != 0])
@@ -0,0 +1,220 @@
+"""
+Tests for corrections module
+"""
+import os
+from six import StringIO
+
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import corrections, AslImage, Workspace
+from oxasl.test.mock_fsl import MockBackends
+
+def test_dvars():
+    """
+    Check DVARS is the RMS difference between consecutive volumes
+    """
+    data = np.random.rand(5, 5, 5, 6)
+    dvars = corrections.dvars(Image(data))
+    assert dvars.shape == (6,)
+    assert dvars[0] == 0
+    for vol in range(1, 6):
+        assert np.isclose(dvars[vol], np.sqrt(np.mean(np.square(data[..., vol] - data[..., vol-1]))))
+
+def test_dvars_mask():
+    """
+    Check DVARS only includes voxels within the mask
+    """
+    data = np.zeros((5, 5, 5, 3))
+    data[0, ..., 1] = 100
+    data[1:, ..., 2] = 2
+    mask = np.zeros((5, 5, 5), dtype=int)
+    mask[1:] = 1
+    dvars = corrections.dvars(data, mask=Image(mask))
+    assert np.allclose(dvars, [0, 0, 2])
+
+def _pairs_data(ntis=2, rpts=6, order="ltr"):
+    """
+    TC data with a constant difference signal at each TI and a corrupted pair
+    """
+    data = np.random.RandomState(0).normal(100, 1, size=(5, 5, 5, 2*ntis*rpts))
+    asldata = AslImage(data, tis=[1.0 + ti for ti in range(ntis)], iaf="tc", order=order)
+    label_idx, ti_idx, rpt_idx = asldata.vol_indices()
+    data[..., label_idx == 0] -= 5
+    # Corrupt the label image of the 3rd repeat at the first TI
+    corrupt = np.flatnonzero((label_idx == 0) & (ti_idx == 0) & (rpt_idx == 2))
+    data[..., corrupt] += 50
+    return AslImage(data, tis=[1.0 + ti for ti in range(ntis)], iaf="tc", order=order), corrupt
+
+def test_outlier_pairs_signal():
+    """
+    Check a pair with corrupted signal is rejected and remaining volumes are grouped by TI
+    """
+    for order in ("ltr", "lrt", "trl"):
+        asldata, corrupt = _pairs_data(order=order)
+        keep_vols, rpts, scores = corrections.outlier_pairs(asldata)
+        assert rpts == [5, 6]
+        assert len(keep_vols) == 22
+        assert corrupt[0] not in keep_vols
+        assert scores.shape == (12, 4)
+        assert np.sum(scores[:, 3]) == 1
+
+        # Remaining data can be used to create a variable repeat AslImage
+        kept = asldata.derived(asldata.data[..., keep_vols], order="lrt", rpts=rpts)
+        assert kept.rpts == [5, 6]
+        assert np.allclose(kept.diff().data.mean(), 5, atol=0.5)
+
+def test_outlier_pairs_per_ti():
+    """
+    Check Z-scores are calculated separately at each TI when the noise level differs
+    """
+    asldata, corrupt = _pairs_data(ntis=2, rpts=8)
+    label_idx, ti_idx, _ = asldata.vol_indices()
+    data = np.array(asldata.data)
+    # Much noisier data at the second TI and a smaller corruption at the first TI
+    data[..., ti_idx == 1] += np.random.RandomState(1).normal(0, 20, size=data[..., ti_idx == 1].shape)
+    data[..., corrupt] -= 40
+    asldata = asldata.derived(data)
+    keep_vols, rpts, scores = corrections.outlier_pairs(asldata)
+    assert corrupt[0] not in keep_vols
+    assert rpts == [7, 8]
+
+def test_outlier_pairs_motion():
+    """
+    Check pairs are rejected on framewise displacement
+    """
+    asldata, _ = _pairs_data(ntis=1, rpts=4)
+    asldata = asldata.derived(np.random.normal(100, 1, size=asldata.shape))
+    fd = np.zeros(8)
+    fd[5] = 2.0
+    keep_vols, rpts, scores = corrections.outlier_pairs(asldata, fd=fd, z_thresh=100)
+    assert rpts == [3]
+    assert list(keep_vols) == [0, 1, 2, 3, 6, 7]
+    assert scores[2, 2] == 2.0
+
+def test_outlier_pairs_keep_one():
+    """
+    Check at least one pair is kept at each TI
+    """
+    asldata, _ = _pairs_data(ntis=2, rpts=2)
+    keep_vols, rpts, _ = corrections.outlier_pairs(asldata, fd=np.ones(8), fd_thresh=0.5)
+    assert rpts == [1, 1]
+    assert len(keep_vols) == 4
+
+def test_outlier_rejection():
+    """
+    Check outlier rejection records the rejected pairs and DVARS of the data
+    """
+    asldata, corrupt = _pairs_data()
+    wsp = Workspace(outlier_rejection=True, log=StringIO())
+    wsp.sub("corrected")
+    wsp.corrected.asldata = asldata
+    corrections.get_outlier_rejection(wsp)
+    assert wsp.outliers.rpts == [5, 6]
+    assert corrupt[0] not in wsp.outliers.keep_vols
+    assert wsp.outliers.dvars.shape == (24,)
+    assert np.argmax(wsp.outliers.dvars) in (corrupt[0], corrupt[0] + 1)
+
+def test_apply_topup():
+    """
+    Check TOPUP output is saved for applytopup and calibration images are corrected together
+    """
+    data = np.random.rand(5, 5, 5, 8)
+    asldata = AslImage(data, tis=[1.5], iaf="tc", order="lrt")
+    calib, cref, cblip = [Image(np.random.rand(5, 5, 5)) for _ in range(3)]
+    wsp = Workspace(asldata=asldata, calib=calib, cref=cref, cblip=cblip, pedir="y", echospacing=0.001,
+                    topup_threads=3, log=StringIO())
+    with MockBackends() as backends:
+        corrections.get_cblip_correction(wsp)
+        assert os.path.exists(os.path.join(wsp.topup.savedir, "topup_fieldcoef.nii.gz"))
+        assert np.allclose(np.loadtxt(os.path.join(wsp.topup.savedir, "topup_movpar.txt")), wsp.topup.movpar)
+
+        wsp.sub("corrected")
+        wsp.corrected.asldata, wsp.corrected.calib, wsp.corrected.cref, wsp.corrected.cblip = asldata, calib, cref, cblip
+        corrections.apply_topup(wsp)
+
+    # One call for calib/cref, one for cblip and one for each block of ASL volumes
+    assert backends.ncalls["applytopup"] == 5
+    assert np.allclose(wsp.corrected.asldata.data, data)
+    assert wsp.corrected.asldata.iaf == "tc"
+    for name, img in (("calib", calib), ("cref", cref), ("cblip", cblip)):
+        assert np.allclose(getattr(wsp.corrected, name).data, img.data)
+
+def test_topup_warp():
+    """
+    Check TOPUP field is converted to a displacement along the phase encoding direction
+    """
+    wsp = Workspace(log=StringIO())
+    wsp.sub("topup")
+    wsp.topup.fout = Image(np.full((5, 5, 5), 10.0), xform=np.diag([-2.0, 3.0, 4.0, 1.0]))
+    wsp.topup.params = np.array([[0, 1, 0, 0.05], [0, -1, 0, 0.05]])
+    wsp.nativeref = wsp.topup.fout
+    with MockBackends():
+        warp = corrections.topup_warp(wsp)
+        warp_blip = corrections.topup_warp(wsp, index=2)
+    assert warp.shape == (5, 5, 5, 3)
+    assert np.allclose(warp.data[..., 0], 0)
+    assert np.allclose(warp.data[..., 1], 1.5)
+    assert np.allclose(warp.data[..., 2], 0)
+    assert np.allclose(warp_blip.data, -warp.data)
+
+def test_apply_corrections_topup_combined():
+    """
+    Check TOPUP correction is included in the combined transformation
+    """
+    asldata = AslImage(np.random.rand(5, 5, 5, 8), tis=[1.5], iaf="tc", order="lrt")
+    calib, cblip = [Image(np.random.rand(5, 5, 5)) for _ in range(2)]
+    wsp = Workspace(asldata=asldata, calib=calib, cblip=cblip, pedir="y", echospacing=0.001,
+                    topup_combined=True, log=StringIO())
+    with MockBackends() as backends:
+        corrections.get_cblip_correction(wsp)
+        wsp.sub("reg")
+        wsp.reg.calib2asl = np.identity(4)
+        corrections.apply_corrections(wsp)
+    assert "applytopup" not in backends.ncalls
+    assert wsp.corrected.total_warp.shape == (5, 5, 5, 3)
+    assert wsp.corrected.jacobian.shape == (5, 5, 5)
+    assert wsp.corrected.asldata.shape == (5, 5, 5, 8)
+    assert wsp.corrected.cblip.shape == (5, 5, 5)
+
+def test_apply_corrections_jacobian():
+    """
+    Check the combined warp Jacobian is used to correct for local volume scaling
+    """
+    asldata = AslImage(np.ones((5, 5, 5, 8)), tis=[1.5], iaf="tc", order="lrt")
+    wsp = Workspace(asldata=asldata, log=StringIO())
+    wsp.sub("fieldmap")
+    # Displacement along the y axis increasing linearly with y so the volume is locally scaled
+    disp = np.zeros((5, 5, 5, 3))
+    disp[..., 1] = 0.1 * np.arange(5)[np.newaxis, :, np.newaxis]
+    wsp.fieldmap.warp = Image(disp)
+    with MockBackends() as backends:
+        corrections.apply_corrections(wsp)
+    assert backends.ncalls["convertwarp"] == 1
+    assert np.allclose(wsp.corrected.jacobian.data, 1.1)
+    assert np.allclose(wsp.corrected.asldata.data[:, 1:4, ...], 1.1)
+
+def test_single_volume_cached():
+    """
+    Check multi-volume images are only pre-processed once and small series do not use MCFLIRT
+    if in-process motion correction is enabled
+    """
+    wsp = Workspace(inprocess_moco=True, log=StringIO())
+    small, large = Image(np.random.rand(5, 5, 5, 4)), Image(np.random.rand(5, 5, 5, corrections.INPROCESS_MOCO_MAX_VOLS + 2))
+    with MockBackends() as backends:
+        for img in (small, large):
+            result = corrections.single_volume(wsp, img)
+            assert result.shape == (5, 5, 5)
+            assert corrections.single_volume(wsp, img) is result
+            assert corrections.single_volume(wsp, img, moco=False) is not result
+    assert backends.ncalls["mcflirt"] == 1
+
+def test_single_volume_mcflirt():
+    """
+    Check MCFLIRT is used for small series by default
+    """
+    wsp = Workspace(log=StringIO())
+    with MockBackends() as backends:
+        corrections.single_volume(wsp, Image(np.random.rand(5, 5, 5, 4)))
+    assert backends.ncalls["mcflirt"] == 1
@@ -0,0 +1,80 @@
+"""
+Tests for EPI registration module
+"""
+from six import StringIO
+
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import Workspace
+from oxasl.epi_reg import epi_reg
+from oxasl.test.mock_fsl import MockBackends, synthetic_head
+
+def _fmap_wsp(**kwargs):
+    head = synthetic_head((20, 20, 20))
+    fmap = np.zeros((10, 10, 10))
+    fmap[2:8, 2:8, 2:8] = 10
+    wsp = Workspace(fmap=Image(fmap, xform=np.diag([2.0, 2.0, 2.0, 1.0])),
+                    fmapmag=Image(head["struc"][::2, ::2, ::2], xform=np.diag([2.0, 2.0, 2.0, 1.0])),
+                    fmapmagbrain=Image(head["brain"][::2, ::2, ::2], xform=np.diag([2.0, 2.0, 2.0, 1.0])),
+                    pedir="y", echospacing=0.0005, log=StringIO(), **kwargs)
+    wsp.sub("structural")
+    wsp.structural.struc = Image(head["struc"])
+    wsp.structural.brain = Image(head["brain"])
+    epi_img = Image(head["brain"][::2, ::2, ::2], xform=np.diag([2.0, 2.0, 2.0, 1.0]))
+    return wsp, epi_img
+
+def test_epi_reg_no_fmap():
+    """
+    Check BBR registration without fieldmap only returns the matrix unless the image is requested
+    """
+    wsp, epi_img = _fmap_wsp()
+    with MockBackends() as backends:
+        out, epi2struc, warp = epi_reg(wsp, epi_img, init=np.identity(4))
+        assert out is None and warp is None
+        assert epi2struc.shape == (4, 4)
+        out, _, _ = epi_reg(wsp, epi_img, init=np.identity(4), output_image=True)
+        assert out.shape == (20, 20, 20)
+    assert backends.ncalls["fast"] == 1
+    assert "fugue" not in backends.ncalls
+
+def test_epi_reg_fmap():
+    """
+    Check fieldmap intermediate images are calculated once and reused
+    """
+    wsp, epi_img = _fmap_wsp()
+    with MockBackends() as backends:
+        out, epi2struc, warp = epi_reg(wsp, epi_img, use_fmap=True, init=np.identity(4), output_image=True)
+        assert out.shape == (20, 20, 20)
+        assert warp.shape == (20, 20, 20, 3)
+        assert epi2struc.shape == (4, 4)
+        assert wsp.reg.fmap_struc.shape == (20, 20, 20)
+        assert wsp.reg.fmap_unmasked.shape == (10, 10, 10)
+        ncalls = dict(backends.ncalls)
+        epi_reg(wsp, epi_img, use_fmap=True, init=epi2struc)
+    # Second run only needs BBR, the fieldmap transformation to EPI space and the warp
+    assert backends.ncalls["flirt"] == ncalls["flirt"] + 1
+    assert backends.ncalls["fugue"] == ncalls["fugue"] + 1
+    assert backends.ncalls["fast"] == 1
+
+def test_epi_reg_nofmapreg():
+    """
+    Check fieldmap registration is skipped if fieldmap is already in structural space
+    """
+    wsp, epi_img = _fmap_wsp(nofmapreg=True)
+    with MockBackends() as backends:
+        epi_reg(wsp, epi_img, use_fmap=True, init=np.identity(4))
+    assert np.allclose(wsp.reg.fmap2struc, np.identity(4))
+    assert backends.ncalls["flirt"] == 1
+
+def test_epi_reg_bad_pedir():
+    """
+    Check invalid phase encode direction is rejected
+    """
+    wsp, epi_img = _fmap_wsp()
+    wsp.pedir = "a"
+    with MockBackends():
+        with pytest.raises(ValueError):
+            epi_reg(wsp, epi_img, use_fmap=True, init=np.identity(4))
@@ -0,0 +1,172 @@
+"""
+Tests for step graph module
+"""
+import threading
+import time
+
+import pytest
+import yaml
+
+from oxasl import Workspace
+from oxasl.graph import StepGraph
+from oxasl.oxford_asl import modelling_graph, preproc_graph
+
+def test_sequential_order():
+    """
+    Check steps run in the order added when run sequentially
+    """
+    order = []
+    graph = StepGraph("test")
+    graph.add("a", lambda: order.append("a"))
+    graph.add("b", lambda: order.append("b"), deps=["a"])
+    graph.add("c", lambda: order.append("c"))
+    graph.run()
+    assert order == ["a", "b", "c"]
+
+def test_unknown_dep():
+    """
+    Check steps cannot depend on steps not yet in the graph
+    """
+    graph = StepGraph("test")
+    with pytest.raises(ValueError):
+        graph.add("b", lambda: None, deps=["a"])
+
+def test_duplicate_name():
+    """
+    Check step names must be unique
+    """
+    graph = StepGraph("test")
+    graph.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add("a", lambda: None)
+
+def test_concurrent():
+    """
+    Check independent steps run concurrently and dependencies are respected
+    """
+    started = threading.Event()
+    order = []
+    def _slow():
+        # Will time out unless the independent step runs at the same time
+        assert started.wait(5)
+        order.append("slow")
+
+    def _fast():
+        started.set()
+        order.append("fast")
+
+    graph = StepGraph("test")
+    graph.add("slow", _slow)
+    graph.add("fast", _fast)
+    graph.add("last", lambda: order.append("last"), deps=["slow", "fast"])
+    graph.run(nthreads=2)
+    assert order == ["fast", "slow", "last"]
+
+def test_failure():
+    """
+    Check an exception in a step is raised and dependent steps are not run
+    """
+    order = []
+    def _fail():
+        time.sleep(0.1)
+        raise RuntimeError("wibble")
+
+    graph = StepGraph("test")
+    graph.add("fail", _fail)
+    graph.add("ok", lambda: order.append("ok"))
+    graph.add("after", lambda: order.append("after"), deps=["fail"])
+    with pytest.raises(RuntimeError):
+        graph.run(nthreads=2)
+    assert order == ["ok"]
+
+def test_serialize():
+    """
+    Check graph can be serialized
+    """
+    graph = StepGraph("test")
+    graph.add("a", lambda: None, outputs=["x"], desc="First step")
+    graph.add("b", lambda: None, deps=["a"], inputs=["x"])
+    graph_dict = yaml.safe_load(graph.to_yaml())
+    assert graph_dict["name"] == "test"
+    assert graph_dict["steps"][0] == {"name" : "a", "deps" : [], "inputs" : [], "outputs" : ["x"], "desc" : "First step"}
+    assert graph_dict["steps"][1] == {"name" : "b", "deps" : ["a"], "inputs" : ["x"], "outputs" : []}
+
+def test_modelling_graph_pvcorr():
+    """
+    Check dependencies of modelling steps with partial volume correction
+    """
+    wsp = Workspace(pvcorr=True, calib="calib.nii.gz")
+    wsp.sub("structural")
+    wsp.structural.struc = "struc.nii.gz"
+    graph = modelling_graph(wsp)
+    assert graph.names() == ["basil_prefit", "basil", "redo_reg", "pvcorr_mask", "calib_m0",
+                             "pve_asl", "basil_pvcorr", "output_native", "output_trans"]
+    assert graph.step("basil_pvcorr").deps == ["pve_asl"]
+    assert set(graph.step("pve_asl").deps) == set(["redo_reg", "pvcorr_mask"])
+    assert set(graph.step("output_native").deps) == set(["calib_m0", "basil_pvcorr"])
+
+def test_modelling_graph_nostruc():
+    """
+    Check modelling steps without structural or calibration data
+    """
+    wsp = Workspace()
+    wsp.sub("structural")
+    graph = modelling_graph(wsp)
+    assert graph.names() == ["basil_prefit", "basil", "redo_reg", "output_native", "output_trans"]
+    assert graph.step("output_native").deps == ["redo_reg"]
+
+def test_modelling_graph_mni():
+    """
+    Check standard space registration steps are added for MNI output
+    """
+    wsp = Workspace(output_mni=True)
+    wsp.sub("structural")
+    wsp.structural.struc = "struc.nii.gz"
+    graph = modelling_graph(wsp)
+    assert graph.step("reg_struc2std").deps == []
+    assert set(graph.step("reg_asl2std").deps) == set(["redo_reg", "reg_struc2std"])
+    assert set(graph.step("output_trans").deps) == set(["output_native", "reg_asl2std"])
+
+def test_modelling_graph_region_analysis():
+    """
+    Check region analysis step depends on native output and standard space registration
+    """
+    wsp = Workspace(region_analysis=True, output_native=True)
+    wsp.sub("structural")
+    wsp.structural.struc = "struc.nii.gz"
+    graph = modelling_graph(wsp)
+    assert "reg_asl2std" not in graph
+    assert set(graph.step("region_analysis").deps) == set(["output_native", "reg_struc2std"])
+
+def test_preproc_graph():
+    """
+    Check structural preprocessing is independent of ASL preprocessing until registration
+    """
+    wsp = Workspace(struc="struc.nii.gz")
+    graph = preproc_graph(wsp)
+    assert graph.names() == ["report_asl", "struc_init", "calib_preproc", "moco", "apply_moco", "outliers",
+                             "reg_asl2calib", "reg_asl2struc", "distcorr", "apply_corrections", "mask"]
+    assert graph.step("struc_init").deps == []
+    assert graph.step("calib_preproc").deps == []
+    assert graph.step("moco").deps == ["calib_preproc"]
+    assert set(graph.step("reg_asl2struc").deps) == set(["struc_init", "reg_asl2calib"])
+    assert set(graph.step("distcorr").deps) == set(["reg_asl2struc", "outliers"])
+
+def test_preproc_graph_struc2std():
+    """
+    Check structural->standard registration is run during preprocessing if required
+    and is not repeated in the modelling graph
+    """
+    wsp = Workspace(struc="struc.nii.gz", output_mni=True)
+    graph = preproc_graph(wsp)
+    assert graph.step("reg_struc2std").deps == ["struc_init"]
+    assert "structural.wm_seg" in graph.step("struc_init").outputs
+    assert "segment" not in graph
+
+    wsp.sub("structural")
+    wsp.structural.struc = "struc.nii.gz"
+    wsp.sub("reg")
+    wsp.reg.std2struc = "std2struc.nii.gz"
+    graph = modelling_graph(wsp)
+    assert "reg_struc2std" not in graph
+    assert graph.step("reg_asl2std").deps == ["redo_reg"]
@@ -573,6 +573,70 @@ def test_split_epochs_reorder_overlap():
         for z in range(data.shape[3]):
             assert np.all(data[..., z] == idx+0.5+4*z)
 
+def test_split_epochs_partial_tis():
+    d = np.zeros([5, 5, 5, 8])
+    for z in range(8): d[..., z] = z
+    img = AslImage(name="asldata", image=d, plds=[1, 2], taus=[0.5, 0.7], casl=True, order='rt')
+    imgs = img.split_epochs(3)
+    assert len(imgs) == 3
+    # TIs 11112222 - epochs are 111, 122, 22
+    assert [epoch.plds for epoch in imgs] == [[1], [1, 2], [2]]
+    assert [epoch.taus for epoch in imgs] == [[0.5], [0.5, 0.7], [0.7]]
+    assert all([epoch.have_plds for epoch in imgs])
+    assert imgs[0].name == "asldata_epoch0_mean"
+    assert np.allclose(imgs[0].data, 1)
+    assert np.allclose(imgs[1].data[..., 0], 3)
+    assert np.allclose(imgs[1].data[..., 1], 4.5)
+    assert np.allclose(imgs[2].data, 6.5)
+
+def test_split_epochs_var_rpts():
+    d = np.random.rand(5, 5, 5, 7)
+    img = AslImage(name="asldata", image=d, tis=[1, 2], rpts=[3, 4], order='rt')
+    imgs = img.split_epochs(2, overlap=1)
+    assert len(imgs) == 6
+    for idx, epoch in enumerate(imgs):
+        if idx == 2:
+            assert epoch.tis == [1, 2]
+            assert np.allclose(epoch.data[..., 0], d[..., 2])
+            assert np.allclose(epoch.data[..., 1], d[..., 3])
+        else:
+            assert epoch.ntis == 1
+            assert np.allclose(epoch.data, np.mean(d[..., idx:idx+2], axis=-1))
+
+def test_split_epochs_lazy():
+    d = np.random.rand(5, 5, 5, 8)
+    img = AslImage(name="asldata", image=d, tis=[1, 2], order='tr')
+    imgs = img.split_epochs(4, overlap=2)
+    views = img.split_epochs(4, overlap=2, lazy=True)
+    assert len(views) == 3
+    assert [(view.start, view.end) for view in views] == [(0, 4), (2, 6), (4, 8)]
+    assert views[1].rpts == [2, 2]
+    for view, epoch in zip(views, imgs):
+        assert np.allclose(view.img().data, epoch.data)
+
+def test_split_epochs_bad_overlap():
+    d = np.random.rand(5, 5, 5, 8)
+    img = AslImage(name="asldata", image=d, tis=[1, 2], order='tr')
+    with pytest.raises(ValueError):
+        img.split_epochs(4, overlap=4)
+
+def test_vol_indices():
+    d = np.random.rand(5, 5, 5, 24)
+    img = AslImage(name="asldata", image=d, tis=[1, 2, 3], iaf="tc", order="ltr")
+    for order in ("ltr", "lrt", "trl", "rtl"):
+        label_idx, ti_idx, rpt_idx = img.vol_indices(order)
+        for vol in range(img.nvols):
+            assert img.get_vol_index(label_idx[vol], ti_idx[vol], rpt_idx[vol], order=order) == vol
+
+def test_vol_indices_var_rpts():
+    d = np.random.rand(5, 5, 5, 7)
+    img = AslImage(name="asldata", image=d, tis=[1, 2], rpts=[3, 4], order='rt')
+    _, ti_idx, rpt_idx = img.vol_indices()
+    assert list(ti_idx) == [0, 0, 0, 1, 1, 1, 1]
+    assert list(rpt_idx) == [0, 1, 2, 0, 1, 2, 3]
+    with pytest.raises(ValueError):
+        img.vol_indices("tr")
+
 def test_derived():
     d1 = np.random.rand(5, 5, 5, 8)
     d2 = np.random.rand(5, 5, 5, 8)
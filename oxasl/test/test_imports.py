@@ -0,0 +1,85 @@
+"""
+Tests for import time of command line tool modules
+
+Heavy dependencies should only be imported when they are first used so that
+command line tools start quickly
+"""
+import sys
+import subprocess
+
+import pytest
+
+# Modules which should not be imported until they are used
+HEAVY_MODULES = ["pandas", "yaml", "matplotlib", "scipy.ndimage", "fabber", "fsl.data.atlases"]
+
+# fslpy (and hence nibabel and numpy) is always required since AslImage is an fsl Image,
+# so import time is measured relative to the time to import it. Importing pandas eagerly
+# adds more than 70% to this so the budget catches heavy modules becoming eager again
+BASELINE_MODULES = ["fsl.data.image", "fsl.wrappers"]
+IMPORT_TIME_FACTOR = 1.5
+
+# Import times vary between runs so the fastest of several is used
+IMPORT_TIME_REPEATS = 7
+
+CLI_MODULES = ["oxasl", "oxasl.oxford_asl", "oxasl.preproc", "oxasl.mask", "oxasl.basil", "oxasl.calib", "oxasl.reg"]
+
+def _importtime(module):
+    """
+    Import a module in a fresh interpreter using ``-X importtime``
+
+    :return: Tuple of (dictionary of module name: cumulative import time in microseconds,
+             list of heavy modules which were imported, total import time in microseconds)
+    """
+    code = "import sys, %s; print(','.join([m for m in %r if m in sys.modules]))" % (module, HEAVY_MODULES)
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    assert proc.returncode == 0, stderr
+
+    times, total = {}, 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            # Header line
+            continue
+        if not name[1:].startswith(" "):
+            # Top level import, including interpreter startup
+            total += int(cumulative)
+    return times, [mod for mod in stdout.strip().split(",") if mod], total
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime requires Python 3.7")
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_no_heavy_imports(module):
+    """
+    Check heavy modules are not imported by command line tool modules
+    """
+    _, heavy, _ = _importtime(module)
+    assert heavy == []
+
+def _min_importtimes(*modules):
+    """
+    Measure the import time of each module, alternating between them so they are all
+    affected in the same way by other load on the system
+
+    :return: List of fastest total import time of each module in microseconds
+    """
+    totals = [[] for _ in modules]
+    for _ in range(IMPORT_TIME_REPEATS):
+        for module, module_totals in zip(modules, totals):
+            times, _, total = _importtime(module)
+            assert all([name.strip() in times for name in module.split(",")])
+            module_totals.append(total)
+    return [min(module_totals) for module_totals in totals]
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime requires Python 3.7")
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_import_time_budget(module):
+    """
+    Check import time of command line tool modules is within budget
+    """
+    baseline_time, module_time = _min_importtimes(", ".join(BASELINE_MODULES), module)
+    assert module_time < IMPORT_TIME_FACTOR * baseline_time
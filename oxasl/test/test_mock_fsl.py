@@ -0,0 +1,96 @@
+"""
+Tests for stand-in FSL and Fabber tools used for pipeline benchmarking
+"""
+import os
+import shutil
+import tempfile
+from six import StringIO
+
+import numpy as np
+
+from fsl.data.image import Image
+import fsl.wrappers as fsl
+
+from oxasl import Workspace, oxford_asl
+from oxasl.test.mock_fsl import MockBackends, synthetic_head, synthetic_subject, fabber, model_params, \
+                                flirt, applywarp, convertwarp
+
+def test_install_uninstall():
+    """
+    Check tools are replaced and restored
+    """
+    orig_bet = fsl.bet
+    with MockBackends() as backends:
+        assert fsl.bet is not orig_bet
+        fsl.bet(Image(synthetic_head((10, 10, 10))["struc"]))
+        assert backends.ncalls == {"bet" : 1}
+    assert fsl.bet is orig_bet
+
+def test_flirt_applywarp():
+    """
+    Check registration aligns a shifted image
+    """
+    data = synthetic_head((20, 20, 20))["brain"]
+    ref = Image(data, xform=np.diag([2.0, 2.0, 2.0, 1.0]))
+    src = Image(np.roll(data, 2, axis=0), xform=np.diag([2.0, 2.0, 2.0, 1.0]))
+    result = flirt(src, ref)
+    assert np.allclose(result["omat"][:3, 3], [-4, 0, 0], atol=0.1)
+    out = applywarp(src, ref, premat=result["omat"])["out"]
+    assert np.allclose(out.data[4:16, 4:16, 4:16], data[4:16, 4:16, 4:16], atol=1)
+
+def test_convertwarp():
+    """
+    Check a warp generated from a matrix gives the same result as the matrix
+    """
+    data = synthetic_head((20, 20, 20))["brain"]
+    ref = Image(data)
+    mat = np.identity(4)
+    mat[:3, 3] = [1.5, -2, 0.5]
+    warp = convertwarp(ref=ref, premat=mat)["out"]
+    assert warp.shape == (20, 20, 20, 3)
+    assert np.allclose(applywarp(ref, ref, warp=warp)["out"].data, applywarp(ref, ref, premat=mat)["out"].data, atol=1e-3)
+
+def test_model_params():
+    """
+    Check model parameters depend on the inclusion options
+    """
+    assert model_params({"inctiss" : True, "incbat" : True}) == ["ftiss", "delttiss"]
+    assert model_params({"inctiss" : True, "incbat" : True, "incpve" : True}) == ["ftiss", "delttiss", "fwm", "deltwm"]
+
+def test_fabber():
+    """
+    Check Fabber outputs and initialization from a previous run
+    """
+    data = Image(np.random.rand(5, 5, 5, 8))
+    options = {"data" : data, "inctiss" : True, "incbat" : True, "bat" : 1.3}
+    result = fabber(options)
+    assert result["paramnames"] == ["ftiss", "delttiss"]
+    assert result["finalMVN"].shape == (5, 5, 5, 6)
+    assert result["modelfit"].shape == (5, 5, 5, 8)
+    assert np.allclose(result["mean_ftiss"].data, np.mean(data.data, axis=-1))
+    assert np.allclose(result["mean_delttiss"].data, 1.3)
+
+    options["continue-from-mvn"] = result["finalMVN"]
+    options["bat"] = 0.7
+    assert np.allclose(fabber(options)["mean_delttiss"].data, 1.0)
+
+def test_pipeline():
+    """
+    Check the complete pipeline runs with the stand-in tools
+    """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        subject = synthetic_subject(asl_shape=(16, 16, 8), struc_shape=(32, 32, 16), plds=[1.0, 1.5], rpts=2)
+        wsp = Workspace(savedir=tempdir, log=StringIO(), calib_method="voxelwise", mc=True, pvcorr=True,
+                        output_native=True, output_struc=True, output_mni=True, save_mask=True, save_report=False,
+                        **subject)
+        fsldir = os.environ.get("FSLDIR", None)
+        with MockBackends() as backends:
+            oxford_asl.oxasl(wsp)
+        assert backends.ncalls["fabber"] > 0
+        assert os.environ.get("FSLDIR", None) == fsldir
+        assert wsp.output.native.perfusion_calib.shape == (16, 16, 8)
+        assert wsp.output.struct.perfusion_calib.shape == (32, 32, 16)
+        assert wsp.output.std.perfusion_calib.shape == (91, 109, 91)
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,218 @@
+"""
+Tests for MVN module
+"""
+import shutil
+import tempfile
+from six import StringIO
+
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import AslImage, Workspace
+from oxasl.basil import PvcInitStep, basil_prefit
+from oxasl.mvn import MVN, MvnCache
+
+def test_cache_key():
+    """
+    Check cache key depends on data and model structure but not other options
+    """
+    d = np.random.rand(5, 5, 5, 8)
+    asldata = AslImage(name="asldata", image=d, tis=[1, 2], order="rt")
+    asldata2 = AslImage(name="asldata2", image=d + 1, tis=[1, 2], order="rt")
+    cache = MvnCache(tempfile.mktemp("_oxasl"))
+    key = cache.key(asldata, None, {})
+    assert key == cache.key(asldata, None, {"model" : "aslrest", "batsd" : 0.5})
+    assert key != cache.key(asldata2, None, {})
+    assert key != cache.key(asldata, None, {"disp" : "gamma"})
+
+def test_cache_miss():
+    """
+    Check no initial MVN is returned if the cache is empty
+    """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        cache = MvnCache(tempdir, log=StringIO())
+        assert cache.entries("wibble") == []
+        assert cache.initmvn("wibble", ["ftiss", "delttiss"]) is None
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_cache_store_same_params():
+    """
+    Check a stored MVN is returned unchanged for the same parameter set
+    """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        cache = MvnCache(tempdir, log=StringIO())
+        mvn = Image(np.random.rand(5, 5, 5, 6))
+        cache.store("key", mvn, ["ftiss", "delttiss"])
+        entries = cache.entries("key")
+        assert len(entries) == 1
+        assert entries[0][1] == ["ftiss", "delttiss"]
+        initmvn = cache.initmvn("key", ["ftiss", "delttiss"])
+        assert np.allclose(initmvn.data, mvn.data)
+        assert cache.initmvn("otherkey", ["ftiss", "delttiss"]) is None
+    finally:
+        shutil.rmtree(tempdir)
+
+def _random_mvn(paramnames):
+    nparams = len(paramnames)
+    return MVN(np.random.rand(5, 5, 5, nparams*(nparams+1)//2 + nparams + 1), paramnames)
+
+def test_mvn_nparams():
+    """
+    Check number of parameters is determined from number of volumes
+    """
+    for nparams in range(1, 8):
+        mvn = MVN(np.zeros((5, 5, 5, nparams*(nparams+1)//2 + nparams + 1)))
+        assert mvn.nparams == nparams
+
+def test_mvn_bad_nvols():
+    """
+    Check invalid number of volumes is detected
+    """
+    with pytest.raises(ValueError):
+        MVN(np.zeros((5, 5, 5, 7)))
+    with pytest.raises(ValueError):
+        MVN(np.zeros((5, 5, 5, 6)), ["ftiss"])
+
+def test_mvn_layout():
+    """
+    Check means and covariances are read from the packed layout
+    """
+    # 3 parameters - 6 covariance volumes, 3 mean volumes and 1
+    data = np.zeros((5, 5, 5, 10))
+    for vol in range(10): data[..., vol] = vol
+    mvn = MVN(data, ["ftiss", "delttiss", "fwm"])
+    assert np.all(mvn.var("ftiss") == 0)
+    assert np.all(mvn.cov("delttiss", "ftiss") == 1)
+    assert np.all(mvn.cov("ftiss", "delttiss") == 1)
+    assert np.all(mvn.var("delttiss") == 2)
+    assert np.all(mvn.cov("fwm", "delttiss") == 4)
+    assert np.all(mvn.var("fwm") == 5)
+    assert np.all(mvn.mean("ftiss") == 6)
+    assert np.all(mvn.mean(2) == 8)
+
+def test_mvn_set_masked():
+    """
+    Check setting means and variances within a mask
+    """
+    mvn = _random_mvn(["ftiss", "fwm"])
+    orig = np.copy(mvn.data)
+    mask = np.zeros((5, 5, 5), dtype=int)
+    mask[1:3, 1:3, 1:3] = 1
+    values = Image(np.random.rand(5, 5, 5))
+    mvn.set_mean("fwm", values, mask=Image(mask))
+    mvn.set_var("fwm", 0.1, mask=mask)
+    assert np.allclose(mvn.mean("fwm")[mask == 1], values.data[mask == 1])
+    assert np.allclose(mvn.mean("fwm")[mask == 0], orig[..., 4][mask == 0])
+    assert np.allclose(mvn.var("fwm")[mask == 1], 0.1)
+    assert np.allclose(mvn.var("fwm")[mask == 0], orig[..., 2][mask == 0])
+    assert np.allclose(mvn.mean("ftiss"), orig[..., 3])
+    assert np.allclose(mvn.cov("ftiss", "fwm"), orig[..., 1])
+
+def test_mvn_unknown_param():
+    """
+    Check error on unknown parameter name
+    """
+    mvn = _random_mvn(["ftiss", "fwm"])
+    with pytest.raises(ValueError):
+        mvn.mean("wibble")
+    with pytest.raises(ValueError):
+        mvn.mean(2)
+
+def test_mvn_remap():
+    """
+    Check remapping parameters by name
+    """
+    mvn = _random_mvn(["ftiss", "delttiss", "fblood"])
+    remapped = mvn.remap(["fblood", "ftiss", "fwm"], mean=0.5, var=2.0)
+    assert remapped.nparams == 3
+    assert np.allclose(remapped.mean("ftiss"), mvn.mean("ftiss"))
+    assert np.allclose(remapped.mean("fblood"), mvn.mean("fblood"))
+    assert np.allclose(remapped.var("fblood"), mvn.var("fblood"))
+    assert np.allclose(remapped.cov("ftiss", "fblood"), mvn.cov("ftiss", "fblood"))
+    assert np.allclose(remapped.mean("fwm"), 0.5)
+    assert np.allclose(remapped.var("fwm"), 2.0)
+    assert np.allclose(remapped.cov("ftiss", "fwm"), 0)
+    assert remapped.image().shape == (5, 5, 5, 10)
+
+def test_cache_remap():
+    """
+    Check a stored MVN is remapped for a different parameter set
+    """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        cache = MvnCache(tempdir, log=StringIO())
+        mvn = _random_mvn(["ftiss", "delttiss"])
+        cache.store("key", mvn.image(), ["ftiss", "delttiss"])
+        initmvn = MVN(cache.initmvn("key", ["ftiss", "delttiss", "fwm", "deltwm"]), ["ftiss", "delttiss", "fwm", "deltwm"])
+        assert np.allclose(initmvn.mean("delttiss"), mvn.mean("delttiss"))
+        assert np.allclose(initmvn.cov("ftiss", "delttiss"), mvn.cov("ftiss", "delttiss"))
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_mvn_remap_priors():
+    """
+    Check parameters not in the MVN are initialized from their priors
+    """
+    mvn = _random_mvn(["ftiss"])
+    remapped = mvn.remap(["ftiss", "delttiss", "fwm"], priors={"delttiss" : (1.3, 0.25), "fblood" : (2.0, 2.0)})
+    assert np.allclose(remapped.mean("ftiss"), mvn.mean("ftiss"))
+    assert np.allclose(remapped.mean("delttiss"), 1.3)
+    assert np.allclose(remapped.var("delttiss"), 0.25)
+    assert np.allclose(remapped.mean("fwm"), 0)
+    assert np.allclose(remapped.var("fwm"), 1)
+
+def test_prefit_cache_priors():
+    """
+    Check the cached MVN lookup uses the parameters of the final step and initializes
+    missing parameters from their priors, without logging the modelling steps
+    """
+    from oxasl.test.mock_fsl import MockBackends
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        d = np.random.rand(5, 5, 5, 8)
+        log = StringIO()
+        wsp = Workspace(log=log, infertiss=True, inferbat=True, infertau=False, spatial=True, mvn_cache=tempdir)
+        wsp.asldata = AslImage(name="asldata", image=d, tis=[1, 2], iaf="diff", order="rt")
+        wsp.rois = Workspace(mask=Image(np.ones((5, 5, 5))))
+
+        cache = MvnCache(tempdir, log=log)
+        cached = _random_mvn(["ftiss"])
+        cache.store(cache.key(wsp.asldata, wsp.rois.mask, {}), cached.image(), ["ftiss"])
+
+        output_wsp = wsp.sub("basil")
+        with MockBackends():
+            basil_prefit(wsp, output_wsp)
+        initmvn = MVN(output_wsp.initmvn, ["ftiss", "delttiss"])
+        assert np.allclose(initmvn.mean("ftiss"), cached.mean("ftiss"))
+        assert np.allclose(initmvn.mean("delttiss"), wsp.bat)
+        assert np.allclose(initmvn.var("delttiss"), wsp.batsd**2)
+        assert "BASIL v" not in log.getvalue()
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_pvc_init_step():
+    """
+    Check PVC initialisation sets GM and WM perfusion in the MVN
+    """
+    mvn = _random_mvn(["ftiss", "delttiss", "fwm", "deltwm"])
+    ftiss = np.random.rand(5, 5, 5)
+    pgm = np.random.rand(5, 5, 5)
+    pwm = np.random.rand(5, 5, 5)
+    mask = np.ones((5, 5, 5), dtype=int)
+    mask[0] = 0
+    step = PvcInitStep({"mask" : Image(mask), "pgm" : Image(pgm), "pwm" : Image(pwm)}, "PVC initialisation")
+    prev_output = {"finalMVN" : mvn.image(), "paramnames" : mvn.paramnames, "mean_ftiss" : Image(ftiss)}
+    output = step.run(prev_output, log=StringIO())
+
+    gmcbf = (ftiss - ftiss * 0.4 * pwm) / np.maximum(pgm, 0.2)
+    outmvn = MVN(output["finalMVN"], mvn.paramnames)
+    assert np.allclose(outmvn.mean("ftiss")[mask == 1], gmcbf[mask == 1])
+    assert np.allclose(outmvn.mean("fwm")[mask == 1], gmcbf[mask == 1] * 0.4)
+    assert np.allclose(outmvn.var("ftiss")[mask == 1], 0.1)
+    assert np.allclose(outmvn.mean("ftiss")[mask == 0], mvn.mean("ftiss")[mask == 0])
+    assert np.allclose(outmvn.mean("delttiss"), mvn.mean("delttiss"))
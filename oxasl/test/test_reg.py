@@ -59,3 +59,209 @@ def test_get_regfrom_calib():
     reg.get_regfrom(wsp)
     calib_brain = brain.brain(wsp, wsp.calib, thresh=0.2)
     assert(np.allclose(calib_brain.data, wsp.reg.regfrom.data))
+
+def test_transform_batch_shape_mismatch():
+    """
+    Test batch transformation requires images of the same shape
+    """
+    wsp = get_wsp()
+    imgs = {"a" : Image(np.random.rand(5, 5, 5)), "b" : Image(np.random.rand(5, 5, 6))}
+    with pytest.raises(ValueError):
+        reg.transform_batch(wsp, imgs, np.identity(4), wsp.calib)
+
+def test_transform_batch():
+    """
+    Test batch transformation gives the same result as transforming individually
+    """
+    from oxasl.test.mock_fsl import MockBackends
+    wsp = get_wsp()
+    imgs = dict([("img%i" % idx, Image(np.random.rand(5, 5, 5))) for idx in range(5)])
+    with MockBackends() as backends:
+        batch = reg.transform_batch(wsp, imgs, np.identity(4), wsp.calib, max_vols=2)
+        assert backends.ncalls["applywarp"] == 3
+        assert sorted(batch.keys()) == sorted(imgs.keys())
+        for name, img in imgs.items():
+            single = reg.transform(wsp, img, np.identity(4), wsp.calib)
+            assert np.allclose(batch[name].data, single.data)
+
+def test_asl2std_linear():
+    """
+    Test composite ASL->standard transformation for linear registration
+    """
+    wsp = get_wsp()
+    reg.init(wsp)
+    asl2struc = np.identity(4)
+    asl2struc[:3, 3] = [1, 2, 3]
+    struc2std = np.diag([2.0, 2.0, 2.0, 1.0])
+    wsp.reg.asl2struc = asl2struc
+    wsp.reg.struc2std = struc2std
+    wsp.reg.std2struc = np.linalg.inv(struc2std)
+    reg.reg_asl2std(wsp)
+    assert np.allclose(wsp.reg.asl2std, np.dot(struc2std, asl2struc))
+    assert np.allclose(np.dot(wsp.reg.asl2std, [0, 0, 0, 1]), [2, 4, 6, 1])
+
+def test_std2asl_linear():
+    """
+    Test composite standard->ASL transformation for linear registration
+    """
+    wsp = get_wsp()
+    reg.init(wsp)
+    struc2asl = np.identity(4)
+    struc2asl[:3, 3] = [1, 2, 3]
+    std2struc = np.diag([0.5, 0.5, 0.5, 1.0])
+    wsp.reg.struc2asl = struc2asl
+    wsp.reg.std2struc = std2struc
+    reg.reg_std2asl(wsp)
+    assert np.allclose(wsp.reg.std2asl, np.dot(struc2asl, std2struc))
+
+def _rotation_matrix(angle, trans=(0, 0, 0)):
+    """
+    Rotation about the z axis in degrees followed by translation
+    """
+    theta = math.radians(angle)
+    mat = np.identity(4)
+    mat[:2, :2] = [[math.cos(theta), -math.sin(theta)], [math.sin(theta), math.cos(theta)]]
+    mat[:3, 3] = trans
+    return mat
+
+def test_get_motion_params_single():
+    """
+    Test motion parameters of a single matrix
+    """
+    mat = _rotation_matrix(10, trans=(3, 4, 0))
+    orig = np.copy(mat)
+    trans, angle, axis = reg.get_motion_params(mat)
+    assert trans == pytest.approx(5)
+    assert angle == pytest.approx(10)
+    assert axis[0] == pytest.approx(0)
+    assert axis[1] == pytest.approx(0)
+    assert np.all(mat == orig)
+
+def test_get_motion_params_batch():
+    """
+    Test batched motion parameters match single matrix results and inputs are not modified
+    """
+    mats = np.array([_rotation_matrix(angle, trans=(angle, 0, 1)) for angle in (-20, -5, 0, 5, 20)])
+    mats[:, :3, :3] *= 1.05
+    orig = np.copy(mats)
+    trans, angles, axes = reg.get_motion_params(mats)
+    assert trans.shape == (5,) and angles.shape == (5,) and axes.shape == (5, 3)
+    assert np.allclose(np.abs(angles), [20, 5, 0, 5, 20])
+    for idx, mat in enumerate(mats):
+        single_trans, single_angle, single_axis = reg.get_motion_params(mat)
+        assert trans[idx] == pytest.approx(single_trans)
+        assert angles[idx] == pytest.approx(single_angle)
+        assert np.allclose(axes[idx], single_axis)
+    assert np.all(mats == orig)
+
+def test_get_motion_params_invalid():
+    """
+    Test invalid matrices give default parameters and a warning
+    """
+    mats = np.array([np.identity(4), np.zeros((4, 4))])
+    with pytest.warns(UserWarning):
+        trans, angles, axes = reg.get_motion_params(mats)
+    assert trans[1] == 1 and angles[1] == 0
+    assert np.all(axes[1] == [0, 0, 1])
+    with pytest.raises(ValueError):
+        reg.get_motion_params(np.identity(3))
+
+def test_framewise_displacement():
+    """
+    Test framewise displacement for translations and rotations
+    """
+    mats = [np.identity(4), _rotation_matrix(0, trans=(1, 2, 2)), _rotation_matrix(0, trans=(1, 2, 2)), _rotation_matrix(1, trans=(1, 2, 2))]
+    fd = reg.framewise_displacement(np.concatenate(mats, axis=0))
+    assert fd.shape == (4,)
+    assert fd[0] == 0
+    assert fd[1] == pytest.approx(3)
+    assert fd[2] == pytest.approx(0)
+    # For small rotations about z the RMS displacement over a sphere is r * theta * sqrt(0.4)
+    assert fd[3] == pytest.approx(80 * math.radians(1) * math.sqrt(0.4), rel=1e-3)
+
+def test_framewise_displacement_centre():
+    """
+    Test framewise displacement includes the displacement of the sphere centre
+    """
+    centre = np.array([100.0, 100.0, 50.0])
+    # Rotation about the centre does not move it
+    about_centre = _rotation_matrix(1)
+    about_centre[:3, 3] = centre - np.dot(about_centre[:3, :3], centre)
+    mats = np.stack([np.identity(4), about_centre])
+    fd = reg.framewise_displacement(mats, centre=centre)
+    assert fd[1] == pytest.approx(80 * math.radians(1) * math.sqrt(0.4), rel=1e-3)
+
+    # Rotation about the origin also moves the centre
+    mats = np.stack([np.identity(4), _rotation_matrix(1)])
+    shift = np.linalg.norm(np.dot(_rotation_matrix(1)[:3, :3] - np.identity(3), centre))
+    fd = reg.framewise_displacement(mats, centre=centre)
+    assert fd[1] == pytest.approx(math.sqrt((80 * math.radians(1))**2 * 0.4 + shift**2), rel=1e-3)
+
+def _smooth_head(shape=(24, 24, 16)):
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing="ij")
+    return 100 * np.exp(-(x**2 + 2*y**2 + 3*z**2) / 0.3) + 20 * np.exp(-((x-0.3)**2 + y**2 + z**2) / 0.05)
+
+def test_rigid_register():
+    """
+    Test in-process rigid body registration recovers a known transformation
+    """
+    pixdims = np.array([3.0, 3.0, 4.0])
+    data = _smooth_head()
+    ref = Image(data, xform=np.diag(list(pixdims) + [1.0]))
+    centre = np.mean(np.indices(data.shape).reshape(3, -1) * pixdims[:, np.newaxis], axis=1)
+    src2ref = reg._rigid_matrix(np.array([2.0, -1.5, 1.0, 0.03, -0.02, 0.05]), centre)
+    src = Image(reg._resample_rigid(data, src2ref, pixdims), header=ref.header)
+    mat = reg.rigid_register(src, ref)
+    assert np.allclose(mat[:3, :3], src2ref[:3, :3], atol=0.01)
+    assert np.allclose(mat[:3, 3], src2ref[:3, 3], atol=0.2)
+
+def test_motion_correct():
+    """
+    Test in-process motion correction aligns volumes to the middle volume
+    """
+    data = _smooth_head()
+    vols = [np.roll(data, shift, axis=0) for shift in (-1, 0, 1)]
+    img = Image(np.stack(vols, axis=-1))
+    corrected, mats = reg.motion_correct(img)
+    assert corrected.shape == img.shape
+    assert len(mats) == 3
+    assert np.allclose(mats[1], np.identity(4))
+    assert np.allclose([mats[0][0, 3], mats[2][0, 3]], [1, -1], atol=0.05)
+    assert np.allclose(corrected.data[2:-2, ..., 0], data[2:-2], atol=1)
+    with pytest.raises(ValueError):
+        reg.motion_correct(Image(data))
+
+def test_reg_bbr():
+    """
+    Test BBR registration uses the existing segmentation and only outputs the matrix by default
+    """
+    from six import StringIO
+    from oxasl.test.mock_fsl import MockBackends, synthetic_head
+
+    head = synthetic_head((20, 20, 20))
+    wsp = Workspace(log=StringIO())
+    wsp.sub("structural")
+    wsp.structural.struc = Image(head["struc"])
+    wsp.structural.brain = Image(head["brain"])
+    reg.init(wsp)
+    wsp.reg.regfrom = Image(head["brain"][::2, ::2, ::2], xform=np.diag([2.0, 2.0, 2.0, 1.0]))
+    wsp.nativeref = wsp.reg.regfrom
+    wsp.reg.asl2struc = np.identity(4)
+    regto = Image(head["brain"])
+    wsp.reg.regto = regto
+    with MockBackends() as backends:
+        reg.reg_asl2struc(wsp, flirt=False, bbr=True, name="final", output_image=False)
+        assert np.allclose(wsp.reg.regto.data, regto.data)
+        assert np.allclose(wsp.reg.asl2struc, np.identity(4))
+        # The WM boundary is only needed for the report
+        assert wsp.structural.wm_edge is None
+        wsp.save_report = True
+        reg.reg_asl2struc(wsp, flirt=False, bbr=True, name="final", output_image=False)
+        edge = wsp.structural.wm_edge
+        assert edge is not None
+        reg.reg_bbr(wsp)
+    assert backends.ncalls["fast"] == 1
+    assert backends.ncalls["flirt"] == 3
+    wm = wsp.structural.wm_seg.data > 0
+    assert np.all(edge.data[~wm] == 0)
+    assert 0 < np.count_nonzero(edge.data) < np.count_nonzero(wm)
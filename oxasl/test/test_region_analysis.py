@@ -0,0 +1,133 @@
+"""
+Tests for region analysis module
+"""
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import Workspace
+from oxasl.region_analysis import RoiStats, LabelStats, tissue_rois, region_stats, PERCENTILES
+
+def test_roi_stats():
+    """
+    Check statistics match those calculated separately for each image and region
+    """
+    gm = np.random.rand(5, 5, 5)
+    mask = np.zeros((5, 5, 5), dtype=int)
+    mask[1:4, 1:4, 1:4] = 1
+    imgs = {"perfusion" : Image(np.random.rand(5, 5, 5)), "arrival" : np.random.rand(5, 5, 5)}
+
+    rois = RoiStats()
+    rois.add_roi("mask", Image(mask))
+    rois.add_roi("gm", gm, thresh=0.8)
+    rows = rois.stats(imgs)
+    assert len(rows) == 4
+    for row in rows:
+        data = imgs[row["output"]]
+        if isinstance(data, Image):
+            data = data.data
+        roi = mask > 0.5 if row["roi"] == "mask" else gm > 0.8
+        values = data[roi]
+        assert row["nvoxels"] == np.count_nonzero(roi)
+        assert row["mean"] == pytest.approx(np.mean(values), rel=1e-5)
+        assert row["std"] == pytest.approx(np.std(values), rel=1e-4)
+        assert row["median"] == pytest.approx(np.median(values), rel=1e-5)
+        for percentile in PERCENTILES:
+            assert row["p%i" % percentile] == pytest.approx(np.percentile(values, percentile), rel=1e-5)
+
+def test_roi_stats_empty_roi():
+    """
+    Check statistics of an empty region are NaN
+    """
+    rois = RoiStats()
+    rois.add_roi("empty", np.zeros((5, 5, 5)))
+    rows = rois.stats({"perfusion" : np.random.rand(5, 5, 5)})
+    assert rows[0]["nvoxels"] == 0
+    assert np.isnan(rows[0]["mean"])
+
+def test_roi_stats_bad_shape():
+    """
+    Check regions and images must have consistent shapes
+    """
+    rois = RoiStats()
+    rois.add_roi("mask", np.ones((5, 5, 5)))
+    with pytest.raises(ValueError):
+        rois.add_roi("gm", np.ones((5, 5, 6)))
+    with pytest.raises(ValueError):
+        rois.stats({"perfusion" : np.ones((5, 5, 6))})
+
+def test_roi_stats_dataframe():
+    """
+    Check statistics can be returned as a tidy DataFrame
+    """
+    rois = RoiStats()
+    rois.add_roi("mask", np.ones((5, 5, 5)))
+    df = rois.stats_dataframe({"perfusion" : np.ones((5, 5, 5)), "arrival" : np.zeros((5, 5, 5))})
+    assert list(df["output"]) == ["perfusion", "arrival"]
+    assert list(df["mean"]) == [1, 0]
+    assert "p95" in df.columns
+
+def test_tissue_rois_cached():
+    """
+    Check tissue regions are created once per workspace and use ASL space PV maps
+    """
+    wsp = Workspace()
+    wsp.sub("rois")
+    wsp.rois.mask = Image(np.ones((5, 5, 5)))
+    wsp.sub("structural")
+    wsp.structural.struc = Image(np.random.rand(10, 10, 10))
+    wsp.structural.gm_pv_asl = Image(np.random.rand(5, 5, 5))
+    wsp.structural.wm_pv_asl = Image(np.random.rand(5, 5, 5))
+    rois = tissue_rois(wsp)
+    assert list(rois.rois.keys()) == ["mask", "gm", "pure_gm", "wm", "pure_wm"]
+    assert len(rois.rois["pure_gm"]) == np.count_nonzero(wsp.structural.gm_pv_asl.data > 0.8)
+    assert tissue_rois(wsp) is rois
+
+def test_label_stats():
+    """
+    Check statistics for all labels match those calculated separately for each label
+    """
+    labels = np.random.randint(0, 5, size=(5, 5, 5))
+    imgs = {"perfusion" : Image(np.random.rand(5, 5, 5)), "arrival" : np.random.rand(5, 5, 5)}
+    label_stats = LabelStats(Image(labels), {1 : "one", 2 : "two", 3 : "three", 4 : "four"})
+    rows = label_stats.stats(imgs)
+    assert len(rows) == 8
+    for row in rows:
+        data = imgs[row["output"]]
+        if isinstance(data, Image):
+            data = data.data
+        values = data[labels == row["label"]]
+        assert row["nvoxels"] == len(values)
+        assert row["mean"] == pytest.approx(np.mean(values), rel=1e-5)
+        assert row["std"] == pytest.approx(np.std(values), rel=1e-4, abs=1e-6)
+
+def test_label_stats_names():
+    """
+    Check default label names and labels with no voxels
+    """
+    labels = np.zeros((5, 5, 5), dtype=int)
+    labels[0] = 2
+    label_stats = LabelStats(labels)
+    assert list(label_stats.names.items()) == [(2, "label_2")]
+
+    label_stats = LabelStats(labels, {2 : "two", 7 : "seven"})
+    df = label_stats.stats_dataframe({"perfusion" : np.ones((5, 5, 5))})
+    assert list(df["roi"]) == ["two", "seven"]
+    assert list(df["nvoxels"]) == [25, 0]
+    assert df["mean"][0] == 1
+    assert np.isnan(df["mean"][1])
+
+def test_region_stats_atlas_img():
+    """
+    Check regional statistics using a user-supplied atlas already in ASL space
+    """
+    wsp = Workspace()
+    labels = np.zeros((5, 5, 5), dtype=int)
+    labels[:2] = 1
+    labels[3:] = 2
+    wsp.atlas_labels = Image(labels)
+    perfusion = np.random.rand(5, 5, 5)
+    region_stats(wsp, {"perfusion" : Image(perfusion)})
+    assert list(wsp.region_stats["roi"]) == ["label_1", "label_2"]
+    assert wsp.region_stats["mean"][1] == pytest.approx(np.mean(perfusion[3:]), rel=1e-5)
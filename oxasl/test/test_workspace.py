@@ -12,7 +12,7 @@ import pytest
 from fsl.data.image import Image
 
 from oxasl import Workspace, AslImage
-from oxasl.workspace import text_to_matrix
+from oxasl.workspace import text_to_matrix, matrix_to_text
 
 def test_default_attr():
     """ Check attributes are None by default """
@@ -424,3 +424,41 @@ def test_text_to_matrix_not_numbers():
     text = "1 x 3\n4 5 6\n"
     with pytest.raises(ValueError):
         mat = text_to_matrix(text)
+
+def test_text_to_matrix_comments():
+    """
+    Check that text_to_matrix ignores comments and blank lines
+    """
+    text = "# Matrix\n1 2 3 # first row\n\n4 5 6\n"
+    mat = text_to_matrix(text)
+    assert(np.all(mat == [[1, 2, 3], [4, 5, 6]]))
+
+def test_text_to_matrix_error_messages():
+    """
+    Check that text_to_matrix gives helpful error messages
+    """
+    with pytest.raises(ValueError, match="fixed size"):
+        text_to_matrix("1 2 3\n4 5\n")
+    with pytest.raises(ValueError, match="Non-numeric value 'x'"):
+        text_to_matrix("1 x 3\n4 5 6\n")
+
+def test_matrix_text_roundtrip():
+    """
+    Check that matrices are preserved exactly when converted to text and back
+    """
+    mat = np.random.rand(400, 4)
+    assert(np.all(text_to_matrix(matrix_to_text(mat)) == mat))
+
+def test_matrix_save_npy():
+    """
+    Test large matrices are also saved in .npy format if requested
+    """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        wsp = Workspace(savedir=tempdir, save_npy=True)
+        wsp.smallmat = np.random.rand(4, 4)
+        wsp.largemat = np.random.rand(4000, 4)
+        assert(not os.path.exists(os.path.join(tempdir, "smallmat.npy")))
+        assert(np.all(np.load(os.path.join(tempdir, "largemat.npy")) == wsp.largemat))
+    finally:
+        shutil.rmtree(tempdir)
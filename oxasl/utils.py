@@ -2,7 +2,12 @@
 Misc utility functions
 """
 
+import hashlib
+
 import six
+import numpy as np
+
+from fsl.data.image import Image
 
 class Tee(object):
     """
@@ -38,3 +43,21 @@ class Tee(object):
 
     def __str__(self):
         return self._streams[0].getvalue()
+
+def data_hash(*items):
+    """
+    Get a hash string identifying the content of images or arrays
+
+    :param items: fsl.data.image.Image objects, Numpy arrays, or other values whose
+                  string representation identifies them. None is permitted
+    :return: Hex digest string
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        data = item.data if isinstance(item, Image) else item
+        if isinstance(data, np.ndarray):
+            digest.update(str((data.shape, data.dtype.str)).encode("utf-8"))
+            digest.update(np.ascontiguousarray(data).tobytes())
+        else:
+            digest.update(str(item).encode("utf-8"))
+    return digest.hexdigest()
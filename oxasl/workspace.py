@@ -24,11 +24,10 @@ import errno
 import glob
 import shutil
 import tempfile
+import warnings
 
 import six
 import numpy as np
-import pandas as pd
-import yaml
 
 from fsl.data.image import Image
 
@@ -256,7 +255,10 @@ class Workspace(object):
                     # Save as ASCII matrix
                     with open(os.path.join(self.savedir, save_name + ".mat"), "w") as tfile:
                         tfile.write(matrix_to_text(value))
-                elif not name.startswith("_") and isinstance(value, pd.DataFrame):
+                    if self.save_npy and value.size >= NPY_MIN_SIZE:
+                        # Large matrices are also saved in binary format for fast loading
+                        np.save(os.path.join(self.savedir, save_name + ".npy"), value)
+                elif not name.startswith("_") and _is_dataframe(value):
                     # Save data frame in CSV file
                     value.to_csv(os.path.join(self.savedir, save_name + ".csv"), index=True, header=True)
                 elif not name.startswith("_") and isinstance(value, (int, float, six.string_types)):
@@ -292,22 +294,53 @@ class Workspace(object):
         return sub_wsp
 
     def _save_stuff(self):
+        import yaml
         with open(os.path.join(self.savedir, "_oxasl.yml"), "w") as tfile:
             yaml.dump(self._stuff, tfile, default_flow_style=False)
 
+# Format for each value when saving matrices as text
+MATRIX_FMT = "%.17g"
+
+# Minimum number of elements for a matrix to be saved in .npy format as well as text,
+# if the ``save_npy`` attribute is set
+NPY_MIN_SIZE = 1000
+
+def _is_dataframe(value):
+    """
+    :return: True if value is a pandas DataFrame. Pandas is slow to import, and
+             if it has not been imported already the value cannot be a DataFrame
+    """
+    pd = sys.modules.get("pandas", None)
+    return pd is not None and isinstance(value, pd.DataFrame)
+
 def matrix_to_text(mat):
     """
     Convert matrix array to text using spaces/newlines as col/row delimiters
+
+    Values are written with 17 significant figures so that double precision
+    values are preserved exactly
     """
-    rows = []
-    for row in mat:
-        rows.append(" ".join([str(v) for v in row]))
-    return "\n".join(rows)
+    mat = np.asarray(mat)
+    row_fmt = " ".join([MATRIX_FMT] * mat.shape[1])
+    return "\n".join([row_fmt % tuple(row) for row in mat.tolist()])
 
 def text_to_matrix(text):
     """
     Convert space or comma separated file to matrix
     """
+    try:
+        with warnings.catch_warnings():
+            # Numpy warns about empty input
+            warnings.simplefilter("ignore")
+            mat = np.loadtxt(six.StringIO(text.replace(",", " ")), comments="#", ndmin=2, dtype=np.float64)
+        if mat.size > 0:
+            return mat
+    except ValueError:
+        # Fall through to the slow path to generate a helpful error message
+        pass
+    return _text_to_matrix(text)
+
+def _text_to_matrix(text):
     fvals = []
     ncols = -1
     lines = text.splitlines()
@@ -2,8 +2,8 @@
 Additional FSL wrappers intended to be compatible with FSL python wrappers as far as possible
 """
 
-from .fabber import fabber, mvntool
+from .fabber import fabber, mvntool, model_params
 from .epi_reg import epi_reg
 from .fnirt_extra import fnirtfileutils
 
-__all__ = ["fabber", "mvntool", "epi_reg", "fnirtfileutils"]
+__all__ = ["fabber", "mvntool", "model_params", "epi_reg", "fnirtfileutils"]
@@ -5,6 +5,7 @@ from __future__ import absolute_import
 
 import sys
 import os
+import threading
 
 import six
 import numpy as np
@@ -14,8 +15,6 @@ from fsl.data.image import Image
 from fsl.wrappers import LOAD, wrapperutils  as wutils
 import fsl.utils.assertions as asrt
 
-from fabber import Fabber, FabberException, percent_progress
-
 from oxasl.utils import Tee
 
 def _matching_image(base_img, img):
@@ -26,6 +25,27 @@ def _matching_image(base_img, img):
     else:
         return img
 
+# Fabber API instances keep the state of the current run, so each thread has its own
+_FABBER_INSTANCES = threading.local()
+
+def _get_fabber(*extra_search_dirs):
+    """
+    Get a Fabber API instance for the given search directories
+
+    Creating the API object involves searching for the Fabber libraries and
+    executables so instances are cached and reused by subsequent runs. Instances
+    hold the handle and log of the current run so are not shared between threads.
+    The Fabber API is imported on first use so that it is not required unless model
+    fitting is performed
+    """
+    instances = getattr(_FABBER_INSTANCES, "instances", None)
+    if instances is None:
+        instances = _FABBER_INSTANCES.instances = {}
+    if extra_search_dirs not in instances:
+        from fabber import Fabber
+        instances[extra_search_dirs] = Fabber(*extra_search_dirs)
+    return instances[extra_search_dirs]
+
 class _Results(dict):
     """
     Nicked from fsl.wrapperutils
@@ -70,8 +90,9 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
              type of the main input data unless this was a file in which case
              an fsl.data.image.Image is returned.
     """
+    from fabber import FabberException, percent_progress
     extra_search_dirs = kwargs.pop("fabber_dirs", ())
-    fab = Fabber(*extra_search_dirs)
+    fab = _get_fabber(*extra_search_dirs)
 
     options = dict(options)
     main_data = options.get("data", None)
@@ -168,6 +189,22 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
 
     return ret
 
+def model_params(options, **kwargs):
+    """
+    Get the names of the model parameters which a Fabber run would infer
+
+    :param options: Fabber run options, as for ``fabber``
+    :return: List of parameter names in the order used in the MVN output
+    """
+    extra_search_dirs = kwargs.pop("fabber_dirs", ())
+    fab = _get_fabber(*extra_search_dirs)
+    options = dict(options)
+    for key in list(options.keys()):
+        value = options[key]
+        if isinstance(value, Image):
+            options[key] = value.nibImage
+    return fab.get_model_params(options)
+
 @wutils.fileOrImage('mvn', 'output', 'valim', 'varim', 'mask')
 @wutils.fslwrapper
 def mvntool(mvn, param, **kwargs):